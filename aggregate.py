@@ -1,64 +1,153 @@
-# fetch the most recent timestamp from the station_status_log table
-# compute aggregates (total bikes, total docks, empty/full stations) for that timestamp
-# insert these aggregates into the system_aggregate_log table
-from env_var import ENDPOINT, PW, USERNAME, NAME, PORT
+# compute system_aggregate_log rows from station_status_log, set-based
+#   python aggregate.py                       aggregate any snapshot from the last day that has no row yet
+#   python aggregate.py --since 2025-11-01    ... any missing snapshot since then
+#   python aggregate.py --since 2025-11-01 --until 2025-11-08 --recompute --threshold 5
+#                                             recompute (upsert) every snapshot in the range
+# one INSERT ... SELECT ... GROUP BY fetched_at per chunk (--chunk-hours), each chunk in its own
+# transaction so locks stay short; re-running is safe (ON CONFLICT on the unique fetched_at index).
+# the hourly / daily rollups of the touched days are rebuilt from the result. every gbfs system
+# in the range is handled, each keeps its own rows (system_id). a range the ingest stored in delta
+# mode (station_status_change, see flow.stored_as_changes) is refused
+import argparse
+import datetime as dt
+
 import psycopg2
 
+import flow
+import instrument
+
+METRICS = ("total_bikes_av", "total_docks_av", "empty_stations", "full_stations")
+TIMEZONE = "America/Toronto"
+
+BACKFILL = """
+    WITH snapshots AS (
+        SELECT DISTINCT system_id, fetched_at FROM station_status_log
+        WHERE fetched_at >= %(start)s AND fetched_at < %(end)s
+        {missing_only}
+    )
+    INSERT INTO system_aggregate_log
+    (system_id, total_bikes_av, total_docks_av, empty_stations, full_stations, fetched_at)
+    SELECT
+        l.system_id,
+        SUM(l.bikes_av),
+        SUM(l.docks_av),
+        COUNT(*) FILTER (WHERE l.bikes_av < %(threshold)s),
+        COUNT(*) FILTER (WHERE l.docks_av < %(threshold)s),
+        l.fetched_at
+    FROM station_status_log l
+    JOIN snapshots USING (system_id, fetched_at)
+    WHERE l.fetched_at >= %(start)s AND l.fetched_at < %(end)s
+    GROUP BY l.system_id, l.fetched_at
+    ON CONFLICT (system_id, fetched_at) DO {on_conflict};
+"""
+
+MISSING_ONLY = """
+        EXCEPT
+        SELECT system_id, fetched_at FROM system_aggregate_log
+        WHERE fetched_at >= %(start)s AND fetched_at < %(end)s
+"""
+
+RECOMPUTE = "UPDATE SET " + ", ".join(f"{m} = EXCLUDED.{m}" for m in METRICS)
+
+
+def _rollup_refresh():
+    # rebuild every hour / day bucket of the Montreal days the range touches
+    columns = ", ".join(f"{m}_min, {m}_max, {m}_sum" for m in METRICS)
+    selects = ", ".join(f"MIN(a.{m}), MAX(a.{m}), SUM(a.{m})" for m in METRICS)
+    updates = ", ".join(f"{m}_{s} = EXCLUDED.{m}_{s}" for m in METRICS for s in ("min", "max", "sum"))
+    return f"""
+        INSERT INTO system_aggregate_rollup (system_id, resolution, bucket, samples, {columns})
+        SELECT a.system_id,
+               r.resolution,
+               date_trunc(r.resolution, a.fetched_at AT TIME ZONE '{TIMEZONE}') AT TIME ZONE '{TIMEZONE}' AS bucket,
+               COUNT(*), {selects}
+        FROM system_aggregate_log a
+        CROSS JOIN (VALUES ('hour'), ('day')) AS r (resolution)
+        WHERE a.fetched_at >= date_trunc('day', %(start)s::timestamptz AT TIME ZONE '{TIMEZONE}') AT TIME ZONE '{TIMEZONE}'
+          AND a.fetched_at < (date_trunc('day', %(end)s::timestamptz AT TIME ZONE '{TIMEZONE}') + INTERVAL '1 day') AT TIME ZONE '{TIMEZONE}'
+        GROUP BY a.system_id, r.resolution, bucket
+        ON CONFLICT (system_id, resolution, bucket) DO UPDATE SET samples = EXCLUDED.samples, {updates};
+    """
+
+
+ROLLUP_REFRESH = _rollup_refresh()
+
+
+def backfill(conn, start, end, recompute=False, threshold=3, chunk=dt.timedelta(hours=24)):
+    command = BACKFILL.format(
+        missing_only="" if recompute else MISSING_ONLY,
+        on_conflict=RECOMPUTE if recompute else "NOTHING",
+    )
+    total = 0
+    chunk_start = start
+    while chunk_start < end:
+        chunk_end = min(chunk_start + chunk, end)
+        params = {"start": chunk_start, "end": chunk_end, "threshold": threshold}
+        with conn:
+            with conn.cursor() as curs:
+                with instrument.stage("backfill"):
+                    curs.execute(command, params)
+                written = curs.rowcount
+                if written:
+                    with instrument.stage("rollups"):
+                        curs.execute(ROLLUP_REFRESH, params)
+        print(f"{chunk_start} -> {chunk_end}: {written} aggregate rows written.")
+        instrument.count("chunks", 1)
+        instrument.count("aggregate_rows", written)
+        total += written
+        chunk_start = chunk_end
+    return total
+
+
+def parse_time(value):
+    ts = dt.datetime.fromisoformat(value)
+    return ts if ts.tzinfo else ts.replace(tzinfo=dt.timezone.utc)
+
+
 def main():
+    # only the cli needs the credentials, bench/ imports this module for its sql
+    from env_var import ENDPOINT, PW, USERNAME, NAME, PORT
+
+    parser = argparse.ArgumentParser(description="Backfill / recompute system_aggregate_log.")
+    parser.add_argument("--since", type=parse_time, help="start of the range (default: one day ago)")
+    parser.add_argument("--until", type=parse_time, help="end of the range (default: now)")
+    parser.add_argument("--recompute", action="store_true", help="overwrite existing rows instead of only filling gaps")
+    parser.add_argument("--threshold", type=int, default=3, help="stations under this many bikes / docks count as empty / full")
+    parser.add_argument("--chunk-hours", type=float, default=24, help="size of each transaction's time range")
+    args = parser.parse_args()
+
+    now = dt.datetime.now(dt.timezone.utc)
+    start = args.since or now - dt.timedelta(days=1)
+    # a bit past now so a snapshot written while this runs isn't cut off
+    end = args.until or now + dt.timedelta(minutes=1)
+
+    instrument.start("aggregate", since=start.isoformat(), until=end.isoformat(), recompute=args.recompute)
     conn = None
     try:
-        conn = psycopg2.connect(dbname=NAME, user=USERNAME, password=PW, host=ENDPOINT)
+        with instrument.stage("connect"):
+            conn = psycopg2.connect(dbname=NAME, user=USERNAME, password=PW, host=ENDPOINT)
     except (Exception, psycopg2.Error) as error:
         print(f"Error connecting to database: {error}")
-        return 
-        
-    if conn:
-        try:
-            with conn:
-                with conn.cursor() as curs:
-                    
-                    curs.execute("SELECT MAX(fetched_at) FROM station_status_log;")
-                    row = curs.fetchone()
-                
-                    if not (row and row[0]):
-                        print("No data found in station_status_log.")
-                        return 
-                        
-                    most_recent = row[0]
-                    print(f"Processing data for timestamp: {most_recent}")
-
-                    aggregate_command = """
-                        SELECT
-                            SUM(bikes_av),
-                            SUM(docks_av),
-                            COUNT(*) FILTER (WHERE bikes_av < 3),
-                            COUNT(*) FILTER (WHERE docks_av < 3)
-                        FROM station_status_log
-                        WHERE fetched_at = %s;
-                    """
-                    curs.execute(aggregate_command, (most_recent,))
-                    agg_row = curs.fetchone()
-                    
-                    if not agg_row:
-                        print(f"Could not fetch aggregates for {most_recent}.")
-                        raise Exception("Aggregate query returned no rows")
-
-                    insert_command = """
-                        INSERT INTO system_aggregate_log
-                        (total_bikes_av, total_docks_av, empty_stations, full_stations, fetched_at)
-                        VALUES (%s, %s, %s, %s, %s)
-                    """
-                    vals = agg_row + (most_recent,)
-                    
-                    curs.execute(insert_command, vals)
-                    print("Successfully inserted aggregate data.")
-                                
-        except (Exception, psycopg2.DatabaseError) as error:
-            print(f"Database error occurred: {error}. Transaction will be rolled back.")
-        finally:
-            if conn is not None:
-                conn.close()
-                print("Database connection closed.")
+        instrument.fail(error)
+        instrument.finish(False)
+        return
+
+    ok = False
+    try:
+        if flow.stored_as_changes(conn, start, end):
+            print("The range has station_status_change rows (STORAGE_MODE=delta), nothing written: "
+                  "aggregate.py reads station_status_log only.")
+        else:
+            total = backfill(conn, start, end, args.recompute, args.threshold, dt.timedelta(hours=args.chunk_hours))
+            print(f"Done, {total} aggregate rows written.")
+            ok = True
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(f"Database error occurred: {error}. Current chunk rolled back.")
+        instrument.fail(error)
+    finally:
+        instrument.finish(ok, conn)
+        conn.close()
+        print("Database connection closed.")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,159 @@
+# compare ways of turning a gbfs payload into the polars frame the ingest uses
+#   python bench/bench_decode.py [--stations 1000 10000 100000] [--repeats 5]
+#   dicts    response.json() + pl.DataFrame(list of dicts) + select, what the ingest used to do
+#   orjson   same, with orjson.loads (only if orjson is installed)
+#   schema   gbfs_decode.decode: json.loads dropping the unused fields while parsing, typed columns
+#   read_json  pl.read_json with an explicit schema: the fastest, but the highest peak memory
+# the payloads come from bench_pipeline's generators (realistic bixi fields, including ones the
+# ingest never reads). time is the median of --repeats; peak memory is measured in a fresh
+# subprocess per method / size that only reads the payload files: the high-water mark is reset
+# (instrument.reset_peak_rss, linux) after the read, peak +MB is how far decoding pushes it up.
+# ru_maxrss wouldn't do, a child inherits the parent's, which has held every payload
+import io
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import subprocess
+
+import numpy as np
+import polars as pl
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+import gbfs_decode
+import instrument
+from bench_pipeline import station_information, station_status
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def payloads(n):
+    rng = random.Random(n)
+    return {
+        "station_information": (json.dumps(station_information(n, rng)).encode(), gbfs_decode.INFO_SCHEMA),
+        "station_status": (json.dumps(station_status(n, rng, int(time.time()))).encode(), gbfs_decode.STATUS_SCHEMA),
+    }
+
+
+def decode_dicts(content, schema, loads=json.loads):
+    payload = loads(content)
+    return payload["last_updated"], pl.DataFrame(payload["data"]["stations"]).select(list(schema))
+
+
+def decode_schema(content, schema):
+    last_updated, _, frame = gbfs_decode.decode(content, schema)
+    return last_updated, frame
+
+
+def decode_read_json(content, schema):
+    dtypes = {str: pl.String, float: pl.Float64, int: pl.Int64}
+    stations = pl.Struct({name: dtypes[kind] for name, kind in schema.items()})
+    payload = pl.read_json(io.BytesIO(content), schema={
+        "last_updated": pl.String, "ttl": pl.Int64, "data": pl.Struct({"stations": pl.List(stations)})})
+    frame = payload.select(pl.col("data").struct.field("stations")).explode("stations").unnest("stations")
+    return payload.get_column("last_updated")[0], frame.drop_nulls("station_id")
+
+
+METHODS = {
+    "dicts": decode_dicts,
+    "schema": decode_schema,
+    "read_json": decode_read_json,
+}
+if orjson is not None:
+    METHODS["orjson"] = lambda content, schema: decode_dicts(content, schema, orjson.loads)
+
+
+# gbfs 3.0 station_information: localized names, rfc 3339 last_updated. checked before timing
+GBFS3_INFO = {
+    "last_updated": "2026-10-18T10:00:00Z",
+    "ttl": 60,
+    "version": "3.0",
+    "data": {"stations": [
+        {"station_id": "1", "name": [{"text": "Métro Mont-Royal", "language": "fr"},
+                                     {"text": "Mont-Royal metro", "language": "en"}],
+         "lat": 45.52, "lon": -73.58, "capacity": 31,
+         "rental_uris": {"android": "https://example.com/1"}},
+        {"station_id": "2", "name": [{"text": "Parc Jarry", "language": "fr"}],
+         "lat": 45, "lon": -73.62, "capacity": 19},
+    ]},
+}
+
+
+def check_gbfs3():
+    last_updated, ttl, frame = gbfs_decode.decode(json.dumps(GBFS3_INFO).encode(), gbfs_decode.INFO_SCHEMA)
+    expected = pl.DataFrame({"station_id": ["1", "2"], "name": ["Mont-Royal metro", "Parc Jarry"],
+                             "lat": [45.52, 45.0], "lon": [-73.58, -73.62], "capacity": [31, 19]})
+    # the second name has no "en" entry and falls back to the first one
+    assert frame.equals(expected), frame
+    assert (last_updated, ttl) == (1792317600, 60), (last_updated, ttl)
+
+
+def peak_growth(method, directory):
+    # run in a child so every measurement starts from the same heap, generating the payloads
+    # would already push the peak past what decoding needs
+    out = subprocess.run([sys.executable, __file__, "--child", method, directory],
+                         capture_output=True, text=True, check=True).stdout
+    return float(out.strip().splitlines()[-1])
+
+
+def child(method, directory):
+    feeds = {}
+    for feed, schema in (("station_information", gbfs_decode.INFO_SCHEMA), ("station_status", gbfs_decode.STATUS_SCHEMA)):
+        with open(os.path.join(directory, f"{feed}.json"), "rb") as f:
+            feeds[feed] = (f.read(), schema)
+    if not instrument.reset_peak_rss():
+        print("nan")
+        return
+    before = instrument.peak_rss_since_reset_mb()
+    for content, schema in feeds.values():
+        METHODS[method](content, schema)
+    print(round(instrument.peak_rss_since_reset_mb() - before, 1))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="GBFS payload decoding benchmark.")
+    parser.add_argument("--stations", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--child", nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(*args.child)
+        return
+
+    check_gbfs3()
+    print(f"{'stations':>9} {'feed':<20} {'method':<9} {'MB':>7} {'p50 (ms)':>10} {'peak +MB':>9}")
+    for n in args.stations:
+        feeds = payloads(n)
+        with tempfile.TemporaryDirectory(prefix="bench-decode-") as directory:
+            for feed, (content, _) in feeds.items():
+                with open(os.path.join(directory, f"{feed}.json"), "wb") as f:
+                    f.write(content)
+            growth = {method: peak_growth(method, directory) for method in METHODS}
+        for feed, (content, schema) in feeds.items():
+            reference = None
+            for method, decode in METHODS.items():
+                samples = []
+                for _ in range(args.repeats):
+                    start = time.perf_counter()
+                    last_updated, frame = decode(content, schema)
+                    samples.append(time.perf_counter() - start)
+                # every method has to produce the same rows
+                values = frame.select(list(schema)).cast(schema)
+                if reference is None:
+                    reference = values
+                elif not values.equals(reference):
+                    raise AssertionError(f"{method} decoded {feed} differently")
+                print(f"{n:>9} {feed:<20} {method:<9} {len(content) / 1e6:>7.2f} "
+                      f"{np.median(samples) * 1000:>10.2f} {growth[method]:>9.1f}")
+    print("peak +MB is for decoding both feeds")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+# station flow inference (flow.py) on synthetic history, no database needed
+#   python bench/bench_flow.py [--stations 1000 2000 5000] [--days 7] [--minutes 1]
+# per station count:
+#   - builds --days of snapshots every --minutes for every station, in snapshot order like
+#     station_status_log / the archive: riders move a bike now and then (random walk clipped to
+#     the station's capacity) and a few trucks per station and day move 10-15 bikes at once,
+#     taking from stations over half full and filling the others
+#   - times flow.station_flows over the whole history (eager and lazy), reports rows/s and the
+#     peak rss, and how many planted truck visits came out flagged as rebalancing
+#   - times the ingest path: one new snapshot against the previous one, like write_flows does
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+import polars as pl
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import flow
+import instrument
+
+RIDES_PER_MINUTE = 0.04 # chance a bike leaves / arrives at a station in a given minute
+TRUCKS_PER_DAY = 2
+
+
+def synthetic_history(stations, days, minutes, seed=0):
+    # returns (snapshots, planted) with planted = (station_id, fetched_at) of every truck visit
+    rng = np.random.default_rng(seed)
+    steps = int(days * 24 * 60 / minutes)
+    capacity = 15 + np.arange(stations) % 25
+    # rides in one interval: arrivals minus departures
+    rides = rng.poisson(RIDES_PER_MINUTE * minutes, (steps, stations)) - rng.poisson(RIDES_PER_MINUTE * minutes, (steps, stations))
+    trucks = rng.random((steps, stations)) < TRUCKS_PER_DAY * minutes / (24 * 60)
+    moved = np.where(trucks, rng.integers(10, 16, (steps, stations)), 0)
+    # cumulative sum clipped at every step, so an empty station stays empty instead of going negative
+    bikes = np.empty((steps, stations), dtype=np.int32)
+    level = capacity // 2
+    for i in range(steps):
+        truck = np.where(level > capacity // 2, -moved[i], moved[i])
+        level = np.clip(level + rides[i] + truck, 0, capacity)
+        bikes[i] = level
+    times = (np.datetime64("2025-11-03T00:00", "us") + np.arange(steps) * np.timedelta64(minutes, "m")).astype("datetime64[us]")
+
+    snapshots = pl.DataFrame({
+        "station_id": pl.Series(np.tile(np.arange(stations), steps)).cast(pl.String),
+        "bikes_av": bikes.ravel(),
+        "docks_av": (capacity[None, :] - bikes).ravel().astype(np.int32),
+        "fetched_at": np.repeat(times, stations),
+    }).with_columns(pl.col("fetched_at").dt.replace_time_zone("UTC"))
+    step, station = np.nonzero(trucks)
+    planted = pl.DataFrame({
+        "station_id": pl.Series(station).cast(pl.String),
+        "fetched_at": times[step],
+    }).with_columns(pl.col("fetched_at").dt.replace_time_zone("UTC"))
+    return snapshots, planted
+
+
+def timed(fn, repeats):
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn()
+        samples.append(time.perf_counter() - start)
+    return result, float(np.median(samples))
+
+
+def run_size(n, args):
+    start = time.perf_counter()
+    snapshots, planted = synthetic_history(n, args.days, args.minutes)
+    print(f"\n### {n:,} stations, {snapshots.height:,} snapshot rows "
+          f"({snapshots.estimated_size() / 1e6:.0f} MB), generated in {time.perf_counter() - start:.1f}s")
+
+    rss_before = instrument.process_peak_rss_mb()
+    flows, eager_s = timed(lambda: flow.station_flows(snapshots), args.repeats)
+    _, lazy_s = timed(lambda: flow.station_flows(snapshots.lazy()).collect(), args.repeats)
+    rss_growth = instrument.process_peak_rss_mb() - rss_before
+
+    flagged = flows.filter(pl.col("rebalancing"))
+    # a truck that arrives at a full / leaves an empty station can get clipped below the threshold
+    found = planted.join(flagged, on=["station_id", "fetched_at"], how="semi").height
+    organic = flagged.join(planted, on=["station_id", "fetched_at"], how="anti").height
+
+    # ingest: one new snapshot against the previous values of every station
+    steps = snapshots.height // n
+    previous = snapshots.slice((steps - 2) * n, n)
+    latest = snapshots.slice((steps - 1) * n, n)
+    _, incremental_s = timed(lambda: flow.station_flows(pl.concat([previous, latest])), args.repeats)
+
+    print(f"station_flows eager {eager_s:.2f}s ({snapshots.height / eager_s / 1e6:.1f} M rows/s), "
+          f"lazy {lazy_s:.2f}s, peak rss +{rss_growth:.0f} MB")
+    print(f"{flows.height:,} flow rows, {flagged.height:,} flagged as rebalancing: "
+          f"{found:,} of {planted.height:,} planted truck visits, {organic:,} from riders")
+    print(f"one snapshot (ingest): {incremental_s * 1000:.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Station flow inference benchmark.")
+    parser.add_argument("--stations", type=int, nargs="+", default=[1000, 2000, 5000])
+    parser.add_argument("--days", type=float, default=7)
+    parser.add_argument("--minutes", type=int, default=1, help="time between snapshots")
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+    for n in args.stations:
+        run_size(n, args)
+
+
+if __name__ == "__main__":
+    main()
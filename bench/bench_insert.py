@@ -0,0 +1,81 @@
+# compare the COPY path against execute_batch for station_status_log inserts
+# needs a local postgres, e.g.
+#   docker run --rm -e POSTGRES_PASSWORD=bench -p 5432:5432 postgres:16
+#   BENCH_DSN="dbname=postgres user=postgres password=bench host=localhost" python bench/bench_insert.py
+import os
+import sys
+import time
+import importlib
+import datetime as dt
+
+import polars as pl
+import psycopg2
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "serverless"))
+ingest = importlib.import_module("lambda")  # lambda is a keyword, can't `import lambda`
+
+DSN = os.environ.get("BENCH_DSN", "dbname=postgres user=postgres host=localhost")
+SIZES = [1_000, 10_000, 100_000]
+REPEATS = 3
+
+DDL = """
+    DROP SCHEMA IF EXISTS bench CASCADE;
+    CREATE SCHEMA bench;
+    CREATE TABLE bench.station_status_log (
+        station_id TEXT,
+        bikes_av INTEGER,
+        docks_av INTEGER,
+        is_functional BOOLEAN,
+        fetched_at TIMESTAMPTZ,
+        system_id TEXT
+    );
+"""
+
+
+def synthetic_snapshot(n):
+    return pl.DataFrame({
+        "station_id": [str(i) for i in range(n)],
+        "bikes_av": [i % 23 for i in range(n)],
+        "docks_av": [(i * 7) % 19 for i in range(n)],
+        "is_functional": [i % 50 != 0 for i in range(n)],
+    })
+
+
+def time_insert(conn, df, mode):
+    best = float("inf")
+    for _ in range(REPEATS):
+        ts = dt.datetime.now(dt.timezone.utc)
+        start = time.perf_counter()
+        with conn:
+            with conn.cursor() as curs:
+                curs.execute("SET search_path TO bench;")
+                ingest.insert_snapshot(curs, df, ts, mode=mode)
+        best = min(best, time.perf_counter() - start)
+        with conn:
+            with conn.cursor() as curs:
+                curs.execute("TRUNCATE bench.station_status_log;")
+    return best
+
+
+def main():
+    conn = psycopg2.connect(DSN)
+    with conn:
+        with conn.cursor() as curs:
+            curs.execute(DDL)
+
+    print(f"{'rows':>8} {'batch (s)':>10} {'copy (s)':>10} {'speedup':>8}")
+    try:
+        for n in SIZES:
+            df = synthetic_snapshot(n)
+            t_batch = time_insert(conn, df, "batch")
+            t_copy = time_insert(conn, df, "copy")
+            print(f"{n:>8} {t_batch:>10.3f} {t_copy:>10.3f} {t_batch / t_copy:>7.1f}x")
+    finally:
+        with conn:
+            with conn.cursor() as curs:
+                curs.execute("DROP SCHEMA IF EXISTS bench CASCADE;")
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
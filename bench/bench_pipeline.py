@@ -0,0 +1,339 @@
+# end-to-end benchmark: synthetic GBFS feeds -> ingest main() -> local postgres -> dashboard queries
+#   BENCH_DSN="dbname=postgres user=postgres password=bench host=localhost" \
+#       python bench/bench_pipeline.py --stations 1000 10000 50000 --days 1 --runs 20
+#   python bench/bench_pipeline.py ... --compare bench/results/20251103T120000Z.json
+#
+# for every station count:
+#   1. seed a throwaway `bench` schema with --days of history (explain_dashboard.seed)
+#   2. serve generated station_information / station_status from a local http server; each
+#      request for station_status gets a new last_updated, station_information never changes
+#   3. run the ingest main() --runs times against the bench schema, stage timings come from
+#      the instrument.py record of each run (the first --warmup runs are left out)
+#   4. run every dashboard query (explain_dashboard.loaders) --runs times
+# reports p50 / p95 / max per stage, ingest throughput and memory: the rss high-water mark is
+# reset (instrument.reset_peak_rss, linux) before each phase, ingest run and dashboard loader,
+# peak +MB is how far it went up from there. writes
+# everything to bench/results/<utc time>.json; --compare prints the p50 change against an older file
+import io
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+import importlib
+import subprocess
+import contextlib
+import datetime as dt
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+import polars as pl
+import psycopg2
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(BENCH_DIR, "..")
+sys.path.insert(0, ROOT)
+import instrument
+import explain_dashboard
+# after explain_dashboard, which puts cleaner/ (with its own lambda.py) on the path
+sys.path.insert(0, os.path.join(ROOT, "serverless"))
+import gbfs
+import resources
+ingest = importlib.import_module("lambda")  # lambda is a keyword, can't `import lambda`
+
+DSN = os.environ.get("BENCH_DSN", "dbname=postgres user=postgres host=localhost")
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+
+
+def station_information(n, rng):
+    return {
+        "last_updated": int(time.time()) - 3600,
+        "ttl": 0,
+        "data": {"stations": [
+            {
+                "station_id": str(i),
+                "external_id": f"ext-{i}",
+                "name": f"Station {i}",
+                "short_name": str(10000 + i),
+                "lat": 45.40 + rng.random() * 0.15,
+                "lon": -73.70 + rng.random() * 0.25,
+                "capacity": 15 + (i % 25),
+                "rental_methods": ["KEY", "CREDITCARD"],
+                "electric_bike_surcharge_waiver": False,
+                "is_charging": False,
+                "eightd_has_key_dispenser": False,
+                "has_kiosk": True,
+            }
+            for i in range(1, n + 1)
+        ]},
+    }
+
+
+def station_status(n, rng, last_updated):
+    stations = []
+    for i in range(1, n + 1):
+        capacity = 15 + (i % 25)
+        bikes = rng.randint(0, capacity)
+        stations.append({
+            "station_id": str(i),
+            "num_bikes_available": bikes,
+            "num_ebikes_available": rng.randint(0, bikes),
+            "num_bikes_disabled": 0,
+            "num_docks_available": capacity - bikes,
+            "num_docks_disabled": 0,
+            "is_installed": 1,
+            "is_renting": int(rng.random() > 0.02),
+            "is_returning": 1,
+            "last_reported": last_updated - rng.randint(0, 300),
+            "eightd_has_available_keys": False,
+        })
+    return {"last_updated": last_updated, "ttl": 0, "data": {"stations": stations}}
+
+
+class FeedServer:
+    # station_status payloads are generated up front so the server doesn't add json.dumps time
+    # to the ingest's http stage; each request hands out the next one
+    def __init__(self, n, runs, start_time, snapshot_minutes):
+        rng = random.Random(n)
+        self.info = json.dumps(station_information(n, rng)).encode()
+        self.statuses = [
+            json.dumps(station_status(n, rng, start_time + i * snapshot_minutes * 60)).encode()
+            for i in range(runs)
+        ]
+        self._next = 0
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.endswith("/station_information.json"):
+                    body = server.info
+                elif self.path.endswith("/station_status.json"):
+                    with server._lock:
+                        body = server.statuses[min(server._next, len(server.statuses) - 1)]
+                        server._next += 1
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def reset_peak():
+    # -> the rss to measure growth from, None where the high-water mark can't be reset
+    return instrument.peak_rss_since_reset_mb() if instrument.reset_peak_rss() else None
+
+
+def peak_since(base):
+    # MB the high-water mark rose since reset_peak()
+    return None if base is None else round(instrument.peak_rss_since_reset_mb() - base, 1)
+
+
+def summarize(samples):
+    values = np.asarray(samples, dtype=float)
+    return {
+        "n": int(values.size),
+        "p50": round(float(np.percentile(values, 50)), 5),
+        "p95": round(float(np.percentile(values, 95)), 5),
+        "max": round(float(values.max()), 5),
+    }
+
+
+def bench_ingest(server, runs, warmup):
+    # the ingest modules read their settings at import; point them at the stand-ins
+    gbfs.GBFS_BASE_URL = server.url
+    gbfs.CACHE_DIR = tempfile.mkdtemp(prefix="bench-gbfs-")
+    gbfs._feeds.clear()
+    gbfs._discovery.clear()
+
+    records = []
+    peaks = []
+    for i in range(runs):
+        base = reset_peak()
+        instrument.start("ingest")
+        with contextlib.redirect_stdout(io.StringIO()):
+            ok = ingest.main()
+            record = instrument.finish(ok)
+        if not ok:
+            raise RuntimeError(f"ingest run {i} failed")
+        if i >= warmup:
+            records.append(record)
+            peaks.append(peak_since(base))
+
+    stages = {}
+    for record in records:
+        stages.setdefault("total", []).append(record["duration_s"])
+        for name, seconds in record["stages"].items():
+            stages.setdefault(name, []).append(seconds)
+    total = sum(r["duration_s"] for r in records)
+    rows = sum(r["counts"].get("rows_written", 0) for r in records)
+    write = sum(r["stages"].get("write", 0.0) for r in records)
+    return {
+        "stages": {name: summarize(values) for name, values in stages.items()},
+        "peak_mb_per_run": summarize(peaks) if peaks and None not in peaks else None,
+        "throughput": {
+            "runs_per_s": round(len(records) / total, 3) if total else None,
+            "rows_per_s_write": round(rows / write) if write else None,
+            "payload_bytes": records[-1]["counts"].get("station_status.bytes") if records else None,
+        },
+    }
+
+
+def bench_queries(conn, now, runs, warmup):
+    results = {}
+    for name, (query, params) in explain_dashboard.loaders(now).items():
+        samples = []
+        base = reset_peak()
+        for i in range(runs):
+            start = time.perf_counter()
+            if params is None:
+                pl.read_database(query, conn)
+            else:
+                pl.read_database(query, conn, execute_options={"vars": params})
+            conn.rollback()
+            if i >= warmup:
+                samples.append(time.perf_counter() - start)
+        results[name] = {**summarize(samples), "peak_mb": peak_since(base)}
+    return results
+
+
+def run_size(n, args):
+    print(f"\n### {n:,} stations")
+    conn = psycopg2.connect(DSN)
+    peaks = {}
+    try:
+        base = reset_peak()
+        seed_start = time.perf_counter()
+        # history stops --runs snapshots ago, the served feeds fill the gap up to now (a
+        # last_updated in the future would look like it's still within the feed's ttl)
+        interval = dt.timedelta(minutes=args.snapshot_minutes)
+        now = dt.datetime.now(dt.timezone.utc).replace(second=0, microsecond=0) - args.runs * interval
+        with contextlib.redirect_stdout(io.StringIO()):
+            explain_dashboard.seed(conn, days=args.days, stations=n, snapshot_minutes=args.snapshot_minutes, now=now)
+        seed_s = time.perf_counter() - seed_start
+        peaks["seed"] = peak_since(base)
+        print(f"seeded {args.days:g} days in {seed_s:.1f}s, peak +{peaks['seed']} MB")
+
+        server = FeedServer(n, args.runs, int((now + interval).timestamp()), args.snapshot_minutes)
+        # the ingest's own connection, kept by resources like in a warm container
+        resources._conn = psycopg2.connect(DSN, options="-c search_path=bench")
+        base = reset_peak()
+        try:
+            ingest_result = bench_ingest(server, args.runs, args.warmup)
+        finally:
+            server.close()
+            resources.discard_connection()
+        peaks["ingest"] = peak_since(base)
+        print(f"ingest: {ingest_result['throughput']}, peak +{peaks['ingest']} MB")
+
+        with conn:
+            with conn.cursor() as curs:
+                curs.execute("SET search_path TO bench; ANALYZE;")
+        base = reset_peak()
+        query_result = bench_queries(conn, now, args.runs, args.warmup)
+        peaks["queries"] = peak_since(base)
+        print(f"dashboard queries: peak +{peaks['queries']} MB")
+    finally:
+        with conn:
+            with conn.cursor() as curs:
+                curs.execute("DROP SCHEMA IF EXISTS bench CASCADE;")
+        conn.close()
+
+    return {
+        "seed_s": round(seed_s, 3),
+        "ingest": ingest_result,
+        "queries": query_result,
+        "peak_mb": peaks,
+    }
+
+
+def print_table(results):
+    for n, result in results.items():
+        print(f"\n{'stations: ' + n:<36} {'p50 (ms)':>10} {'p95 (ms)':>10} {'max (ms)':>10} {'peak +MB':>10}")
+        sections = [("ingest." + k, v) for k, v in result["ingest"]["stages"].items()]
+        sections += [("query." + k, v) for k, v in result["queries"].items()]
+        for name, s in sections:
+            peak = s.get("peak_mb")
+            print(f"{name:<36} {s['p50'] * 1000:>10.2f} {s['p95'] * 1000:>10.2f} {s['max'] * 1000:>10.2f} "
+                  f"{'' if peak is None else peak:>10}")
+        per_run = result["ingest"]["peak_mb_per_run"]
+        if per_run:
+            print(f"ingest run peak +MB: p50 {per_run['p50']}, max {per_run['max']}")
+
+
+def compare(results, path):
+    with open(path) as f:
+        old = json.load(f)["sizes"]
+    print(f"\ncompared to {path} (p50, negative = faster)")
+    for n, result in results.items():
+        if n not in old:
+            continue
+        pairs = [(f"ingest.{k}", v, old[n]["ingest"]["stages"].get(k)) for k, v in result["ingest"]["stages"].items()]
+        pairs += [(f"query.{k}", v, old[n]["queries"].get(k)) for k, v in result["queries"].items()]
+        for name, new, before in pairs:
+            if before is None or not before["p50"]:
+                continue
+            change = (new["p50"] - before["p50"]) / before["p50"] * 100
+            print(f"{n:>7} {name:<36} {before['p50'] * 1000:>10.2f} -> {new['p50'] * 1000:>10.2f} ms {change:>+7.1f} %")
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end ingest + dashboard benchmark.")
+    parser.add_argument("--stations", type=int, nargs="+", default=[1000, 10000], help="station counts to run")
+    parser.add_argument("--days", type=float, default=1, help="days of history seeded before the runs")
+    parser.add_argument("--snapshot-minutes", type=int, default=5, help="time between seeded / served snapshots")
+    parser.add_argument("--runs", type=int, default=20, help="ingest runs and query repetitions per size")
+    parser.add_argument("--warmup", type=int, default=2, help="leading runs left out of the stats")
+    parser.add_argument("--out", help="results file (default bench/results/<utc time>.json)")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    args = parser.parse_args()
+    if args.warmup >= args.runs:
+        parser.error("--warmup has to be smaller than --runs")
+
+    results = {str(n): run_size(n, args) for n in args.stations}
+    print_table(results)
+
+    created = dt.datetime.now(dt.timezone.utc)
+    out = args.out or os.path.join(RESULTS_DIR, created.strftime("%Y%m%dT%H%M%SZ") + ".json")
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out, "w") as f:
+        json.dump({
+            "created_at": created.isoformat(),
+            "git": git_revision(),
+            "config": {k: v for k, v in vars(args).items() if k not in ("out", "compare")},
+            "env": {k: os.environ.get(k) for k in ("INSERT_MODE", "STORAGE_MODE")},
+            "sizes": results,
+        }, f, indent=2)
+    print(f"\nWrote {out}.")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+# EXPLAIN ANALYZE each dashboard loader against weeks of synthetic history
+# seeds a throwaway `bench` schema with sql/schema.sql + daily partitions, then reports
+# planning / execution time and the plan of every dashboard query in queries.py
+#   BENCH_DSN="dbname=postgres user=postgres password=bench host=localhost" python bench/explain_dashboard.py
+# WEEKS / STATIONS / SNAPSHOT_MINUTES env vars size the history
+import os
+import sys
+import json
+import datetime as dt
+
+import polars as pl
+import psycopg2
+import psycopg2.extras
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "cleaner"))
+import grid
+import queries
+import aggregate
+import partitions
+
+DSN = os.environ.get("BENCH_DSN", "dbname=postgres user=postgres host=localhost")
+WEEKS = int(os.environ.get("WEEKS", "3"))
+STATIONS = int(os.environ.get("STATIONS", "1000"))
+SNAPSHOT_MINUTES = int(os.environ.get("SNAPSHOT_MINUTES", "5"))
+KEEP = os.environ.get("KEEP_SCHEMA") == "1"
+
+
+def loaders(now):
+    # loader name -> (query, params), params mirror what the dashboard passes
+    system = {"system_id": "bixi"}
+    return {
+        "load_latest_snapshot": (queries.LATEST_SNAPSHOT, system),
+        "load_aggregate_history": (queries.AGGREGATE_HISTORY, {**system, "max_rows": 200_000}),
+        "load_aggregate_history (since)": (queries.AGGREGATE_HISTORY_SINCE, {**system, "since": now - dt.timedelta(minutes=10)}),
+        "load_rollup_history (hour)": (queries.ROLLUP_HISTORY, {**system, "resolution": "hour", "start": now - dt.timedelta(days=30)}),
+        "load_station_series (day)": (queries.STATION_SERIES, {"station_id": "1", "start": now - dt.timedelta(days=1)}),
+        "load_station_series (week)": (queries.STATION_SERIES, {"station_id": "1", "start": now - dt.timedelta(days=7)}),
+        "load_station_series (week, change log)": (queries.STATION_SERIES_WITH_CHANGES, {"station_id": "1", "start": now - dt.timedelta(days=7)}),
+        "load_cells (6)": (queries.CELL_SNAPSHOT, {**system, "precision": 6}),
+        "load_cells (5)": (queries.CELL_SNAPSHOT, {**system, "precision": 5}),
+        "load_nearby_stations": (queries.NEARBY_STATIONS, {
+            **system, "cells": grid.nearby_cells(45.5, -73.57), "lat": 45.5, "lon": -73.57,
+            "lon_scale": grid.lon_scale(45.5), "min_bikes": 3, "limit": 10}),
+    }
+
+
+def seed_grid(curs):
+    # station.geohash and cell_current, computed by grid.py like the ingest does (no geohash in sql)
+    curs.execute("SELECT station_id, lat, lon FROM station;")
+    stations = grid.with_geohash(pl.DataFrame(curs.fetchall(), schema=["station_id", "lat", "lon"], orient="row"))
+    psycopg2.extras.execute_values(curs, """
+        UPDATE station SET geohash = v.geohash
+        FROM (VALUES %s) AS v (station_id, geohash)
+        WHERE station.station_id = v.station_id;
+    """, stations.select("station_id", "geohash").rows(), page_size=1000)
+    curs.execute("""
+        SELECT c.system_id, s.lat, s.lon, c.bikes_av, c.docks_av, c.is_functional, c.fetched_at
+        FROM station_current c JOIN station s USING (station_id);
+    """)
+    latest = pl.DataFrame(curs.fetchall(), orient="row", schema=[
+        "system_id", "lat", "lon", "bikes_av", "docks_av", "is_functional", "fetched_at"])
+    grid.upsert_cells(curs, grid.cell_aggregates(latest))
+
+
+def seed(conn, days=WEEKS * 7, stations=STATIONS, snapshot_minutes=SNAPSHOT_MINUTES, now=None):
+    # also used by bench_pipeline.py; history ends at `now`, which is returned
+    now = now or dt.datetime.now(dt.timezone.utc).replace(second=0, microsecond=0)
+    start = now - dt.timedelta(days=days)
+    with conn:
+        with conn.cursor() as curs:
+            curs.execute("DROP SCHEMA IF EXISTS bench CASCADE; CREATE SCHEMA bench; SET search_path TO bench;")
+            with open(os.path.join(ROOT, "sql", "schema.sql")) as f:
+                curs.execute(f.read())
+
+            day = partitions.partition_start(start)
+            while day <= now:
+                partitions.create_partition(curs, day)
+                day += dt.timedelta(days=1)
+            # and the ones upcoming snapshots will land in
+            partitions.ensure_partitions(curs, now)
+
+            curs.execute("""
+                INSERT INTO station (station_id, name, lat, lon, capacity)
+                SELECT i::text, 'Station ' || i, 45.40 + random() * 0.15, -73.70 + random() * 0.25, 15 + (i % 25)
+                FROM generate_series(1, %s) AS i;
+            """, (stations,))
+            curs.execute("""
+                INSERT INTO station_status_log (station_id, bikes_av, docks_av, is_functional, fetched_at)
+                SELECT s.station_id,
+                       (random() * s.capacity)::int,
+                       (random() * s.capacity)::int,
+                       random() > 0.02,
+                       t
+                FROM generate_series(%s::timestamptz, %s::timestamptz, make_interval(mins => %s)) AS t
+                CROSS JOIN station s;
+            """, (start, now, snapshot_minutes))
+            print(f"Seeded {curs.rowcount:,} station_status_log rows ({days:g} days x {stations} stations).")
+            curs.execute("""
+                INSERT INTO system_aggregate_log
+                (total_bikes_av, total_docks_av, empty_stations, full_stations, fetched_at)
+                SELECT SUM(bikes_av), SUM(docks_av),
+                       COUNT(*) FILTER (WHERE bikes_av < 3), COUNT(*) FILTER (WHERE docks_av < 3),
+                       fetched_at
+                FROM station_status_log
+                GROUP BY fetched_at;
+            """)
+            # the derived tables, filled the same way a migrated database gets them
+            # (rollups through aggregate.py's refresh, 002 predates per-system buckets)
+            curs.execute(aggregate.ROLLUP_REFRESH, {"start": start, "end": now})
+            for migration in ("003_station_series.sql", "005_station_current.sql"):
+                with open(os.path.join(ROOT, "sql", migration)) as f:
+                    curs.execute(f.read())
+            seed_grid(curs)
+            curs.execute("ANALYZE;")
+    return now
+
+
+def explain(conn, query, params):
+    with conn:
+        with conn.cursor() as curs:
+            curs.execute("SET search_path TO bench;")
+            curs.execute(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {query}", params)
+            plan = curs.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            curs.execute(f"EXPLAIN (ANALYZE, BUFFERS) {query}", params)
+            text = "\n".join(row[0] for row in curs.fetchall())
+    return plan[0], text
+
+
+def main():
+    conn = psycopg2.connect(DSN)
+    try:
+        now = seed(conn)
+        summary = []
+        for name, (query, params) in loaders(now).items():
+            # first run warms the cache, the second one is reported
+            explain(conn, query, params)
+            plan, text = explain(conn, query, params)
+            summary.append((name, plan["Planning Time"], plan["Execution Time"], plan["Plan"].get("Actual Rows")))
+            print(f"\n=== {name} ===\n{text}")
+
+        print(f"\n{'loader':<32} {'plan (ms)':>10} {'exec (ms)':>10} {'rows':>8}")
+        for name, planning, execution, rows in summary:
+            print(f"{name:<32} {planning:>10.2f} {execution:>10.2f} {rows:>8}")
+    finally:
+        if not KEEP:
+            with conn:
+                with conn.cursor() as curs:
+                    curs.execute("DROP SCHEMA IF EXISTS bench CASCADE;")
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,31 +1,107 @@
-# conn to db and delete older entries
-# once a week
+# conn to db and enforce retention on station_status_log, fill the day that just ended into
+# station_series, then enforce retention on the side tables
+# once a day. the partitions go first in their own transaction, each side table after it in
+# its own: a failing (or missing) side table doesn't hold back the snapshot retention
+#   CLEANER_MODE=partitions (default): pre-create upcoming partitions, drop/detach the expired ones
+#   CLEANER_MODE=delete: the old row-by-row DELETE, for a table that isn't partitioned yet
 import os
 import psycopg2
 
+import instrument
+import partitions
+import series
+
+CLEANER_MODE = os.environ.get("CLEANER_MODE", "partitions")
+
+# tables with the same retention as the snapshots: (table, time column, cutoff, %(days)s is
+# RETENTION_DAYS). some only exist with optional migrations (station_status_change: sql/004,
+# delta mode only), a missing one is skipped
+SIDE_TABLES = (
+    # per-station series rows are one per station per day, a plain DELETE is cheap
+    ("station_series", "day", "CURRENT_DATE - %(days)s * INTERVAL '1 day'"),
+    # every Montreal day starts with a keyframe, so cut on a Montreal midnight: a day is either
+    # gone or kept with its keyframe, and the days kept still rebuild
+    ("station_status_change", "changed_at",
+     f"(date_trunc('day', NOW() AT TIME ZONE '{series.TIMEZONE}') - %(days)s * INTERVAL '1 day')"
+     f" AT TIME ZONE '{series.TIMEZONE}'"),
+    ("station_flow_log", "fetched_at", "NOW() - %(days)s * INTERVAL '1 day'"),
+    ("pipeline_run_log", "started_at", "NOW() - %(days)s * INTERVAL '1 day'"),
+)
+
+def delete_expired(conn, table, column, cutoff):
+    # own transaction per table; None if the table doesn't exist
+    with conn:
+        with conn.cursor() as curs:
+            curs.execute("SELECT to_regclass(%s);", (table,))
+            if curs.fetchone()[0] is None:
+                return None
+            curs.execute(f"DELETE FROM {table} WHERE {column} < {cutoff};", {"days": partitions.RETENTION_DAYS})
+            return curs.rowcount
+
 def main():
     conn = None
+    ok = False
+    instrument.start("cleaner", cleaner_mode=CLEANER_MODE)
     try:
-        conn = psycopg2.connect(
+        with instrument.stage("connect"):
+            conn = psycopg2.connect(
                 dbname=os.environ['DBNAME'], 
                 user=os.environ['DBUSERNAME'], 
                 password=os.environ['PW'], 
                 host=os.environ['ENDPOINT']
             )
-        
-        query = """
-        DELETE FROM station_status_log 
-        WHERE fetched_at < NOW() - INTERVAL '1 day';
-        """
-        
-        with conn:
-            with conn.cursor() as curs:
-                curs.execute(query)
-                print("Deleted entries older than 1 day.")
+
+        # first and in its own transaction: the ingest depends on it, the side tables don't
+        if CLEANER_MODE == "partitions":
+            with instrument.stage("partitions"):
+                removed = partitions.maintain(conn)
+            instrument.count("partitions_removed", len(removed))
+        else:
+            query = """
+            DELETE FROM station_status_log 
+            WHERE fetched_at < NOW() - %s * INTERVAL '1 day';
+            """
+
+            with instrument.stage("delete"), conn:
+                with conn.cursor() as curs:
+                    curs.execute(query, (partitions.RETENTION_DAYS,))
+                    instrument.count("station_status_log_deleted", curs.rowcount)
+                    print(f"Deleted entries older than {partitions.RETENTION_DAYS:g} days.")
+
+        ok = True
+        # yesterday's station_series rows, once the day is complete (own transaction too)
+        try:
+            with instrument.stage("series"), conn:
+                with conn.cursor() as curs:
+                    n = series.fill_station_series(curs)
+            instrument.count("station_series_filled", n)
+            print(f"Filled {n} station_series rows.")
+        except Exception as e:
+            print(f"Error filling station_series: {e}")
+            instrument.fail(e)
+            ok = False
+
+        with instrument.stage("side_tables"):
+            for table, column, cutoff in SIDE_TABLES:
+                # one failing table doesn't keep the others from being cleaned
+                try:
+                    n = delete_expired(conn, table, column, cutoff)
+                except Exception as e:
+                    print(f"Error cleaning {table}: {e}")
+                    instrument.fail(e)
+                    ok = False
+                    continue
+                if n is None:
+                    print(f"No {table} table, skipped.")
+                    continue
+                instrument.count(f"{table}_deleted", n)
+                print(f"Deleted {n} {table} rows.")
                 
     except Exception as e:
         print(f"Error: {e}")
+        instrument.fail(e)
     finally:
+        instrument.finish(ok, conn)
         if conn:
             conn.close()
         
@@ -37,4 +113,4 @@ def handler(event, context):
         print(f"Unhandled: {e}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,211 @@
+# range partitioning of station_status_log on fetched_at
+# retention drops whole partitions instead of DELETE-ing rows, so no dead tuples / vacuum churn
+#
+#   python partitions.py migrate    one-off: turn the existing table into a partitioned one
+#   python partitions.py maintain   pre-create upcoming partitions and drop expired ones
+#
+# partitions are named station_status_log_pYYYYMMDD (daily) or station_status_log_pYYYYMMDDHH (hourly),
+# with bounds on utc boundaries. station_status_log_default catches whatever no range partition
+# covers (e.g. the cleaner missed its runs), so the ingest keeps writing; maintain moves those
+# rows into proper partitions
+import os
+import sys
+import datetime as dt
+
+TABLE = "station_status_log"
+DEFAULT_PARTITION = f"{TABLE}_default"
+
+# "day" or "hour"
+PARTITION_INTERVAL = os.environ.get("PARTITION_INTERVAL", "day")
+# keep this many days of station history
+RETENTION_DAYS = float(os.environ.get("RETENTION_DAYS", "30"))
+# how far ahead of now partitions exist, so the ingest never hits a missing one. a duration,
+# whatever PARTITION_INTERVAL is: hourly partitions still get a week of them, not 7 hours
+PRECREATE = dt.timedelta(days=float(os.environ.get("PRECREATE_DAYS", "7")))
+# "drop" or "detach" (detached partitions stay around as plain tables, e.g. for a dump to s3)
+RETENTION_ACTION = os.environ.get("RETENTION_ACTION", "drop")
+
+_STEPS = {"day": dt.timedelta(days=1), "hour": dt.timedelta(hours=1)}
+_NAME_FORMATS = {"day": "%Y%m%d", "hour": "%Y%m%d%H"}
+
+
+def _step():
+    return _STEPS[PARTITION_INTERVAL]
+
+
+def partition_start(ts):
+    # start of the partition that `ts` falls into
+    ts = ts.astimezone(dt.timezone.utc)
+    if PARTITION_INTERVAL == "hour":
+        return ts.replace(minute=0, second=0, microsecond=0)
+    return ts.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def partition_name(start):
+    return f"{TABLE}_p{start.strftime(_NAME_FORMATS[PARTITION_INTERVAL])}"
+
+
+def parse_partition_name(name):
+    # partition start from its name, None for anything not created by this module
+    suffix = name[len(TABLE) + 2:]
+    for fmt in _NAME_FORMATS.values():
+        if len(suffix) == len(dt.datetime(2000, 1, 1).strftime(fmt)):
+            try:
+                return dt.datetime.strptime(suffix, fmt).replace(tzinfo=dt.timezone.utc), fmt
+            except ValueError:
+                return None
+    return None
+
+
+def is_partitioned(curs):
+    curs.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s);", (TABLE,))
+    row = curs.fetchone()
+    return bool(row) and row[0] == "p"
+
+
+def create_partition(curs, start):
+    end = start + _step()
+    curs.execute(f"""
+        CREATE TABLE IF NOT EXISTS {partition_name(start)}
+        PARTITION OF {TABLE}
+        FOR VALUES FROM (%s) TO (%s);
+    """, (start, end))
+
+
+def create_default_partition(curs):
+    curs.execute(f"CREATE TABLE IF NOT EXISTS {DEFAULT_PARTITION} PARTITION OF {TABLE} DEFAULT;")
+
+
+def drain_default(curs):
+    # a range partition can't be created while the default one holds rows in its range: detach
+    # the default, create the partitions its rows belong in, move them and attach it back empty.
+    # returns how many rows moved
+    curs.execute(f"SELECT MIN(fetched_at), MAX(fetched_at) FROM {DEFAULT_PARTITION};")
+    oldest, newest = curs.fetchone()
+    if oldest is None:
+        return 0
+    curs.execute(f"ALTER TABLE {TABLE} DETACH PARTITION {DEFAULT_PARTITION};")
+    start = partition_start(oldest)
+    while start <= newest:
+        create_partition(curs, start)
+        start += _step()
+    curs.execute(f"INSERT INTO {TABLE} SELECT * FROM {DEFAULT_PARTITION};")
+    moved = curs.rowcount
+    curs.execute(f"TRUNCATE {DEFAULT_PARTITION};")
+    curs.execute(f"ALTER TABLE {TABLE} ATTACH PARTITION {DEFAULT_PARTITION} DEFAULT;")
+    return moved
+
+
+def ensure_partitions(curs, now=None, ahead=PRECREATE):
+    # every partition from the current one through now + ahead; returns the rows moved out
+    # of the default partition
+    now = now or dt.datetime.now(dt.timezone.utc)
+    create_default_partition(curs)
+    moved = drain_default(curs)
+    start = partition_start(now)
+    while start <= now + ahead:
+        create_partition(curs, start)
+        start += _step()
+    return moved
+
+
+def list_partitions(curs):
+    curs.execute("""
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass(%s)
+        ORDER BY c.relname;
+    """, (TABLE,))
+    return [row[0] for row in curs.fetchall()]
+
+
+def drop_expired(curs, now=None, retention_days=RETENTION_DAYS, action=RETENTION_ACTION):
+    # a partition goes once its whole range is older than the retention window
+    now = now or dt.datetime.now(dt.timezone.utc)
+    cutoff = now - dt.timedelta(days=retention_days)
+    removed = []
+    for name in list_partitions(curs):
+        parsed = parse_partition_name(name)
+        if parsed is None:
+            continue
+        start, fmt = parsed
+        end = start + (_STEPS["hour"] if fmt == _NAME_FORMATS["hour"] else _STEPS["day"])
+        if end > cutoff:
+            continue
+        curs.execute(f"ALTER TABLE {TABLE} DETACH PARTITION {name};")
+        if action == "drop":
+            curs.execute(f"DROP TABLE {name};")
+        removed.append(name)
+    return removed
+
+
+def migrate(conn):
+    # swap the plain table for a partitioned one with the same columns and copy the rows over
+    # (station_status_log only ever holds about a day of rows when this runs, so the copy is small)
+    with conn:
+        with conn.cursor() as curs:
+            if is_partitioned(curs):
+                print(f"{TABLE} is already partitioned.")
+                return False
+
+            legacy = f"{TABLE}_legacy"
+            curs.execute(f"ALTER TABLE {TABLE} RENAME TO {legacy};")
+            curs.execute(f"""
+                CREATE TABLE {TABLE} (LIKE {legacy} INCLUDING DEFAULTS)
+                PARTITION BY RANGE (fetched_at);
+            """)
+
+            # serial columns: hand the sequence over before the legacy table goes away
+            curs.execute("""
+                SELECT attname, pg_get_serial_sequence(%s, attname)
+                FROM pg_attribute
+                WHERE attrelid = to_regclass(%s) AND attnum > 0 AND NOT attisdropped;
+            """, (legacy, legacy))
+            for column, sequence in curs.fetchall():
+                if sequence:
+                    curs.execute(f"ALTER SEQUENCE {sequence} OWNED BY {TABLE}.{column};")
+
+            curs.execute(f"SELECT MIN(fetched_at) FROM {legacy};")
+            oldest = curs.fetchone()[0]
+            now = dt.datetime.now(dt.timezone.utc)
+            start = partition_start(oldest or now)
+            while start <= partition_start(now):
+                create_partition(curs, start)
+                start += _step()
+            ensure_partitions(curs, now)
+
+            curs.execute(f"INSERT INTO {TABLE} SELECT * FROM {legacy};")
+            print(f"Copied {curs.rowcount} rows into partitioned {TABLE}.")
+            curs.execute(f"DROP TABLE {legacy};")
+            curs.execute(f"CREATE INDEX IF NOT EXISTS {TABLE}_fetched_at_idx ON {TABLE} (fetched_at);")
+    return True
+
+
+def maintain(conn):
+    with conn:
+        with conn.cursor() as curs:
+            moved = ensure_partitions(curs)
+            removed = drop_expired(curs)
+    verb = "Dropped" if RETENTION_ACTION == "drop" else "Detached"
+    if moved:
+        print(f"Moved {moved} rows from {DEFAULT_PARTITION} into range partitions.")
+    print(f"{PARTITION_INTERVAL.capitalize()} partitions ready {PRECREATE} ahead. {verb} {len(removed)} expired: {removed}")
+    return removed
+
+
+if __name__ == "__main__":
+    import psycopg2
+    conn = psycopg2.connect(
+        dbname=os.environ['DBNAME'],
+        user=os.environ['DBUSERNAME'],
+        password=os.environ['PW'],
+        host=os.environ['ENDPOINT']
+    )
+    try:
+        if len(sys.argv) > 1 and sys.argv[1] == "migrate":
+            migrate(conn)
+        else:
+            maintain(conn)
+    finally:
+        conn.close()
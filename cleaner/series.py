@@ -0,0 +1,45 @@
+# per-station time series, one row per station per Montreal day with the samples as parallel
+# arrays (timestamps, bikes, docks). the dashboard reads a single station's row(s) instead
+# of scanning every station in station_status_log, and a week is only 7 rows to fetch
+# a day's rows are written once, after the day ends (the cleaner, once a day): appending to the
+# arrays on every snapshot rewrote the whole row each time. the day still going is read from
+# the logs through their (station_id, time) indexes, see queries.STATION_SERIES
+TIMEZONE = "America/Toronto"
+
+# every complete day after the newest one stored, from station_status_log and, when the
+# database has it (sql/004), station_status_change: only one of them has rows, depending on the
+# ingest's STORAGE_MODE. an empty table is filled from the whole log
+_FILL_SERIES = f"""
+    WITH bounds AS (
+        SELECT COALESCE((MAX(day) + 1)::timestamp AT TIME ZONE '{TIMEZONE}', '-infinity') AS since,
+               date_trunc('day', NOW() AT TIME ZONE '{TIMEZONE}') AT TIME ZONE '{TIMEZONE}' AS until
+        FROM station_series
+    ), samples AS (
+        SELECT station_id, bikes_av, docks_av, fetched_at
+        FROM station_status_log, bounds
+        WHERE station_id IS NOT NULL AND fetched_at >= since AND fetched_at < until{{changes}}
+    )
+    INSERT INTO station_series (station_id, day, ts, bikes_av, docks_av)
+    SELECT station_id,
+           (fetched_at AT TIME ZONE '{TIMEZONE}')::date AS day,
+           array_agg(fetched_at ORDER BY fetched_at),
+           array_agg(bikes_av::smallint ORDER BY fetched_at),
+           array_agg(docks_av::smallint ORDER BY fetched_at)
+    FROM samples
+    GROUP BY station_id, day
+    ON CONFLICT (station_id, day) DO NOTHING;
+"""
+
+FILL_SERIES = _FILL_SERIES.format(changes="")
+FILL_SERIES_WITH_CHANGES = _FILL_SERIES.format(changes="""
+        UNION ALL
+        SELECT station_id, bikes_av, docks_av, changed_at
+        FROM station_status_change, bounds
+        WHERE changed_at >= since AND changed_at < until""")
+
+
+def fill_station_series(curs):
+    # -> number of station days written
+    curs.execute("SELECT to_regclass('station_status_change');")
+    curs.execute(FILL_SERIES if curs.fetchone()[0] is None else FILL_SERIES_WITH_CHANGES)
+    return curs.rowcount
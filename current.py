@@ -0,0 +1,55 @@
+# latest state per station, one row each, upserted with every snapshot in the same transaction
+# (the ingest and fetch.py)
+# the dashboard map reads these ~1,000 rows instead of looking for the newest snapshot in the log.
+# changed_at only moves when bikes / docks / is_functional differ from the stored row, so
+# fetched_at - changed_at is how long a station has been sitting on the same values
+PREVIOUS_STATE = """
+    SELECT station_id, bikes_av, docks_av, is_functional, fetched_at FROM station_current
+    WHERE station_id = ANY(%(station_ids)s);
+"""
+
+UPSERT_CURRENT = """
+    INSERT INTO station_current AS c (station_id, system_id, bikes_av, docks_av, is_functional, fetched_at, changed_at)
+    SELECT u.station_id, u.system_id, u.bikes_av, u.docks_av, u.is_functional, u.fetched_at, u.fetched_at
+    FROM unnest(%(station_ids)s::text[], %(system_ids)s::text[], %(bikes_av)s::int[], %(docks_av)s::int[],
+                %(is_functional)s::boolean[], %(fetched_at)s::timestamptz[])
+        AS u (station_id, system_id, bikes_av, docks_av, is_functional, fetched_at)
+    ON CONFLICT (station_id) DO UPDATE SET
+        bikes_av = EXCLUDED.bikes_av,
+        docks_av = EXCLUDED.docks_av,
+        is_functional = EXCLUDED.is_functional,
+        fetched_at = EXCLUDED.fetched_at,
+        changed_at = CASE
+            WHEN (c.bikes_av, c.docks_av, c.is_functional)
+                IS DISTINCT FROM (EXCLUDED.bikes_av, EXCLUDED.docks_av, EXCLUDED.is_functional)
+            THEN EXCLUDED.fetched_at
+            ELSE c.changed_at
+        END
+    WHERE EXCLUDED.fetched_at > c.fetched_at;
+"""
+
+
+def previous_state(curs, df):
+    # the stored values of df's stations, i.e. what upsert_current is about to replace. read once
+    # per run in the snapshot transaction: the flows and delta mode both diff against it
+    import polars as pl
+    curs.execute(PREVIOUS_STATE, {"station_ids": df.get_column("station_id").to_list()})
+    return pl.DataFrame(
+        curs.fetchall(),
+        schema={"station_id": pl.String, "bikes_av": pl.Int64, "docks_av": pl.Int64,
+                "is_functional": pl.Boolean, "fetched_at": pl.Datetime("us", "UTC")},
+        orient="row",
+    )
+
+
+def upsert_current(curs, df):
+    # the columns go over as arrays in one statement
+    curs.execute(UPSERT_CURRENT, {
+        "fetched_at": df.get_column("fetched_at").to_list(),
+        "station_ids": df.get_column("station_id").to_list(),
+        "system_ids": df.get_column("system_id").to_list(),
+        "bikes_av": df.get_column("bikes_av").to_list(),
+        "docks_av": df.get_column("docks_av").to_list(),
+        "is_functional": df.get_column("is_functional").to_list(),
+    })
+    return curs.rowcount
@@ -2,41 +2,111 @@ import streamlit as st
 import polars as pl
 import pydeck as pdk
 from millify import millify
-import pandas as pd
 import psycopg2
+from concurrent.futures import ThreadPoolExecutor
 from streamlit_autorefresh import st_autorefresh
 
+import os
+import math
+import datetime as dt
+
+import grid
+import instrument
+import queries
+import timeseries
+from db import DatabasePool
+from incremental import IncrementalFrame
+from notify import SnapshotListener
+from shared_cache import SharedFrameCache
+from replay import Archive
+
 TOTAL_BIKES = 12600 # per bixi, approx.
-MIN_LAT, MAX_LAT = 45.40, 45.55 # Montreal + Longueil
-MIN_LON, MAX_LON = -73.70, -73.45
+SYSTEM_ID = os.environ.get("SYSTEM_ID", "bixi") # which of the ingested gbfs systems to show
+MAP_MAX_POINTS = 2000 # above this many stations the map starts out on cells instead of points
+MAP_DETAIL = { # geohash precision of the cells (grid.CELL_PRECISIONS), None = every station
+    "Stations": None,
+    "Neighbourhoods (~1 km)": 6,
+    "Districts (~5 km)": 5,
+}
+NEARBY_MIN_BIKES = 3
+NEARBY_LIMIT = 10
+AGGREGATE_HISTORY_MAX_ROWS = 200_000 # ~2 years of 5 minute snapshots
+SNAPSHOT_POLL_S = 5 # how often a session checks the listener's version (in memory, no db)
+SHARED_CACHE_MAX_AGE_S = 300 # republish even without a notification after this long
+STATION_WINDOWS = {
+    "Last ~2 hours": dt.timedelta(minutes=90),
+    "Last day": dt.timedelta(days=1),
+    "Last week": dt.timedelta(days=7),
+}
+CHART_RANGES = {
+    "Last 24 hours": dt.timedelta(days=1),
+    "Last 7 days": dt.timedelta(days=7),
+    "Last 30 days": dt.timedelta(days=30),
+    "All": None,
+}
+AGGREGATE_COLUMN_NAMES = {
+    "fetched_at": "Time",
+    "total_bikes_av": "Total Bikes Available",
+    "total_docks_av": "Total Docks Available",
+    "empty_stations": "Empty Stations",
+    "full_stations": "Overflow Stations" 
+}
 
 @st.cache_resource
-def get_db_connection():
+def get_db_pool():
+    # BIXI_ARCHIVE=<parquet archive root> runs the dashboard off the archive, no postgres needed
+    if os.environ.get("BIXI_ARCHIVE"):
+        return Archive(os.environ["BIXI_ARCHIVE"])
+
+    # one pool for the whole process, shared by all sessions and reruns
+    db = st.secrets["database"]
     try:
-        conn = psycopg2.connect(
-            dbname=st.secrets["database"]["NAME"], 
-            user=st.secrets["database"]["DBUSERNAME"], 
-            password=st.secrets["database"]["PW"], 
-            host = st.secrets["database"]["ENDPOINT"], 
-            port=st.secrets["database"]["PORT"]
+        return DatabasePool(
+            minconn=1,
+            maxconn=int(db.get("POOL_SIZE", 4)),
+            statement_timeout_ms=int(db.get("STATEMENT_TIMEOUT_MS", 10000)),
+            **db_params()
         )
-        return conn # cache 
     except (Exception, psycopg2.Error) as error:
         st.error(f"Error connecting to database: {error}")
         return None
 
-@st.cache_data(ttl=300) # cache for 5 minutes
-def load_latest_snapshot(_conn):
-    query = """
-        SELECT * FROM station_status_log
-        WHERE fetched_at = (SELECT MAX(fetched_at) FROM station_status_log);
-    """
+def db_params():
+    db = st.secrets["database"]
+    return dict(dbname=db["NAME"], user=db["DBUSERNAME"], password=db["PW"], host=db["ENDPOINT"], port=db["PORT"])
+
+@st.cache_resource
+def get_snapshot_listener(_pool):
+    # one LISTEN connection per process, the ingest notifies after every committed snapshot.
+    # the listener warms the shared cache for the new version before publishing it, so the
+    # db sees one refresh per snapshot however many sessions are open
+    if isinstance(_pool, Archive):
+        return None
+    params = db_params()
+    return SnapshotListener(
+        lambda: psycopg2.connect(connect_timeout=10, keepalives=1, keepalives_idle=60, **params),
+        SYSTEM_ID,
+        on_snapshot=lambda version: refresh_dashboard_data(_pool, version),
+    ).start()
+
+@st.cache_resource
+def get_shared_cache():
+    # DASHBOARD_CACHE_DIR=/dev/shm/bixi-dashboard: the dashboard processes on this host share the
+    # loaded frames (memory-mapped arrow files) and only the elected refresher queries the db
+    directory = os.environ.get("DASHBOARD_CACHE_DIR")
+    return SharedFrameCache(directory) if directory else None
+
+@instrument.timed("load_latest_snapshot")
+def load_latest_snapshot(pool):
+    query = queries.LATEST_SNAPSHOT
     
-    df = pl.read_database(query, _conn)
+    df = pool.read_frame(query, {"system_id": SYSTEM_ID})
     
     if not df.is_empty():
         df = df.with_columns(
-            pl.col("fetched_at").dt.convert_time_zone("America/Toronto")
+            pl.col("fetched_at").dt.convert_time_zone("America/Toronto"),
+            # how long the station has been showing the same numbers
+            (pl.col("fetched_at") - pl.col("changed_at")).dt.total_minutes().alias("unchanged minutes"),
         )
     
     df = df.rename({
@@ -46,52 +116,170 @@ def load_latest_snapshot(_conn):
     })
     return df
 
-@st.cache_data(ttl=300) 
-def load_aggregate_history(_conn):
+@instrument.timed("load_aggregate_history")
+def load_aggregate_history(pool, since=None):
 
-    query = "SELECT * FROM system_aggregate_log ORDER BY fetched_at ASC;"
-    
-    df_agg = pl.read_database(query, _conn)
+    if since is None:
+        df_agg = pool.read_frame(queries.AGGREGATE_HISTORY, {"system_id": SYSTEM_ID, "max_rows": AGGREGATE_HISTORY_MAX_ROWS})
+    else:
+        df_agg = pool.read_frame(queries.AGGREGATE_HISTORY_SINCE, {"system_id": SYSTEM_ID, "since": since})
     
     if not df_agg.is_empty():
         df_agg = df_agg.with_columns(
             pl.col("fetched_at").dt.convert_time_zone("America/Toronto")
         )
     
-    df_agg = df_agg.rename({
-        "fetched_at": "Time",
-        "total_bikes_av": "Total Bikes Available",
-        "total_docks_av": "Total Docks Available",
-        "empty_stations": "Empty Stations",
-        "full_stations": "Overflow Stations" 
-    })
+    df_agg = df_agg.rename(AGGREGATE_COLUMN_NAMES)
     return df_agg
 
-@st.cache_data(ttl=300) 
-def load_station_history(_conn):
-    query = """
-        SELECT name, bikes_av, fetched_at
-        FROM station_status_log
-        WHERE fetched_at IN (
-            SELECT DISTINCT fetched_at
-            FROM station_status_log
-            ORDER BY fetched_at DESC
-            LIMIT 18
-        );
-    """
-    
-    df_hist = pl.read_database(query, _conn)
-    
-    if not df_hist.is_empty():
-        df_hist = df_hist.with_columns(
+@st.cache_data(ttl=300)
+@instrument.timed("load_rollup_history")
+def load_rollup_history(_pool, resolution, start):
+    df_rollup = _pool.read_frame(queries.ROLLUP_HISTORY, {"system_id": SYSTEM_ID, "resolution": resolution, "start": start})
+
+    if not df_rollup.is_empty():
+        df_rollup = df_rollup.with_columns(
             pl.col("fetched_at").dt.convert_time_zone("America/Toronto")
         )
-    
-    df_hist = df_hist.rename({
+
+    return df_rollup.rename(AGGREGATE_COLUMN_NAMES)
+
+def load_chart_history(pool, df_agg, window):
+    # raw rows for short ranges, hourly / daily buckets for long ones, then capped with LTTB
+    end = df_agg.get_column("Time").max()
+    start = end - window if window is not None else df_agg.get_column("Time").min()
+    resolution = timeseries.pick_resolution(start, end)
+    if resolution is None:
+        history = df_agg.filter(pl.col("Time") >= start)
+    else:
+        # "All" may reach further back than the in-memory history, the rollups go back to day one
+        start = start.replace(minute=0, second=0, microsecond=0) if window is not None else dt.datetime(1970, 1, 1, tzinfo=dt.timezone.utc)
+        history = load_rollup_history(pool, resolution, start)
+    return timeseries.downsample(history, "Time", list(AGGREGATE_COLUMN_NAMES.values())[1:])
+
+@st.cache_data(ttl=3600)
+def has_change_log(_pool):
+    # station_status_change only exists with sql/004
+    return _pool.read_frame(queries.CHANGE_LOG_EXISTS).item()
+
+@st.cache_data(ttl=300)
+@instrument.timed("load_station_series")
+def load_station_series(_pool, station_id, start):
+    # just the selected station, fetched on demand
+    query = queries.STATION_SERIES_WITH_CHANGES if has_change_log(_pool) else queries.STATION_SERIES
+    df_series = _pool.read_frame(query, {"station_id": station_id, "start": start})
+
+    if not df_series.is_empty():
+        df_series = df_series.with_columns(
+            pl.col("fetched_at").dt.convert_time_zone("America/Toronto")
+        )
+
+    df_series = df_series.rename({
         "fetched_at": "update_time",
         "bikes_av": "number available bikes"
     })
-    return df_hist
+    return timeseries.downsample(df_series, "update_time", ["number available bikes"])
+
+# fetched_at is the snapshot on screen, it only keys the cache
+@st.cache_data(ttl=300)
+@instrument.timed("load_cells")
+def load_cells(_pool, precision, fetched_at):
+    # a few hundred per-cell rows from cell_current instead of every station
+    df_cells = _pool.read_frame(queries.CELL_SNAPSHOT, {"system_id": SYSTEM_ID, "precision": precision})
+    return df_cells.with_columns(pl.Series("polygon", [grid.polygon(c) for c in df_cells.get_column("cell")]))
+
+@st.cache_data(ttl=300)
+@instrument.timed("load_nearby_stations")
+def load_nearby_stations(_pool, lat, lon, fetched_at):
+    # stations of the 9 cells around the point, through the station geohash index
+    df_nearby = _pool.read_frame(queries.NEARBY_STATIONS, {
+        "system_id": SYSTEM_ID,
+        "cells": grid.nearby_cells(lat, lon),
+        "lat": lat,
+        "lon": lon,
+        "lon_scale": grid.lon_scale(lat),
+        "min_bikes": NEARBY_MIN_BIKES,
+        "limit": NEARBY_LIMIT,
+    })
+    return df_nearby.select(
+        "name",
+        pl.col("bikes_av").alias("bikes"),
+        pl.col("docks_av").alias("docks"),
+        ((pl.col("distance_m") / 10).round() * 10).cast(pl.Int64).alias("distance (m)"),
+    )
+
+@st.cache_resource
+def get_aggregate_cache(_pool):
+    # shared by every session: after the first load each refresh only fetches the new rows
+    return IncrementalFrame(
+        lambda since: load_aggregate_history(_pool, since),
+        time_col="Time",
+        max_rows=AGGREGATE_HISTORY_MAX_ROWS,
+    )
+
+@instrument.timed("load_dashboard_data")
+def query_dashboard_data(pool):
+    # the loaders are independent: run them on separate pooled connections at once
+    agg_cache = get_aggregate_cache(pool)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        latest = executor.submit(load_latest_snapshot, pool)
+        agg = executor.submit(agg_cache.get)
+        return latest.result(), agg.result()
+
+# snapshot_version is only there to key the cache: each new snapshot gets a fresh entry. the ttl
+# stays as a fallback for when nothing is listening (archive mode, listener disconnected)
+@st.cache_data(ttl=300, max_entries=4)
+def load_dashboard_data(_pool, snapshot_version=0):
+    return query_dashboard_data(_pool)
+
+def publish_dashboard_data(pool, cache, max_age):
+    # refresher only: query once and write the frames for every process, unless another
+    # session of this process just did
+    with cache.refresh_lock:
+        age = cache.age()
+        if age is not None and age < max_age and cache.read() is not None:
+            return
+        latest, agg = query_dashboard_data(pool)
+        # keyed by the snapshot itself, so every process agrees on the version
+        key = latest.get_column("fetched_at").max().isoformat() if not latest.is_empty() else None
+        cache.publish({"latest_snapshot": latest, "aggregate_history": agg}, key)
+
+def refresh_dashboard_data(pool, version):
+    # listener callback, once per new snapshot
+    cache = get_shared_cache()
+    if cache is None:
+        load_dashboard_data(pool, version)
+    elif cache.elect():
+        publish_dashboard_data(pool, cache, max_age=0)
+
+def get_dashboard_data(pool, version):
+    cache = get_shared_cache()
+    if cache is not None:
+        # nothing published yet, or the refresher stopped refreshing (it died, no notifications):
+        # whoever wins the election takes over
+        age = cache.age()
+        if (age is None or age > SHARED_CACHE_MAX_AGE_S) and cache.elect():
+            publish_dashboard_data(pool, cache, max_age=SHARED_CACHE_MAX_AGE_S)
+            age = cache.age()
+        # still stale: the refresher is alive but stuck (a hung query...), this process queries
+        # for itself until it publishes again
+        frames = cache.read() if age is not None and age <= SHARED_CACHE_MAX_AGE_S else None
+        if frames is not None:
+            return frames["latest_snapshot"], frames["aggregate_history"]
+    return load_dashboard_data(pool, version)
+
+def snapshot_version(listener):
+    # what a run renders: the published key with a shared cache, the listener's count otherwise
+    cache = get_shared_cache()
+    if cache is not None:
+        return cache.key()
+    return listener.version if listener is not None else 0
+
+@st.fragment(run_every=SNAPSHOT_POLL_S)
+def watch_snapshots(listener):
+    # rerun the whole page once there's a newer (already cached) snapshot
+    if snapshot_version(listener) != st.session_state.get("snapshot_version"):
+        st.rerun()
 
 
 st.write("""
@@ -99,17 +287,27 @@ st.write("""
 With public transit on strike all of November, Montrealers are turning to Bixi to get around.  
 To handle the surge, the network has added extra drop-off stations and more staff to keep bikes balanced across the city.  
 
-The metrics, map and line charts below will be updated every 5 minutes. Let's see how the system holds up! 🚲
+The metrics, map and line charts below are updated as soon as a new snapshot comes in (every 5 minutes). Let's see how the system holds up! 🚲
 """)
 
-st_autorefresh(interval=300000, key="datarefresher")
-
-conn = get_db_connection()
-if conn is None:
+pool = get_db_pool()
+if pool is None:
     st.stop()
 
-df = load_latest_snapshot(conn)
-df_agg = load_aggregate_history(conn)
+listener = get_snapshot_listener(pool)
+# the snapshot this run renders, watch_snapshots compares the listener against it
+st.session_state.snapshot_version = snapshot_version(listener)
+if listener is not None:
+    watch_snapshots(listener)
+if listener is None or not listener.connected:
+    # nothing to push updates (yet): poll like before
+    st_autorefresh(interval=300000, key="datarefresher")
+
+try:
+    df, df_agg = get_dashboard_data(pool, st.session_state.snapshot_version)
+except Exception as error:
+    st.error(f"Error loading data: {error}")
+    st.stop()
 
 if df.is_empty() or df_agg.is_empty():
     st.warning("No data found in the database")
@@ -141,85 +339,120 @@ delta_full = num_stations_less_3docks - full_prev
 c.metric("Stations at < 3 docks", f"{num_stations_less_3docks} ({percentage_overflows:.2f} %)", f"{delta_full}", border=True)
 
 
-# map
-df_filtered = df.filter(
-    (pl.col("is functional") == True) & 
-    (pl.col("lat") >= MIN_LAT) &
-    (pl.col("lat") <= MAX_LAT) &
-    (pl.col("lon") >= MIN_LON) &
-    (pl.col("lon") <= MAX_LON)
+# map: wherever the system's stations are, no fixed bounding box. stations without a
+# position (the ingest fills 0 / 0) are left out
+df_located = df.filter((pl.col("lat") != 0) | (pl.col("lon") != 0))
+df_filtered = df_located.filter(pl.col("is functional") == True)
+latest_time = df.get_column("fetched_at").max()
+
+# centre on the stations, zoomed so the bulk of them (outliers aside) fits the map column
+lat_lo, lat_hi, lon_lo, lon_hi = df_located.select(
+    pl.col("lat").quantile(0.02).alias("lat_lo"), pl.col("lat").quantile(0.98).alias("lat_hi"),
+    pl.col("lon").quantile(0.02).alias("lon_lo"), pl.col("lon").quantile(0.98).alias("lon_hi"),
+).row(0)
+span = max(lon_hi - lon_lo, (lat_hi - lat_lo) / grid.lon_scale((lat_lo + lat_hi) / 2), 1e-3)
+view_state = pdk.ViewState(
+    latitude=(lat_lo + lat_hi) / 2,
+    longitude=(lon_lo + lon_hi) / 2,
+    zoom=min(13, max(3, math.log2(1125 / span))), # ~800 px wide: 256 * 2^zoom px per 360 degrees
 )
 
-data = df_filtered.to_pandas()
-
-def color_row(row):
-    if row["number available bikes"] < 3:
-        return [255, 75, 75]  # red
-    elif row["number available docks"] < 3:
-        return [255, 200, 0]  # yellow 
-    else:
-        return [0, 180, 0]  # green normal
-
-data["color"] = data.apply(color_row, axis=1)
-
-layer = pdk.Layer(
-    "ScatterplotLayer",
-    data=data,
-    get_position=["lon", "lat"],
-    get_fill_color="color",
-    get_radius=30, 
-    pickable=True,
-    opacity=0.8,
-)
 
-view_state = pdk.ViewState(latitude=45.4996, longitude=-73.5668, zoom=13)
-
-deck = pdk.Deck(
-    layers=[layer],
-    initial_view_state=view_state,
-    map_style="light",  
-    tooltip={
-        'html': '{name} <br> Bikes: {number available bikes} <br> Open docks: {number available docks}',
-        'style': {'color': 'white'}
-    } # type: ignore
-)
-
-
-station_history_df = load_station_history(conn).to_pandas()
-station_names = sorted(station_history_df["name"].unique())
+# name -> station_id, straight from the latest snapshot
+station_ids = dict(df.select("name", "station_id").unique("name").iter_rows())
+station_names = sorted(station_ids)
+station_positions = {name: (lat, lon) for name, lat, lon in df_located.select("name", "lat", "lon").iter_rows()}
 
 col_map, col_chart = st.columns([2, 1])
 
 with col_map:
+    # pydeck doesn't report the viewport back, so the level of detail is picked here: every
+    # station for a city, cells once there are enough stations that the points get heavy
+    map_detail = st.radio("Detail", list(MAP_DETAIL), index=0 if df_filtered.height <= MAP_MAX_POINTS else 1,
+                          horizontal=True)
+    precision = MAP_DETAIL[map_detail]
+    if precision is None:
+        # vectorized colors, same rules as before: red < 3 bikes, yellow < 3 docks, green otherwise
+        data = df_filtered.select(
+            "name", "lat", "lon", "number available bikes", "number available docks", "unchanged minutes",
+            pl.when(pl.col("number available bikes") < 3).then(pl.lit([255, 75, 75]))  # red
+            .when(pl.col("number available docks") < 3).then(pl.lit([255, 200, 0]))  # yellow
+            .otherwise(pl.lit([0, 180, 0]))  # green normal
+            .alias("color"),
+        )
+        layer = pdk.Layer(
+            "ScatterplotLayer",
+            data=data.to_dicts(), # only the columns the layer and tooltip use, no pandas round trip
+            get_position=["lon", "lat"],
+            get_fill_color="color",
+            get_radius=30,
+            pickable=True,
+            opacity=0.8,
+        )
+        tooltip = '{name} <br> Bikes: {number available bikes} <br> Open docks: {number available docks} <br> Unchanged for: {unchanged minutes} min'
+    else:
+        # same colors per cell: red when a third of its stations are under 3 bikes, yellow under 3 docks
+        data = load_cells(pool, precision, latest_time).select(
+            "polygon", "stations", "bikes_av", "docks_av", "empty_stations", "full_stations",
+            pl.when(pl.col("empty_stations") * 3 >= pl.col("stations")).then(pl.lit([255, 75, 75]))  # red
+            .when(pl.col("full_stations") * 3 >= pl.col("stations")).then(pl.lit([255, 200, 0]))  # yellow
+            .otherwise(pl.lit([0, 180, 0]))  # green normal
+            .alias("color"),
+        )
+        layer = pdk.Layer(
+            "PolygonLayer",
+            data=data.to_dicts(),
+            get_polygon="polygon",
+            get_fill_color="color",
+            get_line_color=[255, 255, 255],
+            line_width_min_pixels=1,
+            pickable=True,
+            opacity=0.5,
+        )
+        tooltip = '{stations} stations <br> Bikes: {bikes_av} <br> Open docks: {docks_av} <br> Under 3 bikes: {empty_stations} <br> Under 3 docks: {full_stations}'
+
+    deck = pdk.Deck(
+        layers=[layer],
+        initial_view_state=view_state,
+        map_style="light",
+        tooltip={
+            'html': tooltip,
+            'style': {'color': 'white'}
+        } # type: ignore
+    )
     st.pydeck_chart(deck)
 
 with col_chart:
-    st.write("#### Bikes at Station (Last ~2 Hours)")
+    st.write("#### Bikes at Station")
     selected_station = st.selectbox("Select a station", station_names)
+    station_window = st.radio("Window", list(STATION_WINDOWS), horizontal=True)
     if selected_station:
-        station_df = station_history_df[station_history_df["name"] == selected_station]
-        station_df = station_df.sort_values("update_time") # type: ignore
-        station_df["update_time"] = pd.to_datetime(station_df["update_time"])
-        station_df["time_label"] = station_df["update_time"].dt.strftime("%H:%M")
-        
-        station_chart_df = station_df[["time_label", "number available bikes"]].set_index("time_label")
-        
+        # rounded to the minute so reruns within a minute share the cached query
+        start = (df.get_column("fetched_at").max() - STATION_WINDOWS[station_window]).replace(second=0, microsecond=0)
         st.line_chart(
-            station_chart_df,
+            load_station_series(pool, station_ids[selected_station], start),
+            x="update_time",
+            y="number available bikes",
             width='stretch',
             height=250
         )
+        if selected_station in station_positions:
+            st.write(f"#### Nearby with > {NEARBY_MIN_BIKES} bikes")
+            st.dataframe(
+                load_nearby_stations(pool, *station_positions[selected_station], latest_time),
+                hide_index=True,
+            )
 
 st.write("## Global Evolution")
 
-df_agg_pd = df_agg.to_pandas()
-df_agg_pd = df_agg_pd.set_index("Time")
+chart_range = st.radio("Range", list(CHART_RANGES), index=len(CHART_RANGES) - 1, horizontal=True)
+df_chart = load_chart_history(pool, df_agg, CHART_RANGES[chart_range])
 
 st.write("### Station Stress")
-st.line_chart(df_agg_pd[["Empty Stations", "Overflow Stations"]],
+st.line_chart(df_chart, x="Time", y=["Empty Stations", "Overflow Stations"],
               width='stretch', color=['#FF0000', '#FFC800'],
               )
 
 st.write("### Bikes and Docks")
-st.line_chart(df_agg_pd[["Total Bikes Available", "Total Docks Available"]],
+st.line_chart(df_chart, x="Time", y=["Total Bikes Available", "Total Docks Available"],
               width='stretch')
\ No newline at end of file
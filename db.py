@@ -0,0 +1,80 @@
+# dashboard-side db access: a small bounded pool shared by every streamlit session
+#  - at most `maxconn` connections; callers wait (up to `checkout_timeout`) for a free one
+#  - every checkout is pinged first, dead connections are thrown away and replaced
+#  - statement_timeout is set per connection so a slow query can't pin a slot forever
+import threading
+from contextlib import contextmanager
+
+import polars as pl
+import psycopg2
+import psycopg2.pool
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class DatabasePool:
+    def __init__(self, minconn=1, maxconn=4, statement_timeout_ms=10000, checkout_timeout=15, **connect_kwargs):
+        self._pool = psycopg2.pool.ThreadedConnectionPool(
+            minconn, maxconn,
+            options=f"-c statement_timeout={int(statement_timeout_ms)}",
+            connect_timeout=10,
+            keepalives=1,
+            keepalives_idle=60,
+            **connect_kwargs,
+        )
+        # ThreadedConnectionPool raises instead of waiting when it's exhausted
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._checkout_timeout = checkout_timeout
+
+    @staticmethod
+    def _is_alive(conn):
+        if conn.closed:
+            return False
+        try:
+            with conn.cursor() as curs:
+                curs.execute("SELECT 1;")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _checkout(self):
+        conn = self._pool.getconn()
+        if self._is_alive(conn):
+            return conn
+        # RDS dropped it (failover, idle timeout...): discard and take a fresh one
+        self._pool.putconn(conn, close=True)
+        return self._pool.getconn()
+
+    @contextmanager
+    def connection(self):
+        if not self._slots.acquire(timeout=self._checkout_timeout):
+            raise PoolTimeout(f"no db connection free after {self._checkout_timeout}s")
+        conn = None
+        broken = False
+        try:
+            conn = self._checkout()
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            if conn is not None:
+                if not broken and not conn.closed:
+                    try:
+                        conn.rollback()
+                    except psycopg2.Error:
+                        broken = True
+                self._pool.putconn(conn, close=broken or bool(conn.closed))
+            self._slots.release()
+
+    def read_frame(self, query, params=None, **kwargs):
+        with self.connection() as conn:
+            if params is not None:
+                kwargs["execute_options"] = {"vars": params}
+            return pl.read_database(query, conn, **kwargs)
+
+    def close(self):
+        self._pool.closeall()
@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
+import io
 import requests
 import datetime as dt
 import polars as pl
@@ -7,9 +8,51 @@ from typing import Tuple
 from env_var import ENDPOINT, PW, USERNAME, NAME, PORT
 import psycopg2
 import psycopg2.extras
+
+import instrument
+import current
+import gbfs_decode
+import grid
+import notify
 # fetches data, transform, update the db
+
+STATUS_LOG_COLUMNS = ("station_id", "bikes_av", "docks_av", "is_functional", "fetched_at")
+STATION_COLUMNS = ("station_id", "name", "lat", "lon", "capacity", "geohash")
+SYSTEM_ID = "bixi" # what the system_id column defaults to
+
+
+def copy_snapshot(curs, df, fetch_timestamp):
+    # stream the frame as csv through COPY instead of building python tuples
+    buf = io.BytesIO()
+    df.with_columns(pl.lit(fetch_timestamp).alias("fetched_at")).select(STATUS_LOG_COLUMNS).write_csv(buf, include_header=False)
+    buf.seek(0)
+    curs.copy_expert(f"COPY station_status_log ({', '.join(STATUS_LOG_COLUMNS)}) FROM STDIN WITH (FORMAT csv)", buf)
+    return df.height
+
     
-def main(): 
+def main():
+    instrument.start("fetch")
+    ok = False
+    try:
+        ok = run()
+    except Exception as e:
+        print(f"Unhandled: {e}")
+        instrument.fail(e)
+    finally:
+        # the run log gets its own connection, run() closes the one it used
+        conn = None
+        if instrument.RUN_LOG:
+            try:
+                conn = psycopg2.connect(dbname=NAME, user=USERNAME, password=PW, host=ENDPOINT)
+            except (Exception, psycopg2.Error) as error:
+                print(f"No connection for pipeline_run_log: {error}")
+        instrument.finish(ok, conn)
+        if conn is not None:
+            conn.close()
+
+
+def run():
+    # returns whether the snapshot was written
     station_info_url = 'https://gbfs.velobixi.com/gbfs/2-2/en/station_information.json'
     station_status_url = 'https://gbfs.velobixi.com/gbfs/2-2/en/station_status.json'
     
@@ -17,50 +60,52 @@ def main():
     status_response = None
     try :
         print("Fetching from info feed.")
-        info_response = requests.get(station_info_url)
+        with instrument.stage("http"):
+            info_response = requests.get(station_info_url)
         print("Success.")
     except Exception as e:
         print(f"Couldn't get from info feed, {e}")
-        return
+        return False
         
     try :
         print("Fetching from status feed.")
-        status_response = requests.get(station_status_url)
+        with instrument.stage("http"):
+            status_response = requests.get(station_status_url)
         print("Success.")
     except Exception as e:
         print(f"Couldn't get from status feed, {e}")
-        return
+        return False
     
-    stations_info_list = info_response.json()['data']['stations']
-    info_update_time = info_response.json()['last_updated']
-    stations_status_list = status_response.json()['data']['stations']
+    instrument.count("payload_bytes", len(info_response.content) + len(status_response.content))
+    with instrument.stage("parse"):
+        info_update_time, _, df_info = gbfs_decode.decode(info_response.content, gbfs_decode.INFO_SCHEMA)
+        _, _, df_status = gbfs_decode.decode(status_response.content, gbfs_decode.STATUS_SCHEMA)
 
     try:
         print("Processing data.")
-        df_info = pl.DataFrame(stations_info_list)
-        df_status = pl.DataFrame(stations_status_list)
-
-        df_merged = df_info.join(df_status, on="station_id", how="inner")
+        with instrument.stage("transform"):
+            df_merged = df_info.join(df_status, on="station_id", how="inner")
 
-        df = df_merged.select(
-            pl.col("name"),
-            pl.col("lat").fill_null(0.0), 
-            pl.col("lon").fill_null(0.0), 
-            pl.col("capacity"),
-            pl.col("num_bikes_available").alias("bikes_av"),
-            pl.col("num_docks_available").alias("docks_av"),
-            (
-                (pl.col("is_installed") == 1) & 
-                (pl.col("is_renting") == 1) & 
-                (pl.col("is_returning") == 1)
+            df = df_merged.select(
+                pl.col("station_id"),
+                pl.col("name"),
+                pl.col("lat").fill_null(0.0), 
+                pl.col("lon").fill_null(0.0), 
+                pl.col("capacity"),
+                pl.col("num_bikes_available").alias("bikes_av"),
+                pl.col("num_docks_available").alias("docks_av"),
+                (
+                    (pl.col("is_installed") == 1) & 
+                    (pl.col("is_renting") == 1) & 
+                    (pl.col("is_returning") == 1)
+                )
+                .alias("is_functional")
+                .fill_null(False) 
             )
-            .alias("is_functional")
-            .fill_null(False) 
-        )
         print("Data processed.")
     except Exception as e:
         print(f"Error processing data: {e}")
-        return 
+        return False
 
     try:
         fetch_timestamp = dt.datetime.fromtimestamp(info_update_time)
@@ -72,36 +117,65 @@ def main():
     conn = None
     try:
         print("Connecting to db.")
-        conn = psycopg2.connect(dbname=NAME, user=USERNAME, password=PW, host=ENDPOINT)
+        with instrument.stage("connect"):
+            conn = psycopg2.connect(dbname=NAME, user=USERNAME, password=PW, host=ENDPOINT)
         print("Connected to db.")
     except (Exception, psycopg2.Error) as error:
         print(f"Error connecting to database: {error}")
-        return 
+        return False
 
+    ok = False
     if conn:
         command = """
             INSERT INTO station_status_log
-            (name, lat, lon, capacity, bikes_av, docks_av, is_functional, fetched_at) 
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s); 
+            (station_id, bikes_av, docks_av, is_functional, fetched_at) 
+            VALUES (%s, %s, %s, %s, %s); 
+            """
+        station_command = """
+            INSERT INTO station (station_id, name, lat, lon, capacity, geohash, updated_at)
+            VALUES %s
+            ON CONFLICT (station_id) DO UPDATE
+            SET name = EXCLUDED.name, lat = EXCLUDED.lat, lon = EXCLUDED.lon,
+                capacity = EXCLUDED.capacity, geohash = EXCLUDED.geohash, updated_at = EXCLUDED.updated_at
+            WHERE (station.name, station.lat, station.lon, station.capacity, station.geohash)
+                IS DISTINCT FROM (EXCLUDED.name, EXCLUDED.lat, EXCLUDED.lon, EXCLUDED.capacity, EXCLUDED.geohash);
             """
-        
-        
-        data_to_insert = [row + (fetch_timestamp,) for row in df.rows()]
         
         try:
-            with conn:
+            with instrument.stage("write"), conn:
                 with conn.cursor() as curs:
+                    print("Upserting stations.")
+                    psycopg2.extras.execute_values(curs, station_command, grid.with_geohash(df).select(STATION_COLUMNS).rows(),
+                                                   template="(%s, %s, %s, %s, %s, %s, NOW())", page_size=1000)
                     print("Inserting in db.")
-                    psycopg2.extras.execute_batch(curs, command, data_to_insert)
-                    print(f"Successfully inserted {len(data_to_insert)} rows.")
+                    curs.execute("SAVEPOINT copy_snapshot;")
+                    try:
+                        n = copy_snapshot(curs, df, fetch_timestamp)
+                    except (Exception, psycopg2.Error) as error:
+                        print(f"COPY failed ({error}), falling back to execute_batch.")
+                        curs.execute("ROLLBACK TO SAVEPOINT copy_snapshot;")
+                        data_to_insert = [row + (fetch_timestamp,) for row in df.select(STATUS_LOG_COLUMNS[:-1]).rows()]
+                        psycopg2.extras.execute_batch(curs, command, data_to_insert)
+                        n = len(data_to_insert)
+                    print(f"Successfully inserted {n} rows.")
+                    instrument.count("rows_written", n)
+                    # what the dashboard reads, so the notify below has something new to show
+                    snapshot = df.with_columns(pl.lit(SYSTEM_ID).alias("system_id"), pl.lit(fetch_timestamp).alias("fetched_at"))
+                    current.upsert_current(curs, snapshot)
+                    n = grid.upsert_cells(curs, grid.cell_aggregates(snapshot))
+                    instrument.count("cells_upserted", n)
+                    notify.notify_snapshot(curs, SYSTEM_ID, fetch_timestamp)
+            ok = True
                         
         except (Exception, psycopg2.Error) as error:
             print(f"Error during batch insert: {error}")
+            instrument.fail(error)
         
         finally:
             if conn is not None:
                 conn.close()
                 print("Database connection closed.")
+    return ok
             
         
 if __name__ == "__main__":
@@ -0,0 +1,178 @@
+# station flows between consecutive snapshots: per station and interval, how many bikes left
+# (departures) or came in (arrivals), and whether the jump is too big to be riders, i.e. most
+# likely a rebalancing truck. one polars pass over any number of snapshots: diff().over(station)
+# on frames in fetched_at order, no python loop per station
+#   station_flows(frame)     DataFrame / LazyFrame with station_id, fetched_at, bikes_av, docks_av
+#   write_flows(curs, df, previous)
+#                            ingest: this run's snapshot against the previous values in
+#                            station_current (current.previous_state), in the snapshot transaction
+#   python flow.py --since 2025-11-01 [--until 2025-11-08]
+#                            (re)compute station_flow_log from station_status_log, a day per transaction.
+#                            refuses a range stored in delta mode, skips days without snapshots
+#   python replay.py flows ARCHIVE_ROOT [--since DATE] [--out FILE]
+#                            the same from the parquet archive
+# station_flow_log only gets intervals where something changed, no row = nothing moved
+# polars is imported inside the functions, the ingest imports this module at init
+import io
+import os
+import argparse
+import datetime as dt
+
+import instrument
+
+# a change of at least this many bikes within one interval is flagged as rebalancing...
+REBALANCE_BIKES = int(os.environ.get("REBALANCE_BIKES", "8"))
+# ...unless the interval is longer than this (missed snapshots, an outage): given enough time
+# riders alone move that many bikes
+REBALANCE_MAX_INTERVAL = dt.timedelta(minutes=int(os.environ.get("REBALANCE_MAX_INTERVAL_MINUTES", "15")))
+
+FLOW_COLUMNS = ("station_id", "system_id", "fetched_at", "interval_s", "bikes_delta", "docks_delta",
+                "departures", "arrivals", "rebalancing")
+
+SNAPSHOTS = """
+    SELECT station_id, system_id, bikes_av, docks_av, fetched_at FROM station_status_log
+    WHERE fetched_at >= %(start)s AND fetched_at < %(end)s
+    ORDER BY fetched_at;
+"""
+
+# how far before a chunk recompute() looks for each station's previous snapshot
+LOOKBACK = dt.timedelta(hours=1)
+
+DELETE_RANGE = "DELETE FROM station_flow_log WHERE fetched_at >= %(start)s AND fetched_at < %(end)s;"
+
+# the ingest's delta mode (STORAGE_MODE=delta) writes station_status_change and nothing to
+# station_status_log: recomputing such a range from the log would find no snapshots
+CHANGES_IN_RANGE = """
+    SELECT EXISTS (SELECT 1 FROM station_status_change WHERE changed_at >= %(start)s AND changed_at < %(end)s);
+"""
+
+
+def station_flows(frame, rebalance_bikes=REBALANCE_BIKES, max_interval=REBALANCE_MAX_INTERVAL):
+    # a station's first snapshot has nothing to compare with and yields no row. the archive
+    # has no system_id
+    import polars as pl
+    columns = [c for c in FLOW_COLUMNS if c != "system_id" or c in frame.collect_schema()]
+    return (
+        frame.sort("fetched_at")
+        # one window pass: the three diffs share the station grouping
+        .with_columns(
+            pl.col("fetched_at").diff().over("station_id").alias("interval"),
+            pl.col("bikes_av").diff().over("station_id").alias("bikes_delta"),
+            pl.col("docks_av").diff().over("station_id").alias("docks_delta"),
+        )
+        # most intervals change nothing, drop them before deriving anything else
+        .filter((pl.col("interval") > dt.timedelta(0)) & ((pl.col("bikes_delta") != 0) | (pl.col("docks_delta") != 0)))
+        .with_columns(
+            pl.col("interval").dt.total_seconds().alias("interval_s"),
+            (-pl.col("bikes_delta")).clip(lower_bound=0).alias("departures"),
+            pl.col("bikes_delta").clip(lower_bound=0).alias("arrivals"),
+            ((pl.col("bikes_delta").abs() >= rebalance_bikes) & (pl.col("interval") <= max_interval)).alias("rebalancing"),
+        )
+        .select(columns)
+    )
+
+
+def copy_flows(curs, flows):
+    # csv through COPY, like the snapshot itself
+    buf = io.BytesIO()
+    flows.write_csv(buf, include_header=False)
+    buf.seek(0)
+    curs.copy_expert(f"COPY station_flow_log ({', '.join(flows.columns)}) FROM STDIN WITH (FORMAT csv)", buf)
+    return flows.height
+
+
+def write_flows(curs, df, previous):
+    # ingest: df is this run's snapshot (every system), previous the values station_current
+    # held before this run
+    import polars as pl
+    previous = previous.select("station_id", "bikes_av", "docks_av", "fetched_at")
+    current = df.select("station_id", "system_id", "bikes_av", "docks_av",
+                        pl.col("fetched_at").dt.convert_time_zone("UTC"))
+    # only the new rows have a previous value to diff against, so only they come out
+    flows = station_flows(pl.concat([previous, current], how="diagonal_relaxed"))
+    return copy_flows(curs, flows) if not flows.is_empty() else 0
+
+
+def recompute(conn, start, end, chunk=dt.timedelta(days=1)):
+    # per chunk: the snapshots of the chunk plus a bit before it (so its first interval has a
+    # previous value), the chunk's rows replaced in one transaction; re-running is safe
+    import polars as pl
+    total = 0
+    chunk_start = start
+    while chunk_start < end:
+        chunk_end = min(chunk_start + chunk, end)
+        with instrument.stage("read"):
+            snapshots = pl.read_database(SNAPSHOTS, conn, execute_options={
+                "vars": {"start": chunk_start - LOOKBACK, "end": chunk_end}})
+        if snapshots.filter(pl.col("fetched_at") >= chunk_start).is_empty():
+            # nothing to recompute from, the rows already there stay
+            print(f"{chunk_start} -> {chunk_end}: no snapshot rows, skipped.")
+            chunk_start = chunk_end
+            continue
+        with instrument.stage("flows"):
+            flows = station_flows(snapshots).filter(pl.col("fetched_at") >= chunk_start)
+        with instrument.stage("write"), conn:
+            with conn.cursor() as curs:
+                curs.execute(DELETE_RANGE, {"start": chunk_start, "end": chunk_end})
+                written = copy_flows(curs, flows) if not flows.is_empty() else 0
+        print(f"{chunk_start} -> {chunk_end}: {snapshots.height} snapshot rows, {written} flow rows written.")
+        instrument.count("snapshot_rows", snapshots.height)
+        instrument.count("flow_rows", written)
+        total += written
+        chunk_start = chunk_end
+    return total
+
+
+def stored_as_changes(conn, start, end):
+    # whether part of the range was ingested in delta mode; flow.py and aggregate.py only read
+    # station_status_log and refuse such a range
+    with conn:
+        with conn.cursor() as curs:
+            curs.execute("SELECT to_regclass('station_status_change');")
+            if curs.fetchone()[0] is None:
+                return False
+            curs.execute(CHANGES_IN_RANGE, {"start": start, "end": end})
+            return curs.fetchone()[0]
+
+
+def parse_time(value):
+    ts = dt.datetime.fromisoformat(value)
+    return ts if ts.tzinfo else ts.replace(tzinfo=dt.timezone.utc)
+
+
+def main():
+    # only the cli needs the credentials, the ingest and replay.py import this module
+    from env_var import ENDPOINT, PW, USERNAME, NAME, PORT
+    import psycopg2
+
+    parser = argparse.ArgumentParser(description="Recompute station_flow_log from station_status_log.")
+    parser.add_argument("--since", type=parse_time, required=True, help="start of the range")
+    parser.add_argument("--until", type=parse_time, help="end of the range (default: now)")
+    parser.add_argument("--chunk-hours", type=float, default=24, help="size of each transaction's time range")
+    args = parser.parse_args()
+    end = args.until or dt.datetime.now(dt.timezone.utc)
+
+    instrument.start("flow", since=args.since.isoformat(), until=end.isoformat())
+    conn = None
+    ok = False
+    try:
+        with instrument.stage("connect"):
+            conn = psycopg2.connect(dbname=NAME, user=USERNAME, password=PW, host=ENDPOINT)
+        if stored_as_changes(conn, args.since, end):
+            print("The range has station_status_change rows (STORAGE_MODE=delta), nothing recomputed: "
+                  "flow.py reads station_status_log only.")
+        else:
+            total = recompute(conn, args.since, end, dt.timedelta(hours=args.chunk_hours))
+            print(f"Done, {total} flow rows written.")
+            ok = True
+    except (Exception, psycopg2.Error) as error:
+        print(f"Error: {error}. Current chunk rolled back.")
+        instrument.fail(error)
+    finally:
+        instrument.finish(ok, conn)
+        if conn is not None:
+            conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+# decode gbfs payloads from the response bytes into typed polars frames with only the columns
+# listed below. json.loads drops every other field of a station as soon as the station object is
+# parsed (object_hook), so the unused ones (vehicle_types_available, rental_uris...) never pile
+# up as python dicts, and the frame is built column by column with an explicit schema
+# gbfs 3.0 localized strings ([{"text": ..., "language": ...}], e.g. name) are resolved to
+# GBFS_LANGUAGE, or the first entry when the feed doesn't have it
+#   last_updated, ttl, df = gbfs_decode.decode(response.content, gbfs_decode.STATUS_SCHEMA)
+# shared by fetch.py and the serverless ingest (gbfs.py)
+# pl.read_json with the schema parses faster but peaks well above the old dicts path (it holds
+# the whole document while it builds the frame), bench/bench_decode.py compares the three
+# the schemas use python types and polars is imported inside the functions: the ingest imports
+# this module at init, before its timed "import" stage (see serverless/lambda.py)
+import os
+import json
+import datetime as dt
+
+LANGUAGE = os.environ.get("GBFS_LANGUAGE", "en")
+
+INFO_SCHEMA = {
+    "station_id": str,
+    "name": str,
+    "lat": float,
+    "lon": float,
+    "capacity": int,
+}
+# is_* are 0/1 in gbfs 2.x and true/false in 3.0, both decode to 0/1 here
+STATUS_SCHEMA = {
+    "station_id": str,
+    "num_bikes_available": int,
+    "num_docks_available": int,
+    "is_installed": int,
+    "is_renting": int,
+    "is_returning": int,
+}
+
+
+def parse_last_updated(value):
+    # posix seconds up to 2.x, an RFC 3339 string in 3.0 -> posix seconds
+    if value is None:
+        return None
+    if isinstance(value, (int, float)) or value.isdigit():
+        return int(value)
+    return int(dt.datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp())
+
+
+def localized(value, language=LANGUAGE):
+    # gbfs 3.0 [{"text": ..., "language": ...}] -> the text in `language`, else the first one
+    if not isinstance(value, list):
+        return value
+    texts = [entry for entry in value if isinstance(entry, dict) and "text" in entry]
+    if not texts:
+        return value
+    return next((entry["text"] for entry in texts if entry.get("language") == language), texts[0]["text"])
+
+
+def decode(content, stations):
+    # returns (last_updated, ttl, frame with exactly the `stations` schema columns)
+    import polars as pl
+    strings = [name for name, kind in stations.items() if kind is str]
+
+    def station_fields(obj):
+        # only station objects (they have a station_id) are cut down, everything above and
+        # below them is left alone: the localized entries still need their text / language
+        if "station_id" not in obj:
+            return obj
+        row = {name: obj.get(name) for name in stations}
+        for name in strings:
+            row[name] = localized(row[name])
+        return row
+
+    payload = json.loads(content, object_hook=station_fields)
+    rows = (payload.get("data") or {}).get("stations") or []
+    dtypes = {str: pl.String, float: pl.Float64, int: pl.Int64}
+    frame = pl.DataFrame([
+        # strict=False: 3.0 booleans become 0/1, integer coordinates floats
+        pl.Series(name, [row.get(name) for row in rows], dtype=dtypes[kind], strict=False)
+        for name, kind in stations.items()
+    ]).drop_nulls("station_id")
+    return parse_last_updated(payload.get("last_updated")), payload.get("ttl") or 0, frame
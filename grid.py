@@ -0,0 +1,206 @@
+# spatial grid: geohash cells, so the map and "stations near me" don't have to look at every station
+#  - every station gets a precision-7 geohash (~150 m) when the ingest upserts it; a shorter
+#    prefix of it is the cell one level up, so one column serves every coarser level
+#  - the ingest aggregates each snapshot per cell at CELL_PRECISIONS into cell_current (one row
+#    per system / precision / cell): a zoomed-out map reads a few hundred cells instead of
+#    every station
+#  - nearby lookups go through the station (system_id, left(geohash, 6)) index: the cell around
+#    a point plus its 8 neighbours, then the exact distance on those few stations only
+# geohash instead of hexagons: no new dependency, and plain text prefixes index in postgres
+# polars is imported inside the functions, the ingest imports this module at init (see lambda.py)
+#   geohash(lat, lon, precision)  polars expression, integer arithmetic on whole columns
+#   encode(lat, lon, precision)   the same on lists / series, polars String series out
+#   python grid.py                fill station.geohash for the stations already stored
+import math
+import argparse
+
+BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+STATION_PRECISION = 7  # stored on station
+CELL_PRECISIONS = (5, 6)  # ~4.9 x 4.9 km and ~1.2 x 0.6 km cells in cell_current
+# nearby lookups; has to match the left(geohash, 6) of the station index and NEARBY_STATIONS
+NEAR_PRECISION = 6
+
+CELL_COLUMNS = ("system_id", "precision", "cell", "stations", "functional_stations", "bikes_av",
+                "docks_av", "empty_stations", "full_stations", "lat", "lon", "fetched_at")
+
+UPSERT_CELLS = """
+    INSERT INTO cell_current AS c (system_id, precision, cell, stations, functional_stations, bikes_av,
+                                   docks_av, empty_stations, full_stations, lat, lon, fetched_at)
+    SELECT * FROM unnest(%(system_ids)s::text[], %(precisions)s::smallint[], %(cells)s::text[],
+                         %(stations)s::int[], %(functional_stations)s::int[], %(bikes_av)s::int[],
+                         %(docks_av)s::int[], %(empty_stations)s::int[], %(full_stations)s::int[],
+                         %(lat)s::float8[], %(lon)s::float8[], %(fetched_at)s::timestamptz[])
+    ON CONFLICT (system_id, precision, cell) DO UPDATE SET
+        stations = EXCLUDED.stations,
+        functional_stations = EXCLUDED.functional_stations,
+        bikes_av = EXCLUDED.bikes_av,
+        docks_av = EXCLUDED.docks_av,
+        empty_stations = EXCLUDED.empty_stations,
+        full_stations = EXCLUDED.full_stations,
+        lat = EXCLUDED.lat,
+        lon = EXCLUDED.lon,
+        fetched_at = EXCLUDED.fetched_at
+    WHERE EXCLUDED.fetched_at > c.fetched_at;
+"""
+
+
+def geohash(lat, lon, precision=STATION_PRECISION):
+    # bits alternate lon / lat starting with lon, 5 bits per character. polars has no bit
+    # shifts, so bit b of n is (n // 2^b) % 2
+    import polars as pl
+    bits = 5 * precision
+    lon_bits, lat_bits = (bits + 1) // 2, bits // 2
+    lon_i = ((lon + 180.0) / 360.0 * (1 << lon_bits)).floor().cast(pl.Int64).clip(0, (1 << lon_bits) - 1)
+    lat_i = ((lat + 90.0) / 180.0 * (1 << lat_bits)).floor().cast(pl.Int64).clip(0, (1 << lat_bits) - 1)
+
+    def bit(i):
+        if i % 2 == 0:
+            return lon_i // (1 << (lon_bits - 1 - i // 2)) % 2
+        return lat_i // (1 << (lat_bits - 1 - i // 2)) % 2
+
+    chars = [
+        pl.sum_horizontal([bit(5 * k + j) * (1 << (4 - j)) for j in range(5)])
+        .replace_strict(list(range(32)), list(BASE32), return_dtype=pl.String)
+        for k in range(precision)
+    ]
+    return pl.concat_str(chars)
+
+
+def encode(lat, lon, precision=STATION_PRECISION):
+    import polars as pl
+    points = pl.DataFrame({"lat": lat, "lon": lon}, schema={"lat": pl.Float64, "lon": pl.Float64})
+    return points.select(geohash(pl.col("lat"), pl.col("lon"), precision).alias("geohash")).to_series()
+
+
+def bounds(cell):
+    # -> (min_lat, max_lat, min_lon, max_lon)
+    bits = 5 * len(cell)
+    lon_bits, lat_bits = (bits + 1) // 2, bits // 2
+    code = 0
+    for char in cell:
+        code = (code << 5) | BASE32.index(char)
+    lon_i = lat_i = 0
+    for i in range(bits):
+        bit = (code >> (bits - 1 - i)) & 1
+        if i % 2 == 0:
+            lon_i = (lon_i << 1) | bit
+        else:
+            lat_i = (lat_i << 1) | bit
+    lat_size, lon_size = 180.0 / (1 << lat_bits), 360.0 / (1 << lon_bits)
+    min_lat, min_lon = lat_i * lat_size - 90.0, lon_i * lon_size - 180.0
+    return min_lat, min_lat + lat_size, min_lon, min_lon + lon_size
+
+
+def polygon(cell):
+    # [[lon, lat], ...] corners, what pydeck's PolygonLayer takes
+    min_lat, max_lat, min_lon, max_lon = bounds(cell)
+    return [[min_lon, min_lat], [max_lon, min_lat], [max_lon, max_lat], [min_lon, max_lat]]
+
+
+def nearby_cells(lat, lon, precision=NEAR_PRECISION):
+    # the cell of the point and its 8 neighbours: every station within half a cell (~300 m at
+    # precision 6) is in one of them, wherever the point sits in its cell
+    cell = encode([lat], [lon], precision)[0]
+    min_lat, max_lat, min_lon, max_lon = bounds(cell)
+    lat_size, lon_size = max_lat - min_lat, max_lon - min_lon
+    center_lat, center_lon = (min_lat + max_lat) / 2, (min_lon + max_lon) / 2
+    lats = [center_lat + dy * lat_size for dy in (-1, 0, 1) for _ in (-1, 0, 1)]
+    lons = [(center_lon + dx * lon_size + 180.0) % 360.0 - 180.0 for _ in (-1, 0, 1) for dx in (-1, 0, 1)]
+    lats = [min(max(value, -90.0), 90.0) for value in lats]
+    return encode(lats, lons, precision).unique(maintain_order=True).to_list()
+
+
+def lon_scale(lat):
+    # a degree of longitude is this many degrees of latitude at lat, for squared distances
+    return math.cos(math.radians(lat))
+
+
+def with_geohash(frame, precision=STATION_PRECISION):
+    # stations without a position (gbfs gave none, the ingest filled 0 / 0) get no cell
+    import polars as pl
+    located = (pl.col("lat") != 0) | (pl.col("lon") != 0)
+    return frame.with_columns(
+        pl.when(located).then(geohash(pl.col("lat"), pl.col("lon"), precision)).alias("geohash")
+    )
+
+
+def cell_aggregates(df, precisions=CELL_PRECISIONS, threshold=3):
+    # df: a snapshot with system_id, lat, lon, bikes_av, docks_av, is_functional, fetched_at.
+    # one row per system / precision / cell, stress counted like the system aggregates
+    import polars as pl
+    located = with_geohash(df, max(precisions)).filter(pl.col("geohash").is_not_null())
+    frames = [
+        located.group_by("system_id", "fetched_at", pl.col("geohash").str.slice(0, precision).alias("cell"))
+        .agg(
+            pl.len().alias("stations"),
+            pl.col("is_functional").sum().alias("functional_stations"),
+            pl.col("bikes_av").sum(),
+            pl.col("docks_av").sum(),
+            (pl.col("bikes_av") < threshold).sum().alias("empty_stations"),
+            (pl.col("docks_av") < threshold).sum().alias("full_stations"),
+            pl.col("lat").mean(),
+            pl.col("lon").mean(),
+        )
+        .with_columns(pl.lit(precision, dtype=pl.Int16).alias("precision"))
+        for precision in precisions
+    ]
+    return pl.concat(frames, how="vertical_relaxed").select(CELL_COLUMNS)
+
+
+def upsert_cells(curs, cells):
+    # same shape as current.upsert_current: the columns go over as arrays in one statement.
+    # cells that lost all their stations keep an older fetched_at and drop out of the map
+    curs.execute(UPSERT_CELLS, {
+        "system_ids": cells.get_column("system_id").to_list(),
+        "precisions": cells.get_column("precision").to_list(),
+        "cells": cells.get_column("cell").to_list(),
+        "stations": cells.get_column("stations").to_list(),
+        "functional_stations": cells.get_column("functional_stations").to_list(),
+        "bikes_av": cells.get_column("bikes_av").to_list(),
+        "docks_av": cells.get_column("docks_av").to_list(),
+        "empty_stations": cells.get_column("empty_stations").to_list(),
+        "full_stations": cells.get_column("full_stations").to_list(),
+        "lat": cells.get_column("lat").to_list(),
+        "lon": cells.get_column("lon").to_list(),
+        "fetched_at": cells.get_column("fetched_at").to_list(),
+    })
+    return curs.rowcount
+
+
+def backfill(conn):
+    # stations stored before the geohash column existed
+    import polars as pl
+    import psycopg2.extras
+    stations = pl.read_database("SELECT station_id, lat, lon FROM station WHERE geohash IS NULL;", conn)
+    if stations.is_empty():
+        return 0
+    rows = with_geohash(stations).filter(pl.col("geohash").is_not_null()).select("station_id", "geohash").rows()
+    with conn:
+        with conn.cursor() as curs:
+            psycopg2.extras.execute_values(curs, """
+                UPDATE station SET geohash = v.geohash
+                FROM (VALUES %s) AS v (station_id, geohash)
+                WHERE station.station_id = v.station_id;
+            """, rows, page_size=1000)
+    return len(rows)
+
+
+def main():
+    # only the cli needs the credentials, the ingest, replay.py and the dashboard import this module
+    from env_var import ENDPOINT, PW, USERNAME, NAME, PORT
+    import psycopg2
+
+    argparse.ArgumentParser(description="Fill station.geohash for stations that don't have one.").parse_args()
+    conn = None
+    try:
+        conn = psycopg2.connect(dbname=NAME, user=USERNAME, password=PW, host=ENDPOINT)
+        print(f"Done, {backfill(conn)} stations updated.")
+    except (Exception, psycopg2.Error) as error:
+        print(f"Error: {error}. Nothing written.")
+    finally:
+        if conn is not None:
+            conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+# process-wide history frames that only pull what's new
+# the first call loads what load(None) returns (the dashboard's loader stops at the row cap), later
+# calls fetch rows with time > watermark (the newest time already held) and append them. memory
+# stays bounded by a time window and/or a row cap, and every `resync_every` the frame is reloaded
+# from scratch to pick up late or rewritten rows
+import threading
+import time
+
+import polars as pl
+
+
+class IncrementalFrame:
+    def __init__(self, load, time_col, window=None, max_rows=None, resync_every=6 * 3600):
+        # load(since) -> frame sorted on time_col with rows newer than `since` (everything if None)
+        self._load = load
+        self._time_col = time_col
+        self._window = window
+        self._max_rows = max_rows
+        self._resync_every = resync_every
+        self._frame = None
+        self._last_full = 0.0
+        self._lock = threading.Lock()
+
+    def _trim(self, df):
+        if self._window is not None and not df.is_empty():
+            df = df.filter(pl.col(self._time_col) > pl.col(self._time_col).max() - self._window)
+        if self._max_rows is not None:
+            df = df.tail(self._max_rows)
+        return df
+
+    def get(self):
+        with self._lock:
+            now = time.monotonic()
+            if self._frame is None or self._frame.is_empty() or now - self._last_full > self._resync_every:
+                self._frame = self._trim(self._load(None))
+                self._last_full = now
+            else:
+                watermark = self._frame.get_column(self._time_col).max()
+                new_rows = self._load(watermark)
+                if not new_rows.is_empty():
+                    self._frame = self._trim(pl.concat([self._frame, new_rows], how="vertical_relaxed"))
+            return self._frame
+
+    def reset(self):
+        with self._lock:
+            self._frame = None
@@ -0,0 +1,186 @@
+# per-run instrumentation shared by every entry point (ingest and cleaner lambdas, fetch.py,
+# aggregate.py) plus timing hooks for the dashboard loaders
+#   instrument.start("ingest")              begin a run, one per invocation
+#   with instrument.stage("fetch"): ...     wall time of a named stage, summed if it repeats
+#   instrument.count("rows", n)             counters: rows written, payload bytes...
+#   instrument.finish(ok, conn)             one JSON line on stdout (cloudwatch / cron.log) and,
+#                                           with PIPELINE_RUN_LOG=1, a row in pipeline_run_log
+# stage() / count() are no-ops outside a run, so library modules can call them unconditionally.
+# stages may nest ("write" includes "insert_snapshot"), each one is timed on its own
+import os
+import sys
+import json
+import time
+import threading
+import functools
+import datetime as dt
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+RUN_LOG = os.environ.get("PIPELINE_RUN_LOG") == "1"
+
+_run = None
+_lock = threading.Lock()
+
+
+def process_peak_rss_mb():
+    # ru_maxrss: the highest rss since the process started, not since instrument.start(). a warm
+    # lambda container reports the peak of every invocation it has served so far
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def reset_peak_rss():
+    # linux: restart the process's high-water mark (VmHWM) at its current rss, so
+    # peak_rss_since_reset_mb() covers only what runs after this. ru_maxrss can't be reset, and a
+    # child process starts out with its parent's. returns whether the reset worked
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_since_reset_mb():
+    # VmHWM: the peak rss since the last reset_peak_rss(), or since start. None off linux
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+class Run:
+    def __init__(self, pipeline, **fields):
+        self.pipeline = pipeline
+        self.fields = fields
+        self.started_at = dt.datetime.now(dt.timezone.utc)
+        self.stages = {}
+        self.counts = {}
+        self.error = None
+        self._start = time.perf_counter()
+
+    def add_stage(self, name, seconds):
+        # gbfs fetches run in threads
+        with _lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def add_count(self, name, value):
+        with _lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def record(self, ok=True):
+        status = "error" if self.error else ("ok" if ok else "failed")
+        return {
+            "pipeline": self.pipeline,
+            "started_at": self.started_at.isoformat(),
+            "duration_s": round(time.perf_counter() - self._start, 4),
+            "status": status,
+            "error": self.error,
+            "process_peak_rss_mb": process_peak_rss_mb(),
+            "stages": {name: round(s, 4) for name, s in self.stages.items()},
+            "counts": self.counts,
+            **self.fields,
+        }
+
+
+def start(pipeline, **fields):
+    # extra fields (cold_start...) go into the record as they are
+    global _run
+    _run = Run(pipeline, **fields)
+    return _run
+
+
+@contextmanager
+def stage(name):
+    run = _run
+    if run is None:
+        yield
+        return
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        run.add_stage(name, time.perf_counter() - start_time)
+
+
+def count(name, value):
+    if _run is not None and value is not None:
+        _run.add_count(name, value)
+
+
+def fail(error):
+    if _run is not None:
+        _run.error = str(error)
+
+
+def write_run_log(conn, record):
+    # own transaction, after the run's work is committed; losing it never fails the run
+    try:
+        with conn:
+            with conn.cursor() as curs:
+                curs.execute("""
+                    INSERT INTO pipeline_run_log (pipeline, started_at, duration_s, status, process_peak_rss_mb, record)
+                    VALUES (%s, %s, %s, %s, %s, %s);
+                """, (record["pipeline"], record["started_at"], record["duration_s"], record["status"],
+                      record["process_peak_rss_mb"], json.dumps(record)))
+    except Exception as e:
+        print(f"Couldn't write pipeline_run_log: {e}")
+
+
+def finish(ok=True, conn=None):
+    global _run
+    if _run is None:
+        return None
+    record = _run.record(ok)
+    _run = None
+    print(json.dumps(record))
+    if RUN_LOG and conn is not None:
+        write_run_log(conn, record)
+    return record
+
+
+def _rows(result):
+    if hasattr(result, "height"):
+        return result.height
+    if isinstance(result, tuple):
+        return [getattr(r, "height", None) for r in result]
+    return None
+
+
+def timed(name):
+    # dashboard loaders: one JSON line per call that actually runs (put it under st.cache_data
+    # so cache hits aren't logged)
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start_time = time.perf_counter()
+            status = "ok"
+            rows = None
+            try:
+                result = fn(*args, **kwargs)
+                rows = _rows(result)
+                return result
+            except Exception:
+                status = "error"
+                raise
+            finally:
+                print(json.dumps({
+                    "loader": name,
+                    "status": status,
+                    "duration_s": round(time.perf_counter() - start_time, 4),
+                    "rows": rows,
+                }))
+        return wrapper
+    return decorator
@@ -0,0 +1,95 @@
+# new-snapshot notifications over postgres LISTEN / NOTIFY
+#  - the ingest calls notify_snapshot() inside its write transaction; postgres only delivers
+#    the notification once that transaction commits, so listeners never see a half-written run
+#  - the dashboard runs one SnapshotListener per process on its own connection (LISTEN needs a
+#    long-lived session, pooled connections get rolled back / recycled). every time snapshots
+#    arrive for its system it calls on_snapshot(version) once, then publishes the new version;
+#    sessions compare it against what they rendered instead of polling the db
+import json
+import time
+import select
+import threading
+
+CHANNEL = "station_snapshot"
+
+
+def notify_snapshot(curs, system_id, fetched_at):
+    # payload: {"system_id": ..., "fetched_at": iso timestamp}
+    payload = json.dumps({"system_id": system_id, "fetched_at": fetched_at.isoformat()})
+    curs.execute("SELECT pg_notify(%s, %s);", (CHANNEL, payload))
+
+
+class SnapshotListener:
+    def __init__(self, connect, system_id, on_snapshot=None, poll_timeout=30, retry_delay=5):
+        # connect() -> new psycopg2 connection
+        self._connect = connect
+        self._system_id = system_id
+        self._on_snapshot = on_snapshot
+        self._poll_timeout = poll_timeout
+        self._retry_delay = retry_delay
+        self.version = 0
+        self.fetched_at = None
+        self.connected = False
+        self._listened = False
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="snapshot-listener", daemon=True)
+            self._thread.start()
+        return self
+
+    def _publish(self, fetched_at):
+        version = self.version + 1
+        if self._on_snapshot is not None:
+            try:
+                self._on_snapshot(version)
+            except Exception as e:
+                print(f"snapshot listener: refresh failed, {e}")
+        self.fetched_at = fetched_at
+        self.version = version
+
+    def _matches(self, notify):
+        try:
+            payload = json.loads(notify.payload)
+        except ValueError:
+            return None
+        if payload.get("system_id") != self._system_id:
+            return None
+        return payload.get("fetched_at")
+
+    def _listen(self, conn):
+        conn.autocommit = True
+        with conn.cursor() as curs:
+            curs.execute(f"LISTEN {CHANNEL};")
+        if self._listened:
+            # reconnected: snapshots may have been announced while we were away
+            self._publish(self.fetched_at)
+        self._listened = True
+        self.connected = True
+        while True:
+            if select.select([conn], [], [], self._poll_timeout) == ([], [], []):
+                # idle: make sure the connection is still there
+                with conn.cursor() as curs:
+                    curs.execute("SELECT 1;")
+            conn.poll()
+            # everything that arrived together is one refresh, however many notifications
+            fetched_at = None
+            while conn.notifies:
+                fetched_at = self._matches(conn.notifies.pop(0)) or fetched_at
+            if fetched_at is not None:
+                self._publish(fetched_at)
+
+    def _run(self):
+        while True:
+            conn = None
+            try:
+                conn = self._connect()
+                self._listen(conn)
+            except Exception as e:
+                print(f"snapshot listener: {e}, reconnecting in {self._retry_delay}s")
+            finally:
+                self.connected = False
+                if conn is not None:
+                    conn.close()
+            time.sleep(self._retry_delay)
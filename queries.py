@@ -0,0 +1,111 @@
+# sql behind the dashboard loaders, kept here so bench/ can EXPLAIN the exact same queries
+#
+# the ingest can cover several gbfs systems, every query here is for one of them (%(system_id)s)
+#
+# the latest snapshot comes from station_current (one row per station, upserted by the ingest in
+# the same transaction as the log), a fixed ~1,000-row read however long the history gets.
+# stations that dropped out of the feed keep an older fetched_at and are left out
+
+LATEST_SNAPSHOT = """
+    SELECT c.station_id, s.name, s.lat, s.lon, s.capacity, c.bikes_av, c.docks_av, c.is_functional,
+           c.fetched_at, c.changed_at
+    FROM station_current c
+    JOIN station s USING (station_id)
+    WHERE c.system_id = %(system_id)s
+      AND c.fetched_at = (SELECT MAX(fetched_at) FROM station_current WHERE system_id = %(system_id)s);
+"""
+
+# full (re)load: the newest %(max_rows)s rows, a backward scan of the (system_id, fetched_at)
+# index that stops there instead of reading the whole log, handed back oldest first
+AGGREGATE_HISTORY = """
+    SELECT * FROM (
+        SELECT total_bikes_av, total_docks_av, empty_stations, full_stations, fetched_at
+        FROM system_aggregate_log
+        WHERE system_id = %(system_id)s
+        ORDER BY fetched_at DESC
+        LIMIT %(max_rows)s
+    ) newest
+    ORDER BY fetched_at ASC;
+"""
+
+# incremental refresh: only the rows after the newest one already loaded
+AGGREGATE_HISTORY_SINCE = """
+    SELECT total_bikes_av, total_docks_av, empty_stations, full_stations, fetched_at
+    FROM system_aggregate_log
+    WHERE system_id = %(system_id)s AND fetched_at > %(since)s
+    ORDER BY fetched_at ASC;
+"""
+
+# hourly / daily buckets for long ranges, averaged so they chart like the raw rows
+ROLLUP_HISTORY = """
+    SELECT bucket AS fetched_at,
+           total_bikes_av_sum::float / samples AS total_bikes_av,
+           total_docks_av_sum::float / samples AS total_docks_av,
+           empty_stations_sum::float / samples AS empty_stations,
+           full_stations_sum::float / samples AS full_stations
+    FROM system_aggregate_rollup
+    WHERE system_id = %(system_id)s AND resolution = %(resolution)s AND bucket >= %(start)s
+    ORDER BY bucket ASC;
+"""
+
+# one station's samples: the complete days from station_series (only the day rows the window
+# touches), the rest from the logs through their (station_id, time) indexes. the cleaner fills
+# station_series once a day, so that's the day still going (and whatever it hasn't filled yet)
+_STATION_SERIES = """
+    WITH tail AS (
+        SELECT GREATEST(%(start)s::timestamptz,
+                        COALESCE((MAX(day) + 1)::timestamp AT TIME ZONE 'America/Toronto', '-infinity')) AS since
+        FROM station_series
+        WHERE station_id = %(station_id)s
+    )
+    SELECT t.fetched_at, t.bikes_av
+    FROM station_series s,
+         unnest(s.ts, s.bikes_av) AS t (fetched_at, bikes_av)
+    WHERE s.station_id = %(station_id)s
+      AND s.day >= (%(start)s::timestamptz AT TIME ZONE 'America/Toronto')::date
+      AND t.fetched_at > %(start)s
+    UNION ALL
+    SELECT l.fetched_at, l.bikes_av::smallint
+    FROM station_status_log l, tail
+    WHERE l.station_id = %(station_id)s AND l.fetched_at >= tail.since AND l.fetched_at > %(start)s{changes}
+    ORDER BY fetched_at ASC;
+"""
+
+STATION_SERIES = _STATION_SERIES.format(changes="")
+
+# the same plus the change log, for databases with station_status_change (sql/004, only filled
+# in delta mode): the dashboard picks this one when CHANGE_LOG_EXISTS says the table is there
+STATION_SERIES_WITH_CHANGES = _STATION_SERIES.format(changes="""
+    UNION ALL
+    SELECT c.changed_at, c.bikes_av::smallint
+    FROM station_status_change c, tail
+    WHERE c.station_id = %(station_id)s AND c.changed_at >= tail.since AND c.changed_at > %(start)s""")
+
+CHANGE_LOG_EXISTS = "SELECT to_regclass('station_status_change') IS NOT NULL AS change_log;"
+
+# per-cell totals of the latest snapshot (cell_current, grid.py) at one geohash precision: a few
+# hundred rows for the zoomed-out map however many stations there are
+CELL_SNAPSHOT = """
+    SELECT cell, stations, functional_stations, bikes_av, docks_av, empty_stations, full_stations,
+           lat, lon, fetched_at
+    FROM cell_current
+    WHERE system_id = %(system_id)s AND precision = %(precision)s
+      AND fetched_at = (SELECT MAX(fetched_at) FROM cell_current
+                        WHERE system_id = %(system_id)s AND precision = %(precision)s);
+"""
+
+# functional stations with more than %(min_bikes)s bikes in the given precision-6 cells
+# (grid.nearby_cells), nearest first: the station (system_id, left(geohash, 6)) index finds the
+# candidates, the distance is only computed for those
+NEARBY_STATIONS = """
+    SELECT s.station_id, s.name, s.lat, s.lon, c.bikes_av, c.docks_av,
+           sqrt((s.lat - %(lat)s) ^ 2 + ((s.lon - %(lon)s) * %(lon_scale)s) ^ 2) * 111195 AS distance_m
+    FROM station s
+    JOIN station_current c USING (station_id)
+    WHERE s.system_id = %(system_id)s
+      AND left(s.geohash, 6) = ANY(%(cells)s)
+      AND c.is_functional AND c.bikes_av > %(min_bikes)s
+      AND c.fetched_at = (SELECT MAX(fetched_at) FROM station_current WHERE system_id = %(system_id)s)
+    ORDER BY distance_m
+    LIMIT %(limit)s;
+"""
@@ -0,0 +1,203 @@
+# offline replay over the parquet snapshot archive written by serverless/archive.py
+# everything is a lazy polars scan, so only the columns / date partitions a query needs are read
+#
+#   python replay.py aggregates ARCHIVE_ROOT [--since 2025-11-01] [--out aggregates.csv]
+#   python replay.py flows ARCHIVE_ROOT [--since 2025-11-01] [--out flows.csv]
+#   python replay.py compact ARCHIVE_ROOT 2025-11-03
+#
+# the Archive class can also stand in for the dashboard's DatabasePool (BIXI_ARCHIVE=<root>),
+# which runs the whole dashboard locally without postgres
+import os
+import sys
+import glob
+import datetime as dt
+
+import polars as pl
+
+import flow
+import grid
+import queries
+
+STRESS_THRESHOLD = 3
+TIMEZONE = "America/Toronto"
+# the queries.py statements Archive.read_frame answers
+SERVED_QUERIES = (
+    "LATEST_SNAPSHOT", "AGGREGATE_HISTORY", "AGGREGATE_HISTORY_SINCE", "ROLLUP_HISTORY",
+    "CHANGE_LOG_EXISTS", "STATION_SERIES", "STATION_SERIES_WITH_CHANGES", "CELL_SNAPSHOT",
+    "NEARBY_STATIONS",
+)
+
+
+class Archive:
+    def __init__(self, root):
+        self.root = root.rstrip("/")
+
+    def scan(self, since=None):
+        lf = pl.scan_parquet(f"{self.root}/**/*.parquet", hive_partitioning=True)
+        if since is not None:
+            since = since.astimezone(dt.timezone.utc)
+            # prune whole date=... directories first, then rows
+            lf = lf.filter(pl.col("date") >= since.date()).filter(pl.col("fetched_at") > since)
+        return lf.with_columns(
+            pl.col("station_id").cast(pl.String),
+            pl.col("name").cast(pl.String),
+        )
+
+    def latest_snapshot(self):
+        lf = self.scan()
+        # like station_current.changed_at: the last snapshot where a station's values differed
+        # from its previous one
+        values = ("bikes_av", "docks_av", "is_functional")
+        changed_at = (
+            lf.sort("fetched_at")
+            .filter(pl.any_horizontal([pl.col(c).ne_missing(pl.col(c).shift().over("station_id")) for c in values]))
+            .group_by("station_id")
+            .agg(pl.col("fetched_at").max().alias("changed_at"))
+        )
+        return (
+            lf.filter(pl.col("fetched_at") == pl.col("fetched_at").max())
+            .join(changed_at, on="station_id", how="left")
+            .select("station_id", "name", "lat", "lon", "capacity", "bikes_av", "docks_av", "is_functional",
+                    "fetched_at", "changed_at")
+            .collect()
+        )
+
+    def cells(self, precision, threshold=STRESS_THRESHOLD):
+        # cell_current at one precision, from the newest snapshot
+        latest = self.scan().filter(pl.col("fetched_at") == pl.col("fetched_at").max()).collect()
+        return (
+            grid.cell_aggregates(latest.with_columns(pl.lit("").alias("system_id")), (precision,), threshold)
+            .drop("system_id", "precision")
+        )
+
+    def nearby(self, cells, lat, lon, lon_scale, min_bikes, limit):
+        # NEARBY_STATIONS: the archive has no index, filtering the newest snapshot is as good
+        latest = self.scan().filter(pl.col("fetched_at") == pl.col("fetched_at").max()).collect()
+        return (
+            grid.with_geohash(latest)
+            .filter(
+                pl.col("geohash").str.slice(0, grid.NEAR_PRECISION).is_in(cells)
+                & pl.col("is_functional") & (pl.col("bikes_av") > min_bikes)
+            )
+            .with_columns(
+                (((pl.col("lat") - lat) ** 2 + ((pl.col("lon") - lon) * lon_scale) ** 2).sqrt() * 111195)
+                .alias("distance_m")
+            )
+            .sort("distance_m")
+            .head(limit)
+            .select("station_id", "name", "lat", "lon", "bikes_av", "docks_av", "distance_m")
+        )
+
+    def aggregate_history(self, since=None, threshold=STRESS_THRESHOLD):
+        # same numbers as system_aggregate_log, one row per snapshot
+        return (
+            self.scan(since)
+            .group_by("fetched_at")
+            .agg(
+                pl.col("bikes_av").sum().alias("total_bikes_av"),
+                pl.col("docks_av").sum().alias("total_docks_av"),
+                (pl.col("bikes_av") < threshold).sum().alias("empty_stations"),
+                (pl.col("docks_av") < threshold).sum().alias("full_stations"),
+            )
+            .sort("fetched_at")
+            .select("total_bikes_av", "total_docks_av", "empty_stations", "full_stations", "fetched_at")
+            .collect()
+        )
+
+    def flows(self, since=None):
+        # station_flow_log rows, recomputed over the whole archive range in one pass
+        lf = self.scan(since).select("station_id", "bikes_av", "docks_av", "fetched_at")
+        return flow.station_flows(lf).collect()
+
+    def rollup_history(self, resolution, start):
+        # averages per hour / Montreal day, like system_aggregate_rollup
+        every = {"hour": "1h", "day": "1d"}[resolution]
+        agg = self.aggregate_history(since=start).with_columns(
+            pl.col("fetched_at").dt.convert_time_zone(TIMEZONE)
+        )
+        return (
+            agg.group_by_dynamic("fetched_at", every=every)
+            .agg(pl.col("total_bikes_av", "total_docks_av", "empty_stations", "full_stations").mean())
+        )
+
+    def station_series(self, station_id, start):
+        return (
+            self.scan(since=start)
+            .filter(pl.col("station_id") == station_id)
+            .select("fetched_at", "bikes_av")
+            .sort("fetched_at")
+            .collect()
+        )
+
+    def read_frame(self, query, params=None, **kwargs):
+        # DatabasePool stand-in: answer the dashboard's queries from the archive
+        # (the archive only holds the ingest's primary system, params["system_id"] isn't needed)
+        params = params or {}
+        if query == queries.LATEST_SNAPSHOT:
+            return self.latest_snapshot()
+        if query == queries.AGGREGATE_HISTORY:
+            return self.aggregate_history().tail(params["max_rows"])
+        if query == queries.AGGREGATE_HISTORY_SINCE:
+            return self.aggregate_history(since=params["since"])
+        if query == queries.ROLLUP_HISTORY:
+            return self.rollup_history(params["resolution"], params["start"])
+        if query == queries.CHANGE_LOG_EXISTS:
+            return pl.DataFrame({"change_log": [False]})
+        if query in (queries.STATION_SERIES, queries.STATION_SERIES_WITH_CHANGES):
+            return self.station_series(params["station_id"], params["start"])
+        if query == queries.CELL_SNAPSHOT:
+            return self.cells(params["precision"])
+        if query == queries.NEARBY_STATIONS:
+            return self.nearby(params["cells"], params["lat"], params["lon"], params["lon_scale"],
+                               params["min_bikes"], params["limit"])
+        raise ValueError(f"the parquet archive only serves queries.{{{', '.join(SERVED_QUERIES)}}}, "
+                         f"not: {query.strip()[:80]}")
+
+    def compact(self, day):
+        # merge one day's per-snapshot files into a single file (fewer objects to list / open)
+        directory = f"{self.root}/date={day}"
+        files = sorted(glob.glob(f"{directory}/*.parquet"))
+        if len(files) <= 1:
+            return None
+        merged = pl.concat([pl.read_parquet(f) for f in files], how="vertical_relaxed").sort("fetched_at")
+        target = f"{directory}/compacted.parquet"
+        tmp = target + ".tmp"
+        merged.write_parquet(tmp, compression="zstd", statistics=True)
+        for f in files:
+            os.remove(f)
+        os.replace(tmp, target)
+        return target
+
+
+def main(argv):
+    if len(argv) < 3 or argv[1] not in ("aggregates", "flows", "compact"):
+        print("usage: replay.py aggregates|flows ARCHIVE_ROOT [--since DATE] [--out FILE] | compact ARCHIVE_ROOT DATE")
+        return 1
+
+    archive = Archive(argv[2])
+    if argv[1] == "compact":
+        print(archive.compact(argv[3]))
+        return 0
+
+    since = None
+    out = None
+    rest = argv[3:]
+    if "--since" in rest:
+        since = dt.datetime.fromisoformat(rest[rest.index("--since") + 1]).replace(tzinfo=dt.timezone.utc)
+    if "--out" in rest:
+        out = rest[rest.index("--out") + 1]
+
+    if argv[1] == "flows":
+        result, what = archive.flows(since=since), "flow"
+    else:
+        result, what = archive.aggregate_history(since=since), "aggregate"
+    if out:
+        result.write_csv(out)
+        print(f"Wrote {result.height} {what} rows to {out}.")
+    else:
+        print(result)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
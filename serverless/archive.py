@@ -0,0 +1,31 @@
+# optional parquet archive of every snapshot, for long-term retention and offline replay
+# (see replay.py at the repo root). ARCHIVE_ROOT is a local directory or an s3://bucket/prefix
+# url; unset means no archive. layout is hive-style, one zstd file per snapshot:
+#   <root>/date=2025-11-03/20251103T153947Z.parquet
+import os
+import datetime as dt
+
+ARCHIVE_ROOT = os.environ.get("ARCHIVE_ROOT")
+
+ARCHIVE_COLUMNS = ("station_id", "name", "lat", "lon", "capacity", "bikes_av", "docks_av", "is_functional")
+
+
+def snapshot_path(root, fetch_timestamp):
+    utc = fetch_timestamp.astimezone(dt.timezone.utc)
+    return f"{root.rstrip('/')}/date={utc:%Y-%m-%d}/{utc:%Y%m%dT%H%M%SZ}.parquet"
+
+
+def archive_snapshot(df, fetch_timestamp, root=ARCHIVE_ROOT):
+    import polars as pl
+
+    path = snapshot_path(root, fetch_timestamp)
+    frame = df.select(ARCHIVE_COLUMNS).with_columns(
+        # categorical -> dictionary-encoded in parquet, ids and names are the same every snapshot
+        pl.col("station_id").cast(pl.Categorical),
+        pl.col("name").cast(pl.Categorical),
+        pl.lit(fetch_timestamp).dt.convert_time_zone("UTC").alias("fetched_at"),
+    )
+    if "://" not in path:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    frame.write_parquet(path, compression="zstd", statistics=True)
+    return path
@@ -0,0 +1,54 @@
+# change-only storage (STORAGE_MODE=delta): instead of ~1000 station_status_log rows per
+# snapshot, write only the stations whose bikes / docks / is_functional changed since the
+# previous snapshot to station_status_change. station_status_at(ts) in the db rebuilds the
+# full snapshot at any point in time from it.
+#
+# the previous state is each station's row in station_current, read in the same transaction
+# before current.upsert_current overwrites it (current.previous_state, shared with the flows).
+# whichever container runs the schedule, it diffs against what is actually stored. the first
+# write of each Montreal day (and the first one ever) is a keyframe with every station in it,
+# so reconstruction never needs more than a day of changes and old ones can simply be deleted
+import io
+import os
+
+STORAGE_MODE = os.environ.get("STORAGE_MODE", "full")
+
+STATE_COLUMNS = ("station_id", "bikes_av", "docks_av", "is_functional")
+CHANGE_COLUMNS = STATE_COLUMNS + ("changed_at",)
+
+
+def changed_stations(df, baseline):
+    # stations that are new or differ in any tracked column, vectorized with one join
+    import polars as pl
+    current = df.select(STATE_COLUMNS + ("fetched_at",))
+    known = baseline.select(STATE_COLUMNS).with_columns(pl.lit(True).alias("known"))
+    joined = current.join(known, on="station_id", how="left", suffix="_prev")
+    changed = pl.col("known").is_null()
+    for col in STATE_COLUMNS[1:]:
+        changed = changed | pl.col(col).ne_missing(pl.col(f"{col}_prev"))
+    return joined.filter(changed).select(STATE_COLUMNS + ("fetched_at",))
+
+
+def is_keyframe(df, previous):
+    # no stored state yet, or the stored one is from an earlier day (in the snapshot's time zone)
+    if previous.is_empty():
+        return True
+    fetched_at = df.get_column("fetched_at").max()
+    return previous.get_column("fetched_at").max().astimezone(fetched_at.tzinfo).date() != fetched_at.date()
+
+
+def write_changes(curs, df, previous):
+    # df carries fetched_at per row (every system has its own), previous is
+    # current.previous_state(curs, df); returns (rows written, keyframe)
+    keyframe = is_keyframe(df, previous)
+    if keyframe:
+        rows = df.select(STATE_COLUMNS + ("fetched_at",))
+    else:
+        rows = changed_stations(df, previous)
+
+    if not rows.is_empty():
+        buf = io.BytesIO()
+        rows.write_csv(buf, include_header=False)
+        buf.seek(0)
+        curs.copy_expert(f"COPY station_status_change ({', '.join(CHANGE_COLUMNS)}) FROM STDIN WITH (FORMAT csv)", buf)
+    return rows.height, keyframe
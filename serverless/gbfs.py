@@ -0,0 +1,204 @@
+# gbfs client: fetches station_information and station_status of every configured system
+# concurrently and skips whatever hasn't changed since last time
+#  - GBFS_SYSTEMS="bixi=https://.../gbfs.json,other=https://.../gbfs.json": feed urls come from
+#    each system's gbfs.json auto-discovery file (re-read hourly). the first system is the
+#    primary one, the one the dashboard shows. unset = bixi only, straight from GBFS_BASE_URL
+#  - inside the feed's ttl window we don't even make the request
+#  - otherwise a conditional GET (ETag / If-Modified-Since), 304 means unchanged
+#  - a 200 with the same last_updated also counts as unchanged
+# payloads are decoded by gbfs_decode into typed frames with only the columns the ingest uses
+# station_information is cached as a parsed frame, in memory for warm containers and
+# under /tmp for cold ones (lambda keeps /tmp around as long as the sandbox lives)
+import os
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import instrument
+import gbfs_decode
+
+GBFS_BASE_URL = os.environ.get("GBFS_BASE_URL", "https://gbfs.velobixi.com/gbfs/2-2/en")
+CACHE_DIR = os.environ.get("GBFS_CACHE_DIR", "/tmp/gbfs")
+REQUEST_TIMEOUT = 10
+# at most this many requests in flight, across all systems
+WORKERS = int(os.environ.get("GBFS_WORKERS", "8"))
+LANGUAGE = gbfs_decode.LANGUAGE
+DISCOVERY_TTL = 3600
+
+FEEDS = ("station_information", "station_status")
+
+
+def parse_systems(value):
+    # "bixi=https://.../gbfs.json,other=..." -> [(system_id, discovery url)]
+    systems = []
+    for item in value.split(","):
+        system_id, _, url = item.strip().partition("=")
+        if system_id:
+            systems.append((system_id.strip(), url.strip() or None))
+    return systems
+
+
+SYSTEMS = parse_systems(os.environ.get("GBFS_SYSTEMS", "")) or [("bixi", None)]
+PRIMARY_SYSTEM = SYSTEMS[0][0]
+
+# (system_id, feed name) -> {"etag", "last_modified", "last_updated", "ttl", "frame"}
+_feeds = {}
+# system_id -> {"urls": {feed name: url}, "expires": epoch seconds}
+_discovery = {}
+
+
+def _meta_path(system_id, feed):
+    return os.path.join(CACHE_DIR, system_id, f"{feed}.json")
+
+
+def _frame_path(system_id, feed):
+    return os.path.join(CACHE_DIR, system_id, f"{feed}.arrow")
+
+
+def _load_disk_cache(system_id, feed, keep_frame):
+    import polars as pl
+    try:
+        with open(_meta_path(system_id, feed)) as f:
+            state = json.load(f)
+        state["frame"] = pl.read_ipc(_frame_path(system_id, feed)) if keep_frame else None
+        return state
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"Ignoring unreadable {system_id}/{feed} cache: {e}")
+        return None
+
+
+def _save_disk_cache(system_id, feed, state):
+    # write-then-rename so a killed invocation never leaves a half-written cache
+    try:
+        os.makedirs(os.path.join(CACHE_DIR, system_id), exist_ok=True)
+        if state["frame"] is not None:
+            tmp = _frame_path(system_id, feed) + ".tmp"
+            state["frame"].write_ipc(tmp)
+            os.replace(tmp, _frame_path(system_id, feed))
+        tmp = _meta_path(system_id, feed) + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({k: v for k, v in state.items() if k != "frame"}, f)
+        os.replace(tmp, _meta_path(system_id, feed))
+    except OSError as e:
+        print(f"Couldn't persist {system_id}/{feed} cache: {e}")
+
+
+def _cached_state(system_id, feed, keep_frame):
+    key = (system_id, feed)
+    if key not in _feeds:
+        state = _load_disk_cache(system_id, feed, keep_frame)
+        if state is not None:
+            _feeds[key] = state
+    return _feeds.get(key)
+
+
+def feed_urls(session, system_id, discovery_url):
+    # {feed name: url} from the system's gbfs.json, kept for DISCOVERY_TTL (or the file's ttl if longer)
+    if discovery_url is None:
+        return {feed: f"{GBFS_BASE_URL}/{feed}.json" for feed in FEEDS}
+    cached = _discovery.get(system_id)
+    if cached is not None and time.time() < cached["expires"]:
+        return cached["urls"]
+
+    with instrument.stage("discovery.http"):
+        response = session.get(discovery_url, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    payload = response.json()
+    data = payload["data"]
+    # v1 / v2 group the feed list by language, v3 has it directly under data
+    if "feeds" in data:
+        feeds = data["feeds"]
+    else:
+        feeds = (data.get(LANGUAGE) or next(iter(data.values())))["feeds"]
+    urls = {f["name"]: f["url"] for f in feeds}
+    _discovery[system_id] = {"urls": urls, "expires": time.time() + max(payload.get("ttl", 0), DISCOVERY_TTL)}
+    return urls
+
+
+def fetch_feed(session, system_id, feed, url, schema, keep_frame):
+    # returns (frame, last_updated, changed, state)
+    # frame is None when the feed is unchanged and we don't keep a copy of it. state is the new
+    # cache entry of a changed feed, only stored by commit() once its snapshot is in the db
+    state = _cached_state(system_id, feed, keep_frame)
+    now = time.time()
+
+    if state is not None and now < state["last_updated"] + state["ttl"]:
+        print(f"{system_id}/{feed}: within ttl, not requesting.")
+        return state["frame"], state["last_updated"], False, None
+
+    headers = {}
+    if state is not None:
+        if state.get("etag"):
+            headers["If-None-Match"] = state["etag"]
+        if state.get("last_modified"):
+            headers["If-Modified-Since"] = state["last_modified"]
+
+    with instrument.stage(f"{feed}.http"):
+        response = session.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+    if response.status_code == 304 and state is not None:
+        print(f"{system_id}/{feed}: 304 not modified.")
+        return state["frame"], state["last_updated"], False, None
+    response.raise_for_status()
+
+    instrument.count(f"{feed}.bytes", len(response.content))
+    with instrument.stage(f"{feed}.parse"):
+        last_updated, ttl, frame = gbfs_decode.decode(response.content, schema)
+    if state is not None and last_updated <= state["last_updated"]:
+        print(f"{system_id}/{feed}: last_updated hasn't advanced ({last_updated}).")
+        return state["frame"], state["last_updated"], False, None
+
+    state = {
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+        "last_updated": last_updated,
+        "ttl": ttl,
+        "frame": frame if keep_frame else None,
+    }
+    return frame, last_updated, True, state
+
+
+def commit(system_id, feed, state):
+    # remember a fetched feed, in memory and under CACHE_DIR
+    if state is not None:
+        _feeds[(system_id, feed)] = state
+        _save_disk_cache(system_id, feed, state)
+
+
+def fetch_feeds(session, systems=None):
+    # every feed of every system on one bounded pool
+    # returns ({system_id: (info_df, info_changed, status_df, status_last_updated)}, pending):
+    # status_df is None when station_status hasn't advanced; a system that failed maps to None
+    # and doesn't hold up the others. pending = {system_id: [(feed, state)]}, the new cache
+    # entries, for the caller to commit() once the snapshot is stored. until then the next run
+    # fetches the same feeds again: a failed transform / write, a timeout or a killed
+    # invocation can't leave a snapshot marked as seen without it being in the db
+    systems = systems or SYSTEMS
+    results = {}
+    pending = {}
+    with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+        discovered = {system_id: pool.submit(feed_urls, session, system_id, url) for system_id, url in systems}
+        jobs = {}
+        for system_id, urls in discovered.items():
+            try:
+                urls = urls.result()
+                jobs[system_id] = (
+                    pool.submit(fetch_feed, session, system_id, "station_information",
+                                urls["station_information"], gbfs_decode.INFO_SCHEMA, True),
+                    pool.submit(fetch_feed, session, system_id, "station_status",
+                                urls["station_status"], gbfs_decode.STATUS_SCHEMA, False),
+                )
+            except Exception as e:
+                print(f"{system_id}: feed discovery failed, {e}")
+                results[system_id] = None
+        for system_id, (info, status) in jobs.items():
+            try:
+                info_df, _, info_changed, info_state = info.result()
+                status_df, status_updated, _, status_state = status.result()
+                results[system_id] = (info_df, info_changed, status_df, status_updated)
+                pending[system_id] = [("station_information", info_state), ("station_status", status_state)]
+            except Exception as e:
+                print(f"{system_id}: fetch failed, {e}")
+                results[system_id] = None
+    return results, pending
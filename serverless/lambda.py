@@ -1,34 +1,238 @@
+import time
+
+_MODULE_START = time.perf_counter()
+
+import io
 import os
-import requests
 import datetime as dt
-import polars as pl
-import psycopg2
-import psycopg2.extras
-import pytz
+from concurrent.futures import ThreadPoolExecutor
+
+import archive
+import current
+import delta
+import flow
+import gbfs
+import grid
+import instrument
+import notify
+import resources
+import rollups
+
+_MODULE_INIT_S = time.perf_counter() - _MODULE_START
+
+# polars, psycopg2, requests and pytz are imported inside the functions that use them, here and
+# in every module imported above (flow, gbfs_decode and grid too): _MODULE_INIT_S stays small and
+# the "import" stage in handler() is what loading them costs on a cold start
+_cold_start = True
+
+# static per-station attributes live in the station table, the log only keeps the station_id
+# one run covers every system in gbfs.SYSTEMS, the frames carry system_id and fetched_at per row.
+# station ids of systems other than the primary one are stored as "<system_id>:<station_id>" so
+# the per-station tables stay keyed on station_id alone
+STATUS_LOG_COLUMNS = ("system_id", "station_id", "bikes_av", "docks_av", "is_functional", "fetched_at")
+STATION_COLUMNS = ("station_id", "system_id", "name", "lat", "lon", "capacity", "geohash")
+AGGREGATE_COLUMNS = ("system_id", "total_bikes_av", "total_docks_av", "empty_stations", "full_stations", "fetched_at")
+
+# "copy" streams the frame with COPY FROM STDIN, "batch" is the old execute_batch path
+INSERT_MODE = os.environ.get("INSERT_MODE", "copy")
+
+
+def _log_frame(df, fetch_timestamp):
+    # a bare single-snapshot frame (bench, older callers) gets the primary system and fetch_timestamp
+    import polars as pl
+    missing = []
+    if "system_id" not in df.columns:
+        missing.append(pl.lit(gbfs.PRIMARY_SYSTEM).alias("system_id"))
+    if "fetched_at" not in df.columns:
+        missing.append(pl.lit(fetch_timestamp).alias("fetched_at"))
+    return df.with_columns(missing).select(STATUS_LOG_COLUMNS)
+
+
+def copy_snapshot(curs, df, fetch_timestamp=None):
+    # frame -> csv bytes in polars, no python tuples per row
+    buf = io.BytesIO()
+    _log_frame(df, fetch_timestamp).write_csv(buf, include_header=False)
+    buf.seek(0)
+    command = f"COPY station_status_log ({', '.join(STATUS_LOG_COLUMNS)}) FROM STDIN WITH (FORMAT csv)"
+    curs.copy_expert(command, buf)
+    return df.height
+
+
+def batch_insert_snapshot(curs, df, fetch_timestamp=None):
+    import psycopg2.extras
+    command = f"""
+        INSERT INTO station_status_log
+        ({', '.join(STATUS_LOG_COLUMNS)}) 
+        VALUES ({', '.join(['%s'] * len(STATUS_LOG_COLUMNS))}); 
+        """
+    data_to_insert = _log_frame(df, fetch_timestamp).rows()
+    psycopg2.extras.execute_batch(curs, command, data_to_insert)
+    return len(data_to_insert)
+
+
+def insert_snapshot(curs, df, fetch_timestamp=None, mode=INSERT_MODE):
+    import psycopg2
+    if mode == "copy":
+        # savepoint so a failed COPY doesn't poison the transaction for the fallback
+        curs.execute("SAVEPOINT copy_snapshot;")
+        try:
+            n = copy_snapshot(curs, df, fetch_timestamp)
+            curs.execute("RELEASE SAVEPOINT copy_snapshot;")
+            return n
+        except (Exception, psycopg2.Error) as error:
+            print(f"COPY failed ({error}), falling back to execute_batch.")
+            curs.execute("ROLLBACK TO SAVEPOINT copy_snapshot;")
+    return batch_insert_snapshot(curs, df, fetch_timestamp)
+
+
+def upsert_stations(curs, info_df):
+    import psycopg2.extras
+    # only rows whose attributes actually changed get rewritten
+    command = f"""
+        INSERT INTO station ({', '.join(STATION_COLUMNS)}, updated_at)
+        VALUES %s
+        ON CONFLICT (station_id) DO UPDATE
+        SET system_id = EXCLUDED.system_id,
+            name = EXCLUDED.name,
+            lat = EXCLUDED.lat,
+            lon = EXCLUDED.lon,
+            capacity = EXCLUDED.capacity,
+            geohash = EXCLUDED.geohash,
+            updated_at = EXCLUDED.updated_at
+        WHERE (station.name, station.lat, station.lon, station.capacity, station.geohash)
+            IS DISTINCT FROM (EXCLUDED.name, EXCLUDED.lat, EXCLUDED.lon, EXCLUDED.capacity, EXCLUDED.geohash);
+    """
+    rows = info_df.select(STATION_COLUMNS).rows()
+    psycopg2.extras.execute_values(curs, command, rows, template="(%s, %s, %s, %s, %s, %s, %s, NOW())", page_size=1000)
+    return len(rows)
+
+
+# stations under this many bikes / docks count as empty / full
+STRESS_THRESHOLD = int(os.environ.get("STRESS_THRESHOLD", "3"))
+
+
+def aggregate_snapshots(df):
+    import polars as pl
+    # one row per system snapshot, same numbers the old SUM / COUNT FILTER query produced
+    return df.group_by("system_id", "fetched_at", maintain_order=True).agg(
+        pl.col("bikes_av").sum().alias("total_bikes_av"),
+        pl.col("docks_av").sum().alias("total_docks_av"),
+        (pl.col("bikes_av") < STRESS_THRESHOLD).sum().alias("empty_stations"),
+        (pl.col("docks_av") < STRESS_THRESHOLD).sum().alias("full_stations"),
+    ).select(AGGREGATE_COLUMNS)
+
+
+def insert_aggregates(curs, agg):
+    import psycopg2.extras
+    insert_command = f"""
+        INSERT INTO system_aggregate_log ({', '.join(AGGREGATE_COLUMNS)})
+        VALUES %s
+    """
+    psycopg2.extras.execute_values(curs, insert_command, agg.rows(), page_size=1000)
+
+
+def write_snapshots(curs, df):
+    # everything derived from this run's snapshots, in the caller's transaction
+    # the stored state first, before current.upsert_current replaces it
+    with instrument.stage("previous_state"):
+        previous = current.previous_state(curs, df)
+    with instrument.stage("insert_snapshot"):
+        if delta.STORAGE_MODE == "delta":
+            n, keyframe = delta.write_changes(curs, df, previous)
+            print(f"Successfully inserted {n} changed stations{' (keyframe)' if keyframe else ''}.")
+        else:
+            n = insert_snapshot(curs, df)
+            print(f"Successfully inserted {n} rows.")
+    instrument.count("rows_written", n)
+    with instrument.stage("flow"):
+        n = flow.write_flows(curs, df, previous)
+    instrument.count("flow_rows", n)
+    with instrument.stage("current"):
+        current.upsert_current(curs, df)
+    with instrument.stage("cells"):
+        n = grid.upsert_cells(curs, grid.cell_aggregates(df, threshold=STRESS_THRESHOLD))
+    instrument.count("cells_upserted", n)
+    agg = aggregate_snapshots(df)
+    with instrument.stage("aggregate"):
+        insert_aggregates(curs, agg)
+        rollups.update_rollups(curs, agg)
+    systems = agg.get_column("system_id").unique(maintain_order=True).to_list()
+    print(f"Successfully inserted aggregate data for {', '.join(systems)}.")
+    # delivered by postgres on commit, so only for snapshots that made it
+    for system_id, fetched_at in agg.select("system_id", "fetched_at").iter_rows():
+        notify.notify_snapshot(curs, system_id, fetched_at)
+
+
+def load_dependencies():
+    # the heavy imports, timed by the caller; cheap no-ops once the container is warm
+    import polars
+    import psycopg2
+    import psycopg2.extras
+    import requests
+    import pytz
+
+
 def main():
+    import polars as pl
+    import psycopg2
+    import pytz
 
-    utc = pytz.utc
     montreal_tz = pytz.timezone("America/Toronto")
-    
-    def fetch(): 
-        bool = None
-        
-        station_info_url = 'https://gbfs.velobixi.com/gbfs/2-2/en/station_information.json'
-        info_response = requests.get(station_info_url)
-        stations_info_list = info_response.json()['data']['stations']
-        info_update_time = info_response.json()['last_updated']
+    session = resources.get_session()
+
+    def transform(system_id, feeds):
+        # -> (df or None, fetch_timestamp, stations or None); None = nothing new, False = this
+        # system failed. df is None when only station_information changed
+        if feeds is None:
+            return False
+        info_df, info_changed, status_df, status_update_time = feeds
+
+        try:
+            station_id = pl.col("station_id").cast(pl.String)
+            if system_id != gbfs.PRIMARY_SYSTEM:
+                station_id = pl.concat_str(pl.lit(f"{system_id}:"), station_id)
+
+            info_df = info_df.with_columns(
+                pl.col("lat").fill_null(0.0),
+                pl.col("lon").fill_null(0.0),
+            )
+            # the station table only needs touching when station_information changed,
+            # that's also the only time a station's cell can change. gbfs already counts the
+            # new info as seen, so it's upserted even if station_status hasn't moved
+            stations = None
+            if info_changed:
+                stations = grid.with_geohash(info_df.select(
+                    station_id.alias("station_id"),
+                    pl.lit(system_id).alias("system_id"),
+                    "name", "lat", "lon", "capacity",
+                ))
+        except Exception as e:
+            print(f"{system_id}: error processing station_information: {e}")
+            return False
 
-        station_status_url = 'https://gbfs.velobixi.com/gbfs/2-2/en/station_status.json'
-        status_response = requests.get(station_status_url)
-        stations_status_list = status_response.json()['data']['stations']
+        if status_df is None:
+            if stations is None:
+                print(f"{system_id}: station_status hasn't changed since the last run, nothing to write.")
+                return None
+            print(f"{system_id}: station_status hasn't changed since the last run, only upserting stations.")
+            return None, None, stations
 
         try:
-            df_info = pl.DataFrame(stations_info_list)
-            df_status = pl.DataFrame(stations_status_list)
+            utc_timestamp = dt.datetime.fromtimestamp(status_update_time, dt.timezone.utc)
+            fetch_timestamp = utc_timestamp.astimezone(montreal_tz)
+            print(f"{system_id}: timestamp converted to Montreal time: {fetch_timestamp}")
+        
+        except Exception as e:
+            print(f"{system_id}: error processing 'status_update_time': {e}. Using current time.")
+            utc_now = dt.datetime.now(dt.timezone.utc)
+            fetch_timestamp = utc_now.astimezone(montreal_tz)
 
-            df_merged = df_info.join(df_status, on="station_id", how="inner")
+        try:
+            df_merged = info_df.join(status_df, on="station_id", how="inner")
 
             df = df_merged.select(
+                pl.lit(system_id).alias("system_id"),
+                station_id.alias("station_id"),
                 pl.col("name"),
                 pl.col("lat").fill_null(0.0), 
                 pl.col("lon").fill_null(0.0), 
@@ -41,141 +245,124 @@ def main():
                     (pl.col("is_returning") == 1)
                 )
                 .alias("is_functional")
-                .fill_null(False) 
+                .fill_null(False),
+                pl.lit(fetch_timestamp).alias("fetched_at"),
             )
         except Exception as e:
-            print(f"Error processing data: {e}")
+            print(f"{system_id}: error processing data: {e}")
             return False
 
-        try:
-            montreal_tz = pytz.timezone("America/Toronto")
-            utc_timestamp = dt.datetime.fromtimestamp(info_update_time, dt.timezone.utc)
-            fetch_timestamp = utc_timestamp.astimezone(montreal_tz)
-            print(f"Timestamp converted to Montreal time: {fetch_timestamp}")
-        
-        except Exception as e:
-            print(f"Error processing 'info_update_time': {e}. Using current time.")
-            montreal_tz = pytz.timezone("America/Toronto")
-            utc_now = dt.datetime.now(dt.timezone.utc)
-            fetch_timestamp = utc_now.astimezone(montreal_tz)
+        return df, fetch_timestamp, stations
+
+    def fetch():
+        # returns ({system_id: snapshot} for the systems with something new, [failed system_ids],
+        # the feed states to commit once the snapshots are stored)
+        with instrument.stage("fetch"):
+            feeds, pending = gbfs.fetch_feeds(session)
+        # polars releases the gil, the per-system joins overlap too
+        with instrument.stage("transform"), ThreadPoolExecutor(max_workers=gbfs.WORKERS) as pool:
+            results = dict(zip(feeds, pool.map(transform, feeds, feeds.values())))
+        snapshots = {system_id: r for system_id, r in results.items() if r}
+        failed = [system_id for system_id, r in results.items() if r is False]
+        return snapshots, failed, pending
+
+    def store(snapshots):
+        # one connection, one transaction, one bulk statement per table for all systems:
+        # the snapshots and their aggregates land together or not at all
+        # systems where only station_information changed bring stations and no snapshot
+        frames = [df for df, _, _ in snapshots.values() if df is not None]
+        df = pl.concat(frames, how="vertical_relaxed") if frames else None
+        stations = [s for _, _, s in snapshots.values() if s is not None]
+        stations = pl.concat(stations, how="vertical_relaxed") if stations else None
+        instrument.count("systems", len(frames))
+        instrument.count("stations", df.height if df is not None else 0)
 
-        conn = None
         try:
-            conn = psycopg2.connect(
-                dbname=os.environ['NAME'], 
-                user=os.environ['DBUSERNAME'], 
-                password=os.environ['PW'], 
-                host=os.environ['ENDPOINT']
-            )
+            with instrument.stage("connect"):
+                conn = resources.get_connection()
         except (Exception, psycopg2.Error) as error:
             print(f"Error connecting to database: {error}")
             return False
 
-        if conn:
-            command = """
-                INSERT INTO station_status_log
-                (name, lat, lon, capacity, bikes_av, docks_av, is_functional, fetched_at) 
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s); 
-                """
-            
-            data_to_insert = [row + (fetch_timestamp,) for row in df.rows()]
-            
-            try:
-                with conn:
-                    with conn.cursor() as curs:
-                        psycopg2.extras.execute_batch(curs, command, data_to_insert)
-                        print(f"Successfully inserted {len(data_to_insert)} rows.")
-                        bool = True
-                            
-            except (Exception, psycopg2.Error) as error:
-                print(f"Error during insert: {error}")
-                bool = False
-            
-            finally:
-                if conn is not None:
-                    conn.close()
-                    print("Database connection closed.")
-                    return bool
-    
-    def aggregate():
-        conn = None
-            
         try:
-            conn = psycopg2.connect(
-            dbname=os.environ['NAME'], 
-            user=os.environ['DBUSERNAME'], 
-            password=os.environ['PW'], 
-            host=os.environ['ENDPOINT']
-        )
+            # "write" covers the whole transaction including the commit
+            with instrument.stage("write"), conn:
+                with conn.cursor() as curs:
+                    if stations is not None:
+                        with instrument.stage("upsert_stations"):
+                            n = upsert_stations(curs, stations)
+                        instrument.count("stations_upserted", n)
+                        print(f"Upserted {n} stations.")
+                    if df is not None:
+                        write_snapshots(curs, df)
+            return True
+                        
         except (Exception, psycopg2.Error) as error:
-            print(f"Error connecting to database: {error}")
+            print(f"Database error occurred: {error}. Transaction will be rolled back.")
+            instrument.fail(error)
+            # don't hand a possibly broken connection to the next invocation
+            resources.discard_connection()
             return False
-                
-        if conn:
-            try:
-                with conn:
-                    with conn.cursor() as curs:
-                    
-                        curs.execute("SELECT MAX(fetched_at) FROM station_status_log;")
-                        row = curs.fetchone()
-                    
-                        if not (row and row[0]):
-                            print("No data found in station_status_log.")
-                            return 
-                            
-                        most_recent = row[0]
-                        print(f"Processing data for timestamp: {most_recent}")
-
-                        aggregate_command = """
-                            SELECT
-                                SUM(bikes_av),
-                                SUM(docks_av),
-                                COUNT(*) FILTER (WHERE bikes_av < 3),
-                                COUNT(*) FILTER (WHERE docks_av < 3)
-                            FROM station_status_log
-                            WHERE fetched_at = %s;
-                        """
-                        curs.execute(aggregate_command, (most_recent,))
-                        agg_row = curs.fetchone()
-                
-                        if not agg_row:
-                            print(f"Could not fetch aggregates for {most_recent}.")
-                            raise Exception("Aggregate query returned no rows")
-
-                        insert_command = """
-                            INSERT INTO system_aggregate_log
-                            (total_bikes_av, total_docks_av, empty_stations, full_stations, fetched_at)
-                            VALUES (%s, %s, %s, %s, %s)
-                        """
-                        vals = agg_row + (most_recent,)
-                        
-                        curs.execute(insert_command, vals)
-                        print("Successfully inserted aggregate data.")
-                                
-            except (Exception, psycopg2.DatabaseError) as error:
-                print(f"Database error occurred: {error}. Transaction will be rolled back.")
-                return False
-            finally:
-                if conn is not None:
-                    conn.close()
-                    print("Database connection closed.")
-                    return True
-                        
-    if fetch():
-        print("Fetch successfull. Aggregating...")
-        aggregate()
-        print("Lambda successful.")
-        return True
-    else:
+
+    def archive_to_parquet(df, fetch_timestamp):
+        # best effort, the db already has the snapshot
+        try:
+            with instrument.stage("archive"):
+                path = archive.archive_snapshot(df, fetch_timestamp)
+            print(f"Archived snapshot to {path}.")
+        except Exception as e:
+            print(f"Error archiving snapshot: {e}")
+
+    # the feed states are only committed (gbfs.commit) after the write: whatever goes wrong
+    # before that, including a timeout, the next run fetches and writes these snapshots again
+    snapshots, failed, pending = fetch()
+    if failed:
+        print(f"No snapshot from: {', '.join(failed)}.")
+    if not snapshots:
+        print("Lambda unsuccessful." if failed else "Lambda successful, no new snapshot.")
+        return not failed
+    if not store(snapshots):
         print("Lambda unsuccessful.")
         return False
+    for system_id in snapshots:
+        for feed, state in pending[system_id]:
+            gbfs.commit(system_id, feed, state)
+    # the archive (and replay / the offline dashboard) only covers the primary system
+    if archive.ARCHIVE_ROOT and snapshots.get(gbfs.PRIMARY_SYSTEM, (None,))[0] is not None:
+        archive_to_parquet(*snapshots[gbfs.PRIMARY_SYSTEM][:2])
+    print("Lambda unsuccessful." if failed else "Lambda successful.")
+    return not failed
             
 def handler(event, context):
+    global _cold_start
+    cold = _cold_start
+    _cold_start = False
+
+    instrument.start(
+        "ingest",
+        cold_start=cold,
+        module_init_s=round(_MODULE_INIT_S, 4) if cold else 0.0,
+        insert_mode=INSERT_MODE,
+        storage_mode=delta.STORAGE_MODE,
+    )
+    ok = False
     try:
-        return main()
+        with instrument.stage("import"):
+            load_dependencies()
+        ok = main()
+        return ok
     except Exception as e:
         print(f"Unhandled: {e}")
+        instrument.fail(e)
         return False
+    finally:
+        conn = None
+        if instrument.RUN_LOG:
+            try:
+                conn = resources.get_connection()
+            except Exception as e:
+                print(f"No connection for pipeline_run_log: {e}")
+        instrument.finish(ok, conn)
     
 # code works. 
 # after lunch : run the container -> export needed variables -> see print statements locally
@@ -186,5 +373,5 @@ def handler(event, context):
 if __name__ == "__main__":
     main()
     
-# docker buildx build --platform linux/arm64 --provenance=false -t bixi-lambda:latest .
+# docker buildx build --platform linux/arm64 --provenance=false -f serverless/Dockerfile -t bixi-lambda:latest .  (from the repo root)
 # docker run --platform linux/arm64 -p 9000:8080 bixi-lambda:latest
\ No newline at end of file
@@ -0,0 +1,68 @@
+# long-lived handles that survive across warm lambda invocations
+# the container is reused between invocations, so module globals stick around:
+# keep one db connection and one http session instead of reconnecting every 5 mins
+import os
+
+_conn = None
+_session = None
+
+
+def _connect():
+    import psycopg2
+    return psycopg2.connect(
+        dbname=os.environ['NAME'],
+        user=os.environ['DBUSERNAME'],
+        password=os.environ['PW'],
+        host=os.environ['ENDPOINT'],
+        connect_timeout=10,
+        # tcp keepalives so a frozen container doesn't come back to a half-dead socket silently
+        keepalives=1,
+        keepalives_idle=60,
+        keepalives_interval=10,
+        keepalives_count=3,
+    )
+
+
+def _is_alive(conn):
+    import psycopg2
+    if conn is None or conn.closed:
+        return False
+    try:
+        with conn.cursor() as curs:
+            curs.execute("SELECT 1;")
+        conn.rollback()
+        return True
+    except (Exception, psycopg2.Error) as error:
+        print(f"Cached db connection is dead ({error}), reconnecting.")
+        return False
+
+
+def get_connection():
+    # cached connection if it still answers, a fresh one otherwise
+    global _conn
+    if not _is_alive(_conn):
+        discard_connection()
+        _conn = _connect()
+        print("Connected to db.")
+    return _conn
+
+
+def discard_connection():
+    # drop the cached connection, e.g. after an error left it in a bad state
+    global _conn
+    if _conn is not None:
+        try:
+            _conn.close()
+        except Exception:
+            pass
+    _conn = None
+
+
+def get_session():
+    # keep-alive session to gbfs.velobixi.com, reused across warm invocations
+    global _session
+    if _session is None:
+        import requests
+        _session = requests.Session()
+        _session.headers.update({"User-Agent": "bixi-dashboard-ingest"})
+    return _session
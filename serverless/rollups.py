@@ -0,0 +1,41 @@
+# hourly / daily rollups of system_aggregate_log, kept up to date by the ingest
+# each snapshot folds its aggregate row into the bucket it falls in (min, max, running sum
+# and sample count, so avg = sum / samples), in the same transaction as the snapshot
+# buckets are cut on Montreal local time so a "day" is a Montreal day
+
+RESOLUTIONS = ("hour", "day")
+METRICS = ("total_bikes_av", "total_docks_av", "empty_stations", "full_stations")
+TIMEZONE = "America/Toronto"
+
+
+def _upsert_command():
+    columns = ", ".join(f"{m}_min, {m}_max, {m}_sum" for m in METRICS)
+    values = ", ".join(f"%({m})s, %({m})s, %({m})s" for m in METRICS)
+    updates = ",\n            ".join(
+        f"{m}_min = LEAST(r.{m}_min, EXCLUDED.{m}_min), "
+        f"{m}_max = GREATEST(r.{m}_max, EXCLUDED.{m}_max), "
+        f"{m}_sum = r.{m}_sum + EXCLUDED.{m}_sum"
+        for m in METRICS
+    )
+    return f"""
+        INSERT INTO system_aggregate_rollup AS r (system_id, resolution, bucket, samples, {columns})
+        VALUES (
+            %(system_id)s,
+            %(resolution)s,
+            date_trunc(%(resolution)s, %(fetched_at)s::timestamptz AT TIME ZONE '{TIMEZONE}') AT TIME ZONE '{TIMEZONE}',
+            1, {values}
+        )
+        ON CONFLICT (system_id, resolution, bucket) DO UPDATE SET
+            samples = r.samples + 1,
+            {updates};
+    """
+
+
+UPSERT_ROLLUP = _upsert_command()
+
+
+def update_rollups(curs, agg):
+    # agg: one row per system snapshot (system_id, fetched_at and the metrics)
+    for values in agg.iter_rows(named=True):
+        for resolution in RESOLUTIONS:
+            curs.execute(UPSERT_ROLLUP, {**values, "resolution": resolution})
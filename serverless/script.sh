@@ -9,7 +9,8 @@ if [ ! -f .env ]; then
 fi
 
 echo "Building Docker image."
-docker buildx build --platform linux/arm64 --provenance=false -t $IMAGE_NAME .
+# context is the repo root, the image needs the shared modules in ../ (instrument.py, gbfs_decode.py, notify.py, flow.py, grid.py, current.py)
+docker buildx build --platform linux/arm64 --provenance=false -f Dockerfile -t $IMAGE_NAME ..
 
 if [ $? -ne 0 ]; then
     echo "Docker build failed."
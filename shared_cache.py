@@ -0,0 +1,122 @@
+# frames shared by every dashboard process on a host (DASHBOARD_CACHE_DIR, ideally on tmpfs)
+#  - one process is the refresher: it holds an flock on refresher.lock for as long as it lives
+#    and is the only one querying postgres. when it dies the os drops the lock and the next
+#    process that asks takes over
+#  - it writes each frame once as an uncompressed arrow ipc file, then swaps current.json
+#    (the key and the file of every frame) with os.replace, so readers see a whole generation
+#    or the previous one, never a mix
+#  - readers memory-map the files through pyarrow (a streamlit dependency) and hand them to
+#    polars zero-copy: no copy per process, the pages live once in the page cache. a
+#    generation stays on disk until the one after next is published; an unlinked file stays
+#    valid for whoever still has it mapped
+import os
+import json
+import time
+import threading
+
+import polars as pl
+import pyarrow as pa
+
+try:
+    import fcntl
+except ImportError:  # windows: no election, every process refreshes for itself
+    fcntl = None
+
+POINTER = "current.json"
+
+
+class SharedFrameCache:
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        # refresher side: one publish at a time within the process
+        self.refresh_lock = threading.Lock()
+        self._lock_file = None
+        self._generation = None
+        self._frames = None
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def elect(self):
+        # True if this process is (now) the refresher; non-blocking
+        if fcntl is None:
+            return True
+        if self._lock_file is not None:
+            return True
+        f = open(self._path("refresher.lock"), "a")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        f.truncate(0)
+        f.write(str(os.getpid()))
+        f.flush()
+        self._lock_file = f  # kept open: closing it would release the lock
+        return True
+
+    def _pointer(self):
+        try:
+            with open(self._path(POINTER)) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def key(self):
+        pointer = self._pointer()
+        return pointer["key"] if pointer is not None else None
+
+    def age(self):
+        # seconds since the current generation was published
+        try:
+            return time.time() - os.stat(self._path(POINTER)).st_mtime
+        except FileNotFoundError:
+            return None
+
+    def _map(self, file):
+        # pl.read_ipc copies into memory, pyarrow keeps the buffers backed by the file
+        table = pa.ipc.open_file(pa.memory_map(self._path(file))).read_all()
+        return pl.from_arrow(table)
+
+    def read(self):
+        # -> {name: frame} of the current generation, None if nothing was published yet
+        for _ in range(3):
+            pointer = self._pointer()
+            if pointer is None:
+                return None
+            if pointer["generation"] == self._generation:
+                return self._frames
+            try:
+                frames = {name: self._map(file) for name, file in pointer["files"].items()}
+            except FileNotFoundError:
+                # swapped and cleaned up between reading the pointer and opening the files
+                continue
+            self._generation, self._frames = pointer["generation"], frames
+            return frames
+        return None
+
+    def publish(self, frames, key):
+        previous = (self._pointer() or {}).get("files", {})
+        generation = f"{os.getpid()}-{os.urandom(4).hex()}"
+        files = {}
+        for name, frame in frames.items():
+            file = f"{name}.{generation}.arrow"
+            tmp = self._path(file + ".tmp")
+            # uncompressed so readers can map it as is
+            frame.write_ipc(tmp, compression="uncompressed")
+            os.replace(tmp, self._path(file))
+            files[name] = file
+        tmp = self._path(POINTER + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump({"key": key, "generation": generation, "files": files}, f)
+        os.replace(tmp, self._path(POINTER))
+
+        # older generations than the one just replaced have had a full refresh interval to be picked up
+        keep = set(files.values()) | set(previous.values())
+        for file in os.listdir(self.directory):
+            if file.endswith(".arrow") and file not in keep:
+                try:
+                    os.remove(self._path(file))
+                except FileNotFoundError:
+                    pass
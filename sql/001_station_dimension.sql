@@ -0,0 +1,27 @@
+-- station dimension: name / position / capacity are static per station,
+-- so they're stored once here instead of on every station_status_log row
+CREATE TABLE IF NOT EXISTS station (
+    station_id TEXT PRIMARY KEY,       -- gbfs station_id
+    name TEXT NOT NULL,
+    lat DOUBLE PRECISION,
+    lon DOUBLE PRECISION,
+    capacity INTEGER,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+-- the fact table now only carries station_id + the changing values
+ALTER TABLE station_status_log ADD COLUMN IF NOT EXISTS station_id TEXT;
+ALTER TABLE station_status_log ALTER COLUMN name DROP NOT NULL;
+ALTER TABLE station_status_log ALTER COLUMN lat DROP NOT NULL;
+ALTER TABLE station_status_log ALTER COLUMN lon DROP NOT NULL;
+ALTER TABLE station_status_log ALTER COLUMN capacity DROP NOT NULL;
+
+-- after the first ingest has filled `station`, attach older rows to their station by name
+UPDATE station_status_log l
+SET station_id = s.station_id
+FROM station s
+WHERE l.station_id IS NULL AND l.name = s.name;
+
+-- once no row needs them anymore, drop the wide columns
+-- (new rows leave them NULL, which costs only a bit in the null bitmap until then)
+-- ALTER TABLE station_status_log DROP COLUMN name, DROP COLUMN lat, DROP COLUMN lon, DROP COLUMN capacity;
@@ -0,0 +1,34 @@
+-- hourly / daily buckets of system_aggregate_log for long-range charts
+-- maintained by the ingest (serverless/rollups.py), avg = <metric>_sum / samples
+CREATE TABLE IF NOT EXISTS system_aggregate_rollup (
+    resolution TEXT NOT NULL,          -- 'hour' or 'day'
+    bucket TIMESTAMPTZ NOT NULL,       -- bucket start, Montreal local time boundaries
+    samples INTEGER NOT NULL,
+    total_bikes_av_min INTEGER,
+    total_bikes_av_max INTEGER,
+    total_bikes_av_sum BIGINT,
+    total_docks_av_min INTEGER,
+    total_docks_av_max INTEGER,
+    total_docks_av_sum BIGINT,
+    empty_stations_min INTEGER,
+    empty_stations_max INTEGER,
+    empty_stations_sum BIGINT,
+    full_stations_min INTEGER,
+    full_stations_max INTEGER,
+    full_stations_sum BIGINT,
+    PRIMARY KEY (resolution, bucket)
+);
+
+-- fill the buckets from the aggregate history that predates the rollups
+INSERT INTO system_aggregate_rollup (resolution, bucket, samples, total_bikes_av_min, total_bikes_av_max, total_bikes_av_sum, total_docks_av_min, total_docks_av_max, total_docks_av_sum, empty_stations_min, empty_stations_max, empty_stations_sum, full_stations_min, full_stations_max, full_stations_sum)
+SELECT r.resolution,
+       date_trunc(r.resolution, a.fetched_at AT TIME ZONE 'America/Toronto') AT TIME ZONE 'America/Toronto' AS bucket,
+       COUNT(*),
+       MIN(a.total_bikes_av), MAX(a.total_bikes_av), SUM(a.total_bikes_av),
+       MIN(a.total_docks_av), MAX(a.total_docks_av), SUM(a.total_docks_av),
+       MIN(a.empty_stations), MAX(a.empty_stations), SUM(a.empty_stations),
+       MIN(a.full_stations), MAX(a.full_stations), SUM(a.full_stations)
+FROM system_aggregate_log a
+CROSS JOIN (VALUES ('hour'), ('day')) AS r (resolution)
+GROUP BY r.resolution, bucket
+ON CONFLICT (resolution, bucket) DO NOTHING;
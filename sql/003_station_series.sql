@@ -0,0 +1,25 @@
+-- per-station series, one row per station per Montreal day, samples as parallel arrays
+-- filled once a day after the day ends by the cleaner (cleaner/series.py), read one station at
+-- a time by the dashboard
+CREATE TABLE IF NOT EXISTS station_series (
+    station_id TEXT NOT NULL,
+    day DATE NOT NULL,
+    ts TIMESTAMPTZ[] NOT NULL,
+    bikes_av SMALLINT[] NOT NULL,
+    docks_av SMALLINT[] NOT NULL,
+    PRIMARY KEY (station_id, day)
+);
+
+-- seed from whatever station history is still in station_status_log, complete days only: the
+-- day still going is read from the log until the cleaner fills it
+INSERT INTO station_series (station_id, day, ts, bikes_av, docks_av)
+SELECT station_id,
+       (fetched_at AT TIME ZONE 'America/Toronto')::date AS day,
+       array_agg(fetched_at ORDER BY fetched_at),
+       array_agg(bikes_av::smallint ORDER BY fetched_at),
+       array_agg(docks_av::smallint ORDER BY fetched_at)
+FROM station_status_log
+WHERE station_id IS NOT NULL
+  AND fetched_at < date_trunc('day', NOW() AT TIME ZONE 'America/Toronto') AT TIME ZONE 'America/Toronto'
+GROUP BY station_id, day
+ON CONFLICT (station_id, day) DO NOTHING;
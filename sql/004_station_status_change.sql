@@ -0,0 +1,25 @@
+-- change-only storage (ingest STORAGE_MODE=delta): a row only when a station's values change,
+-- plus a full keyframe per Montreal day. station_status_at(ts) rebuilds the snapshot at ts
+CREATE TABLE IF NOT EXISTS station_status_change (
+    station_id TEXT NOT NULL,
+    bikes_av INTEGER,
+    docks_av INTEGER,
+    is_functional BOOLEAN,
+    changed_at TIMESTAMPTZ NOT NULL,
+    PRIMARY KEY (station_id, changed_at)
+);
+
+-- latest change at or before at_time for every station: one index probe per station
+CREATE OR REPLACE FUNCTION station_status_at(at_time TIMESTAMPTZ)
+RETURNS TABLE (station_id TEXT, bikes_av INTEGER, docks_av INTEGER, is_functional BOOLEAN, changed_at TIMESTAMPTZ)
+LANGUAGE sql STABLE AS $$
+    SELECT s.station_id, c.bikes_av, c.docks_av, c.is_functional, c.changed_at
+    FROM station s
+    CROSS JOIN LATERAL (
+        SELECT c.bikes_av, c.docks_av, c.is_functional, c.changed_at
+        FROM station_status_change c
+        WHERE c.station_id = s.station_id AND c.changed_at <= at_time
+        ORDER BY c.changed_at DESC
+        LIMIT 1
+    ) c;
+$$;
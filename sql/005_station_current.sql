@@ -0,0 +1,32 @@
+-- latest values per station, one row each, upserted by the ingest (serverless/current.py)
+-- in the same transaction as the snapshot. changed_at = last time the values actually changed
+CREATE TABLE IF NOT EXISTS station_current (
+    station_id TEXT PRIMARY KEY,
+    bikes_av INTEGER,
+    docks_av INTEGER,
+    is_functional BOOLEAN,
+    fetched_at TIMESTAMPTZ NOT NULL,   -- snapshot the values come from
+    changed_at TIMESTAMPTZ NOT NULL
+);
+
+-- seed from the newest snapshot in station_status_log; changed_at is the start of the current
+-- run of identical values, looking back at most a day
+WITH latest AS (
+    SELECT MAX(fetched_at) AS fetched_at FROM system_aggregate_log
+),
+recent AS (
+    SELECT l.station_id, l.bikes_av, l.docks_av, l.is_functional, l.fetched_at,
+           ROW(l.bikes_av, l.docks_av, l.is_functional) IS DISTINCT FROM
+               lag(ROW(l.bikes_av, l.docks_av, l.is_functional)) OVER (PARTITION BY l.station_id ORDER BY l.fetched_at)
+               AS changed
+    FROM station_status_log l, latest
+    WHERE l.fetched_at > latest.fetched_at - INTERVAL '1 day'
+      AND l.fetched_at <= latest.fetched_at
+      AND l.station_id IS NOT NULL
+)
+INSERT INTO station_current (station_id, bikes_av, docks_av, is_functional, fetched_at, changed_at)
+SELECT r.station_id, r.bikes_av, r.docks_av, r.is_functional, r.fetched_at,
+       (SELECT MAX(c.fetched_at) FROM recent c WHERE c.station_id = r.station_id AND c.changed)
+FROM recent r, latest
+WHERE r.fetched_at = latest.fetched_at
+ON CONFLICT (station_id) DO NOTHING;
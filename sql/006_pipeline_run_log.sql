@@ -0,0 +1,13 @@
+-- one row per pipeline run (ingest, cleaner, fetch.py, aggregate.py) when PIPELINE_RUN_LOG=1
+-- record is the full JSON line instrument.py prints: stage timings, counters, peak rss
+CREATE TABLE IF NOT EXISTS pipeline_run_log (
+    pipeline TEXT NOT NULL,
+    started_at TIMESTAMPTZ NOT NULL,
+    duration_s DOUBLE PRECISION,
+    status TEXT NOT NULL,
+    peak_rss_mb DOUBLE PRECISION,
+    record JSONB NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS pipeline_run_log_pipeline_started_at_idx
+    ON pipeline_run_log (pipeline, started_at);
@@ -0,0 +1,16 @@
+-- several gbfs systems per ingest run (GBFS_SYSTEMS), rows are tagged with the system they
+-- come from. everything already stored is bixi. station ids of the other systems are stored
+-- as "<system_id>:<gbfs station_id>", so the per-station tables keep station_id as their key
+ALTER TABLE station ADD COLUMN IF NOT EXISTS system_id TEXT NOT NULL DEFAULT 'bixi';
+ALTER TABLE station_status_log ADD COLUMN IF NOT EXISTS system_id TEXT NOT NULL DEFAULT 'bixi';
+ALTER TABLE system_aggregate_log ADD COLUMN IF NOT EXISTS system_id TEXT NOT NULL DEFAULT 'bixi';
+ALTER TABLE system_aggregate_rollup ADD COLUMN IF NOT EXISTS system_id TEXT NOT NULL DEFAULT 'bixi';
+ALTER TABLE station_current ADD COLUMN IF NOT EXISTS system_id TEXT NOT NULL DEFAULT 'bixi';
+
+-- one aggregate row per system snapshot, rollup buckets per system
+CREATE UNIQUE INDEX IF NOT EXISTS system_aggregate_log_system_fetched_at_idx
+    ON system_aggregate_log (system_id, fetched_at);
+DROP INDEX IF EXISTS system_aggregate_log_fetched_at_idx;
+
+ALTER TABLE system_aggregate_rollup DROP CONSTRAINT IF EXISTS system_aggregate_rollup_pkey;
+ALTER TABLE system_aggregate_rollup ADD PRIMARY KEY (system_id, resolution, bucket);
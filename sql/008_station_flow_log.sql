@@ -0,0 +1,21 @@
+-- bikes in / out per station and interval between consecutive snapshots (flow.py), written by
+-- the ingest with every snapshot. only intervals where bikes or docks changed get a row.
+-- rebalancing = a jump of at least REBALANCE_BIKES within a short interval, likely a truck
+CREATE TABLE IF NOT EXISTS station_flow_log (
+    station_id TEXT NOT NULL,
+    system_id TEXT NOT NULL DEFAULT 'bixi',
+    fetched_at TIMESTAMPTZ NOT NULL,   -- end of the interval
+    interval_s INTEGER NOT NULL,
+    bikes_delta SMALLINT NOT NULL,
+    docks_delta SMALLINT NOT NULL,
+    departures SMALLINT NOT NULL,      -- GREATEST(-bikes_delta, 0)
+    arrivals SMALLINT NOT NULL,        -- GREATEST(bikes_delta, 0)
+    rebalancing BOOLEAN NOT NULL,
+    PRIMARY KEY (station_id, fetched_at)
+);
+
+-- system-wide flows over a time range, and the cleaner's retention delete
+CREATE INDEX IF NOT EXISTS station_flow_log_fetched_at_idx
+    ON station_flow_log (fetched_at);
+
+-- fill it for the history already stored: python flow.py --since <date>
@@ -0,0 +1,27 @@
+-- spatial grid (grid.py): every station gets a precision-7 geohash, set by the ingest when it
+-- upserts the station; a prefix of it is the coarser cell. nearby lookups read the stations of
+-- a few precision-6 cells through the index instead of scanning the table
+ALTER TABLE station ADD COLUMN IF NOT EXISTS geohash TEXT;
+CREATE INDEX IF NOT EXISTS station_system_cell_idx
+    ON station (system_id, left(geohash, 6));
+
+-- latest per-cell totals of every system, one row per cell and precision (grid.CELL_PRECISIONS),
+-- upserted by the ingest in the same transaction as the snapshot. what the zoomed-out map draws
+CREATE TABLE IF NOT EXISTS cell_current (
+    system_id TEXT NOT NULL,
+    precision SMALLINT NOT NULL,       -- geohash length of cell
+    cell TEXT NOT NULL,
+    stations INTEGER NOT NULL,
+    functional_stations INTEGER NOT NULL,
+    bikes_av INTEGER NOT NULL,
+    docks_av INTEGER NOT NULL,
+    empty_stations INTEGER NOT NULL,   -- bikes_av < STRESS_THRESHOLD
+    full_stations INTEGER NOT NULL,    -- docks_av < STRESS_THRESHOLD
+    lat DOUBLE PRECISION NOT NULL,     -- mean position of the cell's stations
+    lon DOUBLE PRECISION NOT NULL,
+    fetched_at TIMESTAMPTZ NOT NULL,   -- snapshot the totals come from
+    PRIMARY KEY (system_id, precision, cell)
+);
+
+-- fill station.geohash for the stations already stored: python grid.py
+-- (cell_current fills itself with the next snapshot)
@@ -0,0 +1,9 @@
+-- pipeline_run_log.peak_rss_mb held ru_maxrss, the peak of the whole process rather than of the
+-- run: a warm lambda container reports the highest value of every invocation so far
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM information_schema.columns
+               WHERE table_name = 'pipeline_run_log' AND column_name = 'peak_rss_mb') THEN
+        ALTER TABLE pipeline_run_log RENAME COLUMN peak_rss_mb TO process_peak_rss_mb;
+    END IF;
+END $$;
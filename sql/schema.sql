@@ -0,0 +1,182 @@
+-- full schema, safe to re-run (everything is IF NOT EXISTS)
+-- on a fresh database: psql -f sql/schema.sql, then run the cleaner once
+-- (cleaner/partitions.py maintain) so station_status_log has partitions to write into
+
+-- one row per station, upserted by the ingest when station_information changes
+CREATE TABLE IF NOT EXISTS station (
+    station_id TEXT PRIMARY KEY,       -- gbfs station_id
+    name TEXT NOT NULL,
+    lat DOUBLE PRECISION,
+    lon DOUBLE PRECISION,
+    capacity INTEGER,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    system_id TEXT NOT NULL DEFAULT 'bixi',  -- gbfs system (see sql/007_multi_system.sql)
+    geohash TEXT                       -- precision 7, set by the ingest (grid.py)
+);
+
+-- ~1,000 rows per snapshot, partitioned by day on fetched_at (see cleaner/partitions.py)
+CREATE TABLE IF NOT EXISTS station_status_log (
+    station_id TEXT,
+    bikes_av INTEGER,
+    docks_av INTEGER,
+    is_functional BOOLEAN,
+    fetched_at TIMESTAMPTZ NOT NULL,
+    system_id TEXT NOT NULL DEFAULT 'bixi'
+) PARTITION BY RANGE (fetched_at);
+-- rows no daily partition covers land here instead of failing the ingest
+CREATE TABLE IF NOT EXISTS station_status_log_default PARTITION OF station_status_log DEFAULT;
+
+-- one row per system snapshot, written in the same transaction as the snapshot itself
+CREATE TABLE IF NOT EXISTS system_aggregate_log (
+    total_bikes_av INTEGER,
+    total_docks_av INTEGER,
+    empty_stations INTEGER,
+    full_stations INTEGER,
+    fetched_at TIMESTAMPTZ NOT NULL,
+    system_id TEXT NOT NULL DEFAULT 'bixi'
+);
+
+-- hourly / daily buckets of system_aggregate_log for long-range charts
+-- maintained by the ingest (serverless/rollups.py), avg = <metric>_sum / samples
+CREATE TABLE IF NOT EXISTS system_aggregate_rollup (
+    resolution TEXT NOT NULL,          -- 'hour' or 'day'
+    bucket TIMESTAMPTZ NOT NULL,       -- bucket start, Montreal local time boundaries
+    samples INTEGER NOT NULL,
+    total_bikes_av_min INTEGER,
+    total_bikes_av_max INTEGER,
+    total_bikes_av_sum BIGINT,
+    total_docks_av_min INTEGER,
+    total_docks_av_max INTEGER,
+    total_docks_av_sum BIGINT,
+    empty_stations_min INTEGER,
+    empty_stations_max INTEGER,
+    empty_stations_sum BIGINT,
+    full_stations_min INTEGER,
+    full_stations_max INTEGER,
+    full_stations_sum BIGINT,
+    system_id TEXT NOT NULL DEFAULT 'bixi',
+    PRIMARY KEY (system_id, resolution, bucket)
+);
+
+-- per-station series, one row per station per Montreal day, samples as parallel arrays
+-- filled once a day after the day ends by the cleaner (cleaner/series.py), read one station at
+-- a time by the dashboard
+CREATE TABLE IF NOT EXISTS station_series (
+    station_id TEXT NOT NULL,
+    day DATE NOT NULL,
+    ts TIMESTAMPTZ[] NOT NULL,
+    bikes_av SMALLINT[] NOT NULL,
+    docks_av SMALLINT[] NOT NULL,
+    PRIMARY KEY (station_id, day)
+);
+
+-- latest values per station, one row each, upserted by the ingest (serverless/current.py)
+-- in the same transaction as the snapshot. changed_at = last time the values actually changed
+CREATE TABLE IF NOT EXISTS station_current (
+    station_id TEXT PRIMARY KEY,
+    bikes_av INTEGER,
+    docks_av INTEGER,
+    is_functional BOOLEAN,
+    fetched_at TIMESTAMPTZ NOT NULL,   -- snapshot the values come from
+    changed_at TIMESTAMPTZ NOT NULL,
+    system_id TEXT NOT NULL DEFAULT 'bixi'
+);
+
+-- change-only storage (ingest STORAGE_MODE=delta): a row only when a station's values change,
+-- plus a full keyframe per Montreal day. station_status_at(ts) rebuilds the snapshot at ts
+CREATE TABLE IF NOT EXISTS station_status_change (
+    station_id TEXT NOT NULL,
+    bikes_av INTEGER,
+    docks_av INTEGER,
+    is_functional BOOLEAN,
+    changed_at TIMESTAMPTZ NOT NULL,
+    PRIMARY KEY (station_id, changed_at)
+);
+
+-- latest change at or before at_time for every station: one index probe per station
+CREATE OR REPLACE FUNCTION station_status_at(at_time TIMESTAMPTZ)
+RETURNS TABLE (station_id TEXT, bikes_av INTEGER, docks_av INTEGER, is_functional BOOLEAN, changed_at TIMESTAMPTZ)
+LANGUAGE sql STABLE AS $$
+    SELECT s.station_id, c.bikes_av, c.docks_av, c.is_functional, c.changed_at
+    FROM station s
+    CROSS JOIN LATERAL (
+        SELECT c.bikes_av, c.docks_av, c.is_functional, c.changed_at
+        FROM station_status_change c
+        WHERE c.station_id = s.station_id AND c.changed_at <= at_time
+        ORDER BY c.changed_at DESC
+        LIMIT 1
+    ) c;
+$$;
+
+-- one row per pipeline run (ingest, cleaner, fetch.py, aggregate.py) when PIPELINE_RUN_LOG=1
+-- record is the full JSON line instrument.py prints: stage timings, counters, the process's peak
+-- rss so far (a warm lambda container carries it over from earlier invocations)
+CREATE TABLE IF NOT EXISTS pipeline_run_log (
+    pipeline TEXT NOT NULL,
+    started_at TIMESTAMPTZ NOT NULL,
+    duration_s DOUBLE PRECISION,
+    status TEXT NOT NULL,
+    process_peak_rss_mb DOUBLE PRECISION,
+    record JSONB NOT NULL
+);
+
+-- bikes in / out per station and interval between consecutive snapshots (flow.py), only
+-- intervals where something changed. rebalancing = a jump too big and too quick for riders
+CREATE TABLE IF NOT EXISTS station_flow_log (
+    station_id TEXT NOT NULL,
+    system_id TEXT NOT NULL DEFAULT 'bixi',
+    fetched_at TIMESTAMPTZ NOT NULL,   -- end of the interval
+    interval_s INTEGER NOT NULL,
+    bikes_delta SMALLINT NOT NULL,
+    docks_delta SMALLINT NOT NULL,
+    departures SMALLINT NOT NULL,
+    arrivals SMALLINT NOT NULL,
+    rebalancing BOOLEAN NOT NULL,
+    PRIMARY KEY (station_id, fetched_at)
+);
+
+-- latest per-cell totals (grid.py), one row per system / geohash precision / cell, upserted by
+-- the ingest with every snapshot. the zoomed-out map draws these instead of every station
+CREATE TABLE IF NOT EXISTS cell_current (
+    system_id TEXT NOT NULL,
+    precision SMALLINT NOT NULL,
+    cell TEXT NOT NULL,
+    stations INTEGER NOT NULL,
+    functional_stations INTEGER NOT NULL,
+    bikes_av INTEGER NOT NULL,
+    docks_av INTEGER NOT NULL,
+    empty_stations INTEGER NOT NULL,
+    full_stations INTEGER NOT NULL,
+    lat DOUBLE PRECISION NOT NULL,
+    lon DOUBLE PRECISION NOT NULL,
+    fetched_at TIMESTAMPTZ NOT NULL,
+    PRIMARY KEY (system_id, precision, cell)
+);
+
+-- latest snapshot (= fetched_at) and time-range history (fetched_at >= ...)
+CREATE INDEX IF NOT EXISTS station_status_log_fetched_at_idx
+    ON station_status_log (fetched_at);
+
+-- one station over a time range
+CREATE INDEX IF NOT EXISTS station_status_log_station_fetched_at_idx
+    ON station_status_log (station_id, fetched_at);
+
+-- a system's MAX(fetched_at) is a single index probe, and one aggregate row per system snapshot
+-- (older databases may hold duplicate aggregate rows, keep the first of each)
+DELETE FROM system_aggregate_log a
+USING system_aggregate_log b
+WHERE a.system_id = b.system_id AND a.fetched_at = b.fetched_at AND a.ctid > b.ctid;
+CREATE UNIQUE INDEX IF NOT EXISTS system_aggregate_log_system_fetched_at_idx
+    ON system_aggregate_log (system_id, fetched_at);
+
+-- a pipeline's runs over time
+CREATE INDEX IF NOT EXISTS pipeline_run_log_pipeline_started_at_idx
+    ON pipeline_run_log (pipeline, started_at);
+
+-- system-wide flows over a time range, and the cleaner's retention delete
+CREATE INDEX IF NOT EXISTS station_flow_log_fetched_at_idx
+    ON station_flow_log (fetched_at);
+
+-- stations of a few precision-6 cells (nearby lookups)
+CREATE INDEX IF NOT EXISTS station_system_cell_idx
+    ON station (system_id, left(geohash, 6));
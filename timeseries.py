@@ -0,0 +1,63 @@
+# long-range chart helpers: pick raw / hourly / daily data from the requested range, then
+# cap the number of points with largest-triangle-three-buckets (LTTB) downsampling, which
+# keeps the visual shape (peaks and dips) far better than taking every n-th point
+import datetime as dt
+
+import numpy as np
+import polars as pl
+
+MAX_CHART_POINTS = 1000
+
+# (longest range served at this resolution, resolution); None = raw system_aggregate_log rows
+RESOLUTIONS = (
+    (dt.timedelta(days=2), None),
+    (dt.timedelta(days=60), "hour"),
+    (None, "day"),
+)
+
+
+def pick_resolution(start, end):
+    span = end - start
+    for longest, resolution in RESOLUTIONS:
+        if longest is None or span <= longest:
+            return resolution
+    return RESOLUTIONS[-1][1]
+
+
+def lttb_indices(x, y, n_out):
+    # indices of the points LTTB keeps, always including the first and last one
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    bucket_edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    keep = np.empty(n_out, dtype=np.int64)
+    keep[0] = 0
+    keep[-1] = n - 1
+    prev = 0
+    for i in range(n_out - 2):
+        start, end = bucket_edges[i], bucket_edges[i + 1]
+        # average of the next bucket is the third corner of the triangle
+        next_end = bucket_edges[i + 2] if i + 2 < len(bucket_edges) else n
+        avg_x = x[end:next_end].mean()
+        avg_y = y[end:next_end].mean()
+        area = np.abs(
+            (x[prev] - avg_x) * (y[start:end] - y[prev])
+            - (x[prev] - x[start:end]) * (avg_y - y[prev])
+        )
+        prev = start + int(np.argmax(area))
+        keep[i + 1] = prev
+    return keep
+
+
+def downsample(df, x_col, y_cols, max_points=MAX_CHART_POINTS):
+    # LTTB per y column, keeping the union of the picked rows so every line keeps its shape
+    if df.height <= max_points:
+        return df
+    x = df.get_column(x_col).dt.epoch("ms").to_numpy().astype(np.float64)
+    keep = set()
+    per_series = max(3, max_points // len(y_cols))
+    for col in y_cols:
+        y = df.get_column(col).cast(pl.Float64).fill_null(0.0).to_numpy()
+        keep.update(lttb_indices(x, y, per_series).tolist())
+    return df[sorted(keep)]